@@ -0,0 +1,136 @@
+"""
+Segments per second through TcpConnection.segment_received for the common
+ESTABLISHED cases, with and without header prediction, the cost of a
+pure ACK as the retransmission queue grows, and the cost of driving the
+timers of many connections by polling tick() versus a timer wheel
+
+    python benchmark.py [-n SEGMENTS] [-c CONNECTIONS]
+"""
+import argparse
+import time
+
+import config
+from config import TcpConfig
+from tcp_connection import TcpConnection
+from tcp_segment import TcpHeader, TcpSegment
+from test_sender import connected_pair
+from timer_wheel import ConnectionTimers
+
+
+def bench(header_prediction: bool, n: int):
+    """
+    a sends n full-sized segments to b, b acks each of them;
+    time b receiving the data and a receiving the pure ACKs
+    """
+    a, b = connected_pair(header_prediction=header_prediction,
+                          send_capacity=1 << 24, recv_capacity=1 << 24)
+    a.write(b'x' * (n * a._max_payload_size))
+    data_time = ack_time = 0.0
+    acks_received = 0
+    while a.segments_out:
+        data = list(a.segments_out)
+        a.segments_out.clear()
+        start = time.perf_counter()
+        for seg in data:
+            b.segment_received(seg)
+            # the application keeps up, so the advertised window stays put
+            b.outbound_stream.pop_output(b.outbound_stream.size)
+        data_time += time.perf_counter() - start
+
+        acks = list(b.segments_out)
+        b.segments_out.clear()
+        start = time.perf_counter()
+        for seg in acks:
+            a.segment_received(seg)
+        ack_time += time.perf_counter() - start
+        acks_received += len(acks)
+    assert b.outbound_stream.bytes_read == n * a._max_payload_size
+    assert a.bytes_in_flight == 0
+    return n / data_time, acks_received / ack_time
+
+
+def bench_ack_cost(outstanding: int, acks: int = 1000):
+    """
+    us per pure ACK freeing one segment with outstanding segments still
+    in flight; flat when ACK processing does not walk the queue
+    """
+    a, b = connected_pair(send_capacity=1 << 25, recv_capacity=1 << 25)
+    a._receiver_window_size = 1 << 30
+    a.write(b'x' * ((outstanding + acks) * a._max_payload_size))
+    data = list(a.segments_out)
+    a.segments_out.clear()
+    for seg in data[:acks]:
+        b.segment_received(seg)
+    ack_segs = list(b.segments_out)
+    b.segments_out.clear()
+    start = time.perf_counter()
+    for seg in ack_segs:
+        a.segment_received(seg)
+    elapsed = time.perf_counter() - start
+    assert len(a._outgoing_segments) == outstanding
+    return elapsed * 1e6 / len(ack_segs)
+
+
+def busy_connections(n: int):
+    """
+    n established connections, one in ten with unacknowledged data
+    (RTO armed), the rest idle
+    """
+    conns = []
+    for i in range(n):
+        conn = TcpConnection(TcpConfig(), 1000)
+        conn.connect()
+        conn.segment_received(TcpSegment(TcpHeader(
+            syn=True, ack=True, seqno=5000, ackno=1001, win=65535)))
+        if i % 10 == 0:
+            conn.write(b'x')
+        conn.segments_out.clear()
+        conns.append(conn)
+    return conns
+
+
+def bench_timers(n: int, duration: int = 3000, step: int = 10):
+    """
+    ms per 10 ms loop iteration spent on timers, polling every
+    connection with tick() versus only those a timer wheel says are due
+    """
+    conns = busy_connections(n)
+    start = time.perf_counter()
+    for _ in range(duration // step):
+        for conn in conns:
+            conn.tick(step)
+    poll_time = time.perf_counter() - start
+
+    conns = busy_connections(n)
+    timers = ConnectionTimers()
+    for conn in conns:
+        timers.add(conn)
+    start = time.perf_counter()
+    for _ in range(duration // step):
+        timers.advance(step)
+    wheel_time = time.perf_counter() - start
+    iterations = duration // step
+    return poll_time * 1000 / iterations, wheel_time * 1000 / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=10000, help='segments to send')
+    parser.add_argument('-c', type=int, default=10000, help='connections for the timer benchmark')
+    args = parser.parse_args()
+    # keep the FSM log out of the measurement
+    config.ENABLED_CHANNELS.clear()
+    for header_prediction in (False, True):
+        data_rate, ack_rate = bench(header_prediction, args.n)
+        print(f'header_prediction={header_prediction!s:5}  '
+              f'in-order data {data_rate:10.0f} seg/s  pure ACK {ack_rate:10.0f} seg/s')
+    costs = '  '.join(f'{outstanding}: {bench_ack_cost(outstanding):6.1f} us'
+                      for outstanding in (100, 1000, 10000))
+    print(f'pure ACK by segments in flight  {costs}')
+    poll_ms, wheel_ms = bench_timers(args.c)
+    print(f'{args.c} connections, per 10 ms loop: '
+          f'tick() polling {poll_ms:8.3f} ms  timer wheel {wheel_ms:8.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
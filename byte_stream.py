@@ -1,7 +1,7 @@
 class ByteStream:
     def __init__(self, capacity: int) -> int:
         self._capacity = capacity
-        self._buffer = b''
+        self._buffer = bytearray()
         self._error = False
         self._bytes_written = 0
         self._bytes_read = 0
@@ -25,20 +25,20 @@ class ByteStream:
         if n > self.size:
             self._error = True
             return data
-        data = self._buffer[:n]
-        self._buffer = self._buffer[n:]
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
         self._bytes_read += n
         return data
 
     def peek_output(self, size: int) -> bytes:
         peek_len = min(size, self.size)
-        return self._buffer[:peek_len]
+        return bytes(self._buffer[:peek_len])
 
     def pop_output(self, size: int):
         if size > self.size:
             self._error = True
             return
-        self._buffer = self._buffer[size:]
+        del self._buffer[:size]
         self._bytes_read += size
 
     def end_input(self):
@@ -76,6 +76,11 @@ class ByteStream:
     def capacity(self):
         return self._capacity
 
+    @capacity.setter
+    def capacity(self, val: int):
+        assert val >= self.size
+        self._capacity = val
+
     @property
     def remaining_capacity(self) -> int:
         return self._capacity - self.size
@@ -14,10 +14,73 @@ class TcpConfig:
     TIMEOUT_DFLT = 1000
     # 最大重传次数为8
     MAX_RETX_ATTEMPTS = 8
+    # 窗口扩大因子最大为14 (RFC 7323)
+    MAX_WINDOW_SCALE = 14
+    # PLPMTUD 探测的起始 MSS 和停止探测的区间大小
+    MTU_PROBE_BASE_MSS = 1024
+    MTU_PROBE_THRESHOLD = 8
+    # RTT 估计得到的超时重传时间的上下限
+    MIN_RTO = 200
+    MAX_RTO = 60000
+    # 零窗口探测定时器的退避上限
+    PERSIST_TIMEOUT_MAX = 60000
+
+    # 拥塞窗口的初始大小 (RFC 6928) 和快速重传的重复确认个数
+    INITIAL_WINDOW = 10
+    DUPACK_THRESHOLD = 3
+
+    # 延迟确认定时器为40ms
+    DELACK_TIMEOUT = 40
+    # 连接开始时立即确认的数据段个数
+    QUICKACK_SEGMENTS = 2
 
     rt_timeout = TIMEOUT_DFLT
     recv_capacity = DEFAULT_CAPACITY
     send_capacity = DEFAULT_CAPACITY
+    # ACK every second full-sized segment or after DELACK_TIMEOUT
+    delayed_ack = False
+    # hold sub-MSS segments while data is unacknowledged (Nagle)
+    nagle = False
+    # append small writes to a segment still waiting in segments_out
+    autocork = False
+    # negotiate the window scale option in the SYN exchange
+    window_scaling = True
+    # MSS advertised in our SYN, MAX_PAYLOAD_SIZE when not derived from the MTU
+    mss = None
+    # packetization layer path MTU discovery (RFC 4821)
+    mtu_probing = False
+    # negotiate the timestamps option for RTT measurement and PAWS (RFC 7323)
+    timestamps = True
+    # grow recv_capacity with the application's read rate (dynamic right-sizing)
+    rcvbuf_autotuning = False
+    # upper bound for an autotuned receive buffer
+    recv_capacity_max = 4 * 1024 * 1024
+    # autotuned buffers shrink back once all connections together exceed this
+    recv_memory_limit = 64 * 1024 * 1024
+    # Reno congestion window with PRR during loss recovery (RFC 5681, RFC 6937)
+    congestion_control = False
+    # negotiate ECN, mark data ECT(0) and reduce cwnd on echoed CE marks (RFC 3168)
+    ecn = False
+    # negotiate selective acknowledgments (RFC 2018)
+    sack = True
+    # RACK-TLP time-based loss detection and tail loss probes (RFC 8985)
+    rack = False
+    # merge small outstanding segments into one MSS-sized retransmission
+    retx_coalesce = False
+    # handle in-order data and pure ACKs in ESTABLISHED without the FSM (header prediction)
+    header_prediction = True
+    # grow send_capacity toward twice the bytes delivered per RTT
+    sndbuf_autosizing = False
+    # upper bound for an autosized send buffer
+    send_capacity_max = 4 * 1024 * 1024
+    # autosized send buffers stop growing once all connections together exceed this
+    send_memory_limit = 64 * 1024 * 1024
+    # half-open connections a listener keeps before it answers with SYN cookies
+    syn_backlog = 128
+    # answer SYNs with cookies once the SYN queue is full, instead of dropping them
+    syncookies = True
+    # local ports handed out to outgoing connections that do not pick one
+    ephemeral_port_range = (32768, 60999)
 
     MSL = 1000 * 120
 
@@ -52,7 +52,10 @@ class EventLoop:
         else:
             try:
                 fd = int(fileobj.fileno())
-            except (AttributeError, TypeError, ValueError):
+            except ValueError:
+                # SocketPair.fileno() once closed
+                return True
+            except (AttributeError, TypeError):
                 raise ValueError("Invalid file object: "
                                  "{!r}".format(fileobj)) from None
         try:
@@ -80,9 +83,11 @@ class EventLoop:
             if fileobj in self.write_rules:
                 self.write_rules[fileobj].cancel()
                 self.write_rules.pop(fileobj)
+                self.wlist.remove(fileobj)
             if fileobj in self.read_rules:
                 self.read_rules[fileobj].cancel()
                 self.read_rules.pop(fileobj)
+                self.rlist.remove(fileobj)
 
         # exit when not interested in any event
         if not something_interested:
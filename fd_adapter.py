@@ -2,6 +2,7 @@ import struct
 import fcntl
 import struct
 import os
+import socket
 from abc import ABC, abstractmethod
 from typing import Optional
 
@@ -13,6 +14,8 @@ class FdAdapter(ABC):
     def __init__(self):
         self.config: Optional[FdAdapterConfig] = None
         self.listening = False
+        # link MTU, None when the device cannot tell
+        self.mtu: Optional[int] = None
 
     @abstractmethod
     def read(self) -> Optional[TcpSegment]:
@@ -36,6 +39,7 @@ class TcpOverUdpAdapter(FdAdapter):
 
 # Constants for ioctl
 TUNSETIFF = 0x400454ca
+SIOCGIFMTU = 0x8921
 IFF_TUN = 0x0001
 IFF_TAP = 0x0002
 IFF_NO_PI = 0x1000
@@ -44,6 +48,7 @@ IFF_NO_PI = 0x1000
 class TcpOverIpv4OverTunAdapter(FdAdapter):
     def __init__(self, ifname: str):
         super().__init__()
+        self.ifname = ifname
         try:
             # Open the TUN device file
             self.tun = os.open('/dev/net/tun', os.O_RDWR)
@@ -56,17 +61,26 @@ class TcpOverIpv4OverTunAdapter(FdAdapter):
             if hasattr(self, 'tun'):
                 os.close(self.tun)
             raise
+        self.mtu = self._query_mtu()
 
-    def read(self) -> Optional[TcpSegment]:
-        assert self.config
+    def _query_mtu(self) -> Optional[int]:
+        ifr = struct.pack('16si', self.ifname.encode('utf-8'), 0)
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                ifr = fcntl.ioctl(s, SIOCGIFMTU, ifr)
+        except OSError:
+            return None
+        return struct.unpack('16si', ifr)[1]
+
+    def read_segment(self) -> Optional[TcpSegment]:
+        """
+        Read one TCP segment for any address, None if the datagram is not
+        valid TCP. src_ip/dst_ip and the ports identify the connection
+        """
         recv_data = os.read(self.tun, 65535)
         ip_dgram = IPv4Datagram.deserialize(recv_data)
         if not ip_dgram:
             return None
-        if not self.listening and ip_dgram.header.dst_ip != self.config.saddr:
-            return None
-        if not self.listening and ip_dgram.header.src_ip != self.config.daddr:
-            return None
         if ip_dgram.header.proto != IPv4Header.PROTO_TCP:
             return None
         seg = TcpSegment.deserialize(ip_dgram.payload,
@@ -74,11 +88,46 @@ class TcpOverIpv4OverTunAdapter(FdAdapter):
                                      dst_ip=ip_dgram.header.dst_ip)
         if not seg:
             return None
+        seg.ce = ip_dgram.header.tos & IPv4Header.ECN_MASK == IPv4Header.ECN_CE
+        return seg
+
+    @staticmethod
+    def datagram(seg: TcpSegment) -> IPv4Datagram:
+        """
+        The IPv4 datagram carrying a segment. DF is always set, as Linux
+        does under path MTU discovery: an oversized PLPMTUD probe has to be
+        dropped, not fragmented and acknowledged
+        """
+        return IPv4Datagram(
+            IPv4Header(
+                tos = IPv4Header.ECN_ECT0 if seg.ect else 0,
+                df = True,
+                src_ip = seg.src_ip,
+                dst_ip = seg.dst_ip
+            ),
+            seg.serialize()
+        )
+
+    def write_segment(self, seg: TcpSegment):
+        """
+        Send a segment whose ports and src_ip/dst_ip are already filled in
+        """
+        os.write(self.tun, self.datagram(seg).serialize())
+
+    def read(self) -> Optional[TcpSegment]:
+        assert self.config
+        seg = self.read_segment()
+        if not seg:
+            return None
+        if not self.listening and seg.dst_ip != self.config.saddr:
+            return None
+        if not self.listening and seg.src_ip != self.config.daddr:
+            return None
         if self.listening:
             if seg.header.syn and not seg.header.rst:
-                self.config.saddr = ip_dgram.header.dst_ip
+                self.config.saddr = seg.dst_ip
                 self.config.sport = seg.header.dport
-                self.config.daddr = ip_dgram.header.src_ip
+                self.config.daddr = seg.src_ip
                 self.config.dport = seg.header.sport
                 self.listening = False
             else:
@@ -94,14 +143,7 @@ class TcpOverIpv4OverTunAdapter(FdAdapter):
         seg.header.dport = self.config.dport
         seg.src_ip = self.config.saddr
         seg.dst_ip = self.config.daddr
-        ip_dgram = IPv4Datagram(
-            IPv4Header(
-                src_ip = self.config.saddr,
-                dst_ip = self.config.daddr
-            ),
-            seg.serialize()
-        )
-        os.write(self.tun, ip_dgram.serialize())
+        self.write_segment(seg)
 
     def fileno(self) -> int:
         return self.tun
@@ -27,6 +27,10 @@ class IPv4Header:
     HEADER_LENGTH = 20
     DEFAULT_TTL = 128
     PROTO_TCP = 6
+    # ECN codepoints in the two low bits of the TOS byte (RFC 3168)
+    ECN_MASK = 0x03
+    ECN_ECT0 = 0x02
+    ECN_CE = 0x03
     identification_counter = 0
 
     def __init__(
@@ -0,0 +1,89 @@
+import hashlib
+import os
+from typing import Callable, Optional, Tuple
+
+from config import TcpConfig
+
+
+class EphemeralPortAllocator:
+    """
+    Local ports for outgoing connections, RFC 6056 algorithm 3: the
+    search for a free port starts at a keyed hash of the destination plus
+    a counter, so consecutive connections to one destination get
+    different ports that an off-path attacker cannot predict, while
+    different destinations use the range independently.
+
+    Ports handed out are marked in a bitmap over the range until
+    released. Free ports are found a machine word at a time, so
+    allocation stays cheap with most of the range taken.
+    """
+    def __init__(self, port_range: Tuple[int, int] = TcpConfig.ephemeral_port_range,
+                 secret: Optional[bytes] = None):
+        low, high = port_range
+        if not 0 < low <= high <= 65535:
+            raise ValueError(f'invalid port range {port_range}')
+        self._low = low
+        self._size = high - low + 1
+        self._full = (1 << self._size) - 1
+        # bit i set: port low + i is allocated
+        self._bitmap = 0
+        self._allocated = 0
+        self._next = 0
+        self._secret = secret if secret is not None else os.urandom(16)
+
+    def __len__(self) -> int:
+        return self._allocated
+
+    def __contains__(self, port: int) -> bool:
+        i = port - self._low
+        return 0 <= i < self._size and bool(self._bitmap >> i & 1)
+
+    def _offset(self, local_ip: str, remote_ip: str, remote_port: int) -> int:
+        data = f'{local_ip}/{remote_ip}/{remote_port}'.encode()
+        digest = hashlib.blake2s(data, key=self._secret, digest_size=4).digest()
+        return int.from_bytes(digest, 'big')
+
+    def _next_free(self, start: int) -> Optional[int]:
+        """
+        Index of the first free port at or after start, wrapping around
+        """
+        free = ~self._bitmap & self._full
+        above = free >> start
+        if above:
+            return start + (above & -above).bit_length() - 1
+        if free:
+            return (free & -free).bit_length() - 1
+        return None
+
+    def allocate(self, local_ip: str, remote_ip: str, remote_port: int,
+                 in_use: Callable[[int], bool] = lambda port: False) -> int:
+        """
+        A free port for a connection to remote_ip:remote_port; in_use
+        rejects ports the 4-tuple is still taken for elsewhere, as by a
+        live connection or one in TIME_WAIT
+        """
+        start = (self._offset(local_ip, remote_ip, remote_port) + self._next) % self._size
+        i = start
+        tried = 0
+        while tried < self._size:
+            free = self._next_free(i)
+            if free is None:
+                break
+            # free ports skipped over wrapping past start were all tried
+            tried += (free - i) % self._size + 1
+            if tried > self._size:
+                break
+            port = self._low + free
+            if not in_use(port):
+                self._bitmap |= 1 << free
+                self._allocated += 1
+                self._next += tried
+                return port
+            i = (free + 1) % self._size
+        raise RuntimeError(f'no ephemeral port free for {remote_ip}:{remote_port}')
+
+    def release(self, port: int):
+        if port not in self:
+            return
+        self._bitmap &= ~(1 << (port - self._low))
+        self._allocated -= 1
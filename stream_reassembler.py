@@ -1,5 +1,5 @@
 from collections import deque
-from typing import Deque, Tuple
+from typing import Deque, List, Tuple
 
 from byte_stream import ByteStream
 
@@ -13,6 +13,8 @@ class StreamReassembler:
         self._unassembled_base = 0
         self._buffer: Deque[Tuple[int, bytes]] = deque()
         self._eof = False
+        # stream index right after the last byte
+        self._eof_index = 0
         self._stream_out = ByteStream(capacity)
 
     """
@@ -28,6 +30,7 @@ class StreamReassembler:
     def data_received(self, index: int, data: bytes, eof: bool):
         if eof:
             self._eof = True
+            self._eof_index = index + len(data)
         # data 开始和结束
         first = index
         last = first + len(data)
@@ -35,6 +38,9 @@ class StreamReassembler:
         window_begin = self._unassembled_base - self._stream_out.size
         window_end = window_begin + self._capacity
         if last <= self._unassembled_base or first >= window_end:
+            if self.finished:
+                # a FIN without data
+                self._stream_out.end_input()
             return
         # 需要放入 buffer 的数据开始和结束
         left = max(first, self._unassembled_base)
@@ -76,16 +82,38 @@ class StreamReassembler:
 
     @property
     def finished(self) -> bool:
-        return self._eof and self.unassembled_bytes == 0
+        return self._eof and self._unassembled_base >= self._eof_index
 
     @property
     def ack_index(self):
         return self._unassembled_base
 
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    @capacity.setter
+    def capacity(self, val: int):
+        # 不能收回已经放入 buffer 的数据所占的窗口, 缩小时最多缩到已有数据的末尾
+        window_begin = self._unassembled_base - self._stream_out.size
+        val = max(val, self._unassembled_base - window_begin)
+        if self._buffer:
+            last, data = self._buffer[-1]
+            val = max(val, last + len(data) - window_begin)
+        self._stream_out.capacity = val
+        self._capacity = val
+
     @property
     def stream_out(self) -> ByteStream:
         return self._stream_out
 
+    @property
+    def unassembled_ranges(self) -> List[Tuple[int, int]]:
+        """
+        [start, end) stream indices of the out-of-order data being held
+        """
+        return [(i, i + len(data)) for i, data in self._buffer]
+
     @property
     def unassembled_bytes(self) -> int:
         return sum(len(data) for _, data in self._buffer)
@@ -0,0 +1,379 @@
+import asyncio
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from config import TcpConfig, FdAdapterConfig
+from fd_adapter import TcpOverIpv4OverTunAdapter
+from tcp_connection import TcpConnection
+from tcp_listener import TcpListener
+from tcp_mux import TcpMultiplexer
+from tcp_socket import FullTCPSocket
+from tcp_state import TcpState
+
+# StreamReader buffer limit, as asyncio's
+STREAM_LIMIT = 64 * 1024
+# pause_writing() once this much written data waits for room in the send buffer
+WRITE_HIGH_WATER = 64 * 1024
+WRITE_LOW_WATER = 16 * 1024
+
+
+class TcpDriver:
+    """
+    Runs a TcpMultiplexer on an asyncio event loop instead of a thread
+    per connection: the TUN adapter is read from an add_reader() callback
+    and the multiplexer's timers from a call_later() handle armed for the
+    next one due. Connections are handed to protocols as TcpTransports,
+    so data moves between the connection's streams and the application
+    without a socketpair or a thread switch in between.
+    """
+    def __init__(self, adapter: TcpOverIpv4OverTunAdapter, cfg: Optional[TcpConfig] = None,
+                 loop: Optional[asyncio.AbstractEventLoop] = None):
+        self._loop = loop if loop is not None else asyncio.get_running_loop()
+        self._adapter = adapter
+        self.mux = TcpMultiplexer(adapter, cfg)
+        self.mux.on_update = self._on_update
+        self._transports: Dict[TcpConnection, TcpTransport] = {}
+        self._servers: List[TcpServer] = []
+        # connections fed, written to or ticked since the last _process()
+        self._updated: Dict[TcpConnection, None] = {}
+        self._time = self._now_ms()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._process_scheduled = False
+        self._loop.add_reader(self._adapter.fileno(), self._on_readable)
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return self._loop
+
+    def close(self):
+        self._loop.remove_reader(self._adapter.fileno())
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    async def create_connection(
+        self,
+        protocol_factory: Callable[[], asyncio.Protocol],
+        host: str,
+        port: int,
+        local_ip: str = FullTCPSocket.LOCAL_IP
+    ) -> Tuple['TcpTransport', asyncio.Protocol]:
+        """
+        Connect from an ephemeral port, return once the handshake is done
+        """
+        conn = self.mux.connect(FdAdapterConfig(saddr=local_ip, daddr=host, dport=port))
+        waiter = self._loop.create_future()
+        transport = TcpTransport(self, conn, protocol_factory(), waiter)
+        self._process()
+        await waiter
+        return transport, transport.get_protocol()
+
+    def create_server(
+        self,
+        protocol_factory: Callable[[], asyncio.Protocol],
+        host: str,
+        port: int,
+        backlog: int = 128
+    ) -> 'TcpServer':
+        server = TcpServer(self, self.mux.listen(host, port, backlog), protocol_factory)
+        self._servers.append(server)
+        return server
+
+    def schedule(self):
+        """
+        Run _process() soon, once for everything done until then
+        """
+        if not self._process_scheduled:
+            self._process_scheduled = True
+            self._loop.call_soon(self._process)
+
+    def _now_ms(self) -> int:
+        return int(self._loop.time() * 1000)
+
+    def _advance_clock(self):
+        now = self._now_ms()
+        if now > self._time:
+            self.mux.tick(now - self._time)
+            self._time = now
+
+    def _on_update(self, conn: TcpConnection):
+        self._updated[conn] = None
+
+    def _on_readable(self):
+        self._advance_clock()
+        self.mux.read_adapter()
+        self._process()
+
+    def _on_timer(self):
+        self._timer = None
+        self._advance_clock()
+        self._process()
+
+    def _process(self):
+        """
+        Hand accepted connections to their servers, let the transports of
+        updated connections move data, then send what was queued and
+        rearm the timer
+        """
+        self._process_scheduled = False
+        while True:
+            for server in self._servers:
+                server._accept()
+            if not self._updated:
+                break
+            updated = list(self._updated)
+            self._updated.clear()
+            for conn in updated:
+                transport = self._transports.get(conn)
+                if transport is not None:
+                    transport._update()
+        self.mux.flush()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        timeout = self.mux.next_timeout
+        if timeout is not None:
+            self._timer = self._loop.call_later(timeout / 1000, self._on_timer)
+
+
+class TcpTransport(asyncio.Transport):
+    """
+    asyncio transport over one multiplexed TcpConnection. Writes that do
+    not fit the send buffer wait in the transport, with pause_writing()
+    and resume_writing() around WRITE_HIGH_WATER and WRITE_LOW_WATER;
+    pause_reading() leaves data in the connection, closing its receive
+    window.
+    """
+    def __init__(self, driver: TcpDriver, conn: TcpConnection, protocol: asyncio.Protocol,
+                 waiter: Optional['asyncio.Future[None]'] = None):
+        super().__init__()
+        self._driver = driver
+        self._conn = conn
+        self._protocol = protocol
+        self._waiter = waiter
+        self._local_ip, self._local_port, self._remote_ip, self._remote_port = \
+            driver.mux.address(conn)
+        self._buffer = bytearray()
+        self._connected = False
+        self._reading = True
+        self._writing_paused = False
+        self._eof_received = False
+        # write_eof() called, and the FIN handed to the connection
+        self._eof = False
+        self._shut = False
+        self._closing = False
+        # connection_lost() called; what still arrives is discarded
+        self._lost = False
+        driver._transports[conn] = self
+        driver._updated[conn] = None
+
+    def get_extra_info(self, name: str, default: Any = None) -> Any:
+        if name == 'peername':
+            return (self._remote_ip, self._remote_port)
+        if name == 'sockname':
+            return (self._local_ip, self._local_port)
+        return default
+
+    def get_protocol(self) -> asyncio.BaseProtocol:
+        return self._protocol
+
+    def set_protocol(self, protocol: asyncio.BaseProtocol):
+        assert isinstance(protocol, asyncio.Protocol)
+        self._protocol = protocol
+
+    def is_closing(self) -> bool:
+        return self._closing or self._lost
+
+    def is_reading(self) -> bool:
+        return self._reading
+
+    def pause_reading(self):
+        self._reading = False
+
+    def resume_reading(self):
+        if self._reading:
+            return
+        self._reading = True
+        self._driver._updated[self._conn] = None
+        self._driver.schedule()
+
+    def get_write_buffer_size(self) -> int:
+        return len(self._buffer)
+
+    def get_write_buffer_limits(self) -> Tuple[int, int]:
+        return (WRITE_LOW_WATER, WRITE_HIGH_WATER)
+
+    def can_write_eof(self) -> bool:
+        return True
+
+    def write(self, data: bytes):
+        if self._eof:
+            raise RuntimeError('Cannot call write() after write_eof()')
+        if self._lost or not data:
+            return
+        self._buffer += data
+        self._send()
+        if not self._writing_paused and len(self._buffer) > WRITE_HIGH_WATER:
+            self._writing_paused = True
+            self._protocol.pause_writing()
+        self._driver.schedule()
+
+    def write_eof(self):
+        if self._eof:
+            return
+        self._eof = True
+        self._send()
+        self._driver.schedule()
+
+    def close(self):
+        if self.is_closing():
+            return
+        self._closing = True
+        self.write_eof()
+
+    def abort(self):
+        self._buffer.clear()
+        self._closing = True
+        if self._driver._transports.get(self._conn) is self and not self._finished:
+            self._driver.mux.abort(self._conn)
+            self._driver.schedule()
+        self._lose(None)
+
+    @property
+    def _finished(self) -> bool:
+        return not self._conn.active or self._conn.state == TcpState.TIME_WAIT
+
+    def _send(self):
+        """
+        Move buffered data into the connection's send buffer, then the FIN
+        """
+        if not self._connected or self._shut or self._finished:
+            return
+        room = self._conn.inbound_stream.remaining_capacity
+        if self._buffer and room:
+            n = self._driver.mux.write(self._conn, bytes(self._buffer[:room]))
+            del self._buffer[:n]
+        if self._eof and not self._buffer:
+            self._shut = True
+            self._driver.mux.shutdown_write(self._conn)
+            if self._closing:
+                self._lose(None)
+        if self._writing_paused and len(self._buffer) <= WRITE_LOW_WATER:
+            self._writing_paused = False
+            self._protocol.resume_writing()
+
+    def _update(self):
+        """
+        The connection was fed, written to or ticked
+        """
+        conn = self._conn
+        if not self._connected:
+            if conn.active and conn.state in (TcpState.SYN_SENT, TcpState.SYN_RECEIVED):
+                return
+            if not conn.active:
+                del self._driver._transports[conn]
+                if self._waiter is not None and not self._waiter.done():
+                    self._waiter.set_exception(ConnectionRefusedError(
+                        f'connection to {self._remote_ip}:{self._remote_port} failed'))
+                return
+            self._connected = True
+            self._protocol.connection_made(self)
+            if self._waiter is not None and not self._waiter.done():
+                self._waiter.set_result(None)
+        stream = conn.outbound_stream
+        if self._lost:
+            # nobody reads any more, keep the window open until the peer is done
+            if stream.size:
+                self._driver.mux.read(conn, stream.size)
+            if self._finished:
+                del self._driver._transports[conn]
+            return
+        self._send()
+        finished = self._finished
+        if stream.size and (self._reading or finished):
+            self._protocol.data_received(self._driver.mux.read(conn, stream.size))
+        if stream.eof and not self._eof_received and not stream.error:
+            self._eof_received = True
+            if not self._protocol.eof_received():
+                self.close()
+        if finished:
+            del self._driver._transports[conn]
+            reset = stream.error and not self._closing
+            self._lose(ConnectionResetError('connection reset by peer') if reset else None)
+
+    def _lose(self, exc: Optional[Exception]):
+        if self._lost:
+            return
+        self._lost = True
+        self._closing = True
+        self._driver.loop.call_soon(self._protocol.connection_lost, exc)
+
+
+class TcpServer:
+    """
+    Hands the connections a TcpListener accepts to protocols from
+    protocol_factory, as asyncio.Server does
+    """
+    def __init__(self, driver: TcpDriver, listener: TcpListener,
+                 protocol_factory: Callable[[], asyncio.Protocol]):
+        self._driver = driver
+        self._listener = listener
+        self._protocol_factory = protocol_factory
+        self._closed = driver.loop.create_future()
+
+    def is_serving(self) -> bool:
+        return not self._closed.done()
+
+    def close(self):
+        if not self.is_serving():
+            return
+        self._driver._servers.remove(self)
+        self._listener.close()
+        self._driver.schedule()
+        self._closed.set_result(None)
+
+    async def wait_closed(self):
+        await asyncio.shield(self._closed)
+
+    async def __aenter__(self) -> 'TcpServer':
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+        await self.wait_closed()
+
+    def _accept(self):
+        while True:
+            conn = self._listener.accept()
+            if conn is None:
+                return
+            TcpTransport(self._driver, conn, self._protocol_factory())
+
+
+async def open_connection(driver: TcpDriver, host: str, port: int,
+                          local_ip: str = FullTCPSocket.LOCAL_IP,
+                          limit: int = STREAM_LIMIT) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """
+    asyncio.open_connection() over the user-space stack
+    """
+    loop = driver.loop
+    reader = asyncio.StreamReader(limit=limit, loop=loop)
+    protocol = asyncio.StreamReaderProtocol(reader, loop=loop)
+    transport, _ = await driver.create_connection(lambda: protocol, host, port, local_ip)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer
+
+
+async def start_server(driver: TcpDriver,
+                       client_connected_cb: Callable[[asyncio.StreamReader, asyncio.StreamWriter], Any],
+                       host: str, port: int, backlog: int = 128,
+                       limit: int = STREAM_LIMIT) -> TcpServer:
+    """
+    asyncio.start_server() over the user-space stack
+    """
+    loop = driver.loop
+
+    def factory() -> asyncio.Protocol:
+        reader = asyncio.StreamReader(limit=limit, loop=loop)
+        return asyncio.StreamReaderProtocol(reader, client_connected_cb, loop=loop)
+
+    return driver.create_server(factory, host, port, backlog)
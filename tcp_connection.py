@@ -1,6 +1,7 @@
-from collections import deque
+from collections import Counter, deque
 from random import randint
-from typing import Deque, Optional
+from threading import Lock
+from typing import Deque, Iterable, List, Optional, Sequence, Tuple
 
 from logger import log
 from utils import wrap, unwrap, uint32_plus
@@ -8,10 +9,19 @@ from stream_reassembler import StreamReassembler
 from byte_stream import ByteStream
 from config import TcpConfig
 from tcp_state import TcpState
-from tcp_segment import TcpSegment, TcpHeader
+from tcp_segment import TcpSegment, TcpHeader, TcpOptions, TCPOLEN_TIMESTAMP_ALIGNED
 
 
 class TcpConnection:
+    # receive memory that autotuning added on top of the configured
+    # recv_capacity, summed over all connections
+    _rmem_allocated = 0
+    # the same for send buffers grown by autosizing
+    _wmem_allocated = 0
+    # connections run on their own TcpSocket threads, the totals are
+    # updated under this lock (a stale read is harmless)
+    _mem_lock = Lock()
+
     def __init__(self,
                  cfg: TcpConfig,
                  sender_isn: int = randint(0, (1 << 32) - 1)):
@@ -19,7 +29,8 @@ class TcpConnection:
         self._state = TcpState.CLOSED
         self._send_capacity = cfg.send_capacity
         self._recv_capacity = cfg.recv_capacity
-        self._max_payload_size = cfg.MAX_PAYLOAD_SIZE
+        self._mss = cfg.mss if cfg.mss is not None else cfg.MAX_PAYLOAD_SIZE
+        self._max_payload_size = self._mss
         self._max_retx_attempts = cfg.MAX_RETX_ATTEMPTS
         self._retx_timeout = cfg.TIMEOUT_DFLT
         self._active = True
@@ -28,31 +39,154 @@ class TcpConnection:
         # For sender
         self._sender_isn = sender_isn
         self._next_seqno_absolute = 0
-        # current window size, updated when ack_received() called. 
-        # the initial and minimum value is 1 so that the sender won't wait endlessly.
-        self._receiver_window_size = 1
+        # current window size, updated when ack_received() called.
+        # a zero window is probed by the persist timer
+        self._receiver_window_size = 0
         self._timer_enabled = False
         self._time_elapsed = 0
         self._segments_out: Deque[TcpSegment] = deque()
+        # unacknowledged data segments, ordered by seqno_absolute, and
+        # the sequence space they cover
         self._outgoing_segments: Deque[TcpSegment] = deque()
+        self._bytes_in_flight = 0
         self._consecutive_retransmissions = 0
         self._rto = cfg.rt_timeout
         self._stream_in = ByteStream(self._send_capacity)
+        # send buffer autosizing: bytes acked since the RTT round started at
+        # _snd_round_start, and how long the sender has had nothing to send
+        self._sndbuf_autosizing = cfg.sndbuf_autosizing
+        self._send_capacity_min = cfg.send_capacity
+        self._send_capacity_max = max(cfg.send_capacity_max, cfg.send_capacity)
+        self._send_memory_limit = cfg.send_memory_limit
+        self._snd_delivered = 0
+        self._snd_round_start = 0
+        self._snd_idle = 0
+        self._wmem_charged = 0
         self._linger_after_stream_finish = False
         self._fin_sent = False
+        # persist timer, runs instead of the RTO while the peer's window is zero
+        self._persist_enabled = False
+        self._persist_elapsed = 0
+        self._persist_timeout = cfg.rt_timeout
+        self._persist_timeout_max = cfg.PERSIST_TIMEOUT_MAX
+        # window scaling: shift applied to the windows we advertise / receive
+        self._window_scaling = cfg.window_scaling
+        self._rcv_wscale = self._window_scale_for(
+            cfg.recv_capacity_max if cfg.rcvbuf_autotuning else self._recv_capacity,
+            cfg.MAX_WINDOW_SCALE)
+        self._snd_wscale = 0
+        # path MTU probing: search (low, high] for the largest payload that gets through
+        self._mtu_probing = cfg.mtu_probing
+        self._mtu_probe_base = cfg.MTU_PROBE_BASE_MSS
+        self._mtu_probe_threshold = cfg.MTU_PROBE_THRESHOLD
+        self._mtu_probe_low = self._mss
+        self._mtu_probe_high = self._mss
+        self._mtu_probe: Optional[TcpSegment] = None
+        # timestamps: TSval clock advanced by tick(), RTT estimator fed by TSecr
+        self._timestamps = cfg.timestamps
+        self._ts_ok = False
+        self._ts_recent = 0
+        self._ts_offset = randint(0, (1 << 32) - 1)
+        self._clock_ms = 0
+        self._srtt: Optional[float] = None
+        self._rttvar = 0.0
+        self._min_rto = cfg.MIN_RTO
+        self._max_rto = cfg.MAX_RTO
+        # SACK scoreboard and RACK-TLP: send time and end seqno of the most
+        # recently sent segment known to be delivered, reordering and probe timers
+        self._sack = cfg.sack
+        self._sack_ok = False
+        self._rack = cfg.rack
+        self._rack_xmit_time = -1
+        self._rack_end_seq = 0
+        self._rack_rtt = 0
+        self._min_rtt: Optional[int] = None
+        self._rack_timer: Optional[int] = None
+        self._tlp_timer: Optional[int] = None
+        self._tlp_outstanding = False
+        self._max_ack_delay = cfg.DELACK_TIMEOUT
+        self._reo_wnd_mult = 1
+        # congestion control: cwnd and ssthresh in bytes; during recovery PRR
+        # counts bytes delivered and sent since it started with _recover_fs in flight
+        self._congestion_control = cfg.congestion_control
+        self._initial_window = cfg.INITIAL_WINDOW
+        self._dupack_threshold = cfg.DUPACK_THRESHOLD
+        self._cwnd = 0
+        self._ssthresh = 1 << 62
+        self._dupacks = 0
+        # bytes of outstanding segments SACKed by the peer, and marked lost
+        # but not retransmitted yet, so the pipe needs no walk of the queue
+        self._sacked_out = 0
+        self._lost_out = 0
+        self._in_recovery = False
+        self._recovery_point = 0
+        self._recover_fs = 0
+        self._prr_delivered = 0
+        self._prr_out = 0
+        # ECN: echo ECE until the peer's CWR, reduce at most once per window
+        # of data (ACKs up to _ecn_cwr_point) and send CWR after reducing
+        self._ecn = cfg.ecn
+        self._ecn_ok = False
+        self._ece_pending = False
+        self._cwr_pending = False
+        self._ecn_cwr_point = 0
+        # spurious retransmission undo (Eifel, D-SACK): sender state saved at
+        # the first RTO of an episode, the TSval of that retransmission and
+        # how many retransmissions have not been reported as duplicates yet
+        self._undo_state: Optional[Tuple[int, int, int, int]] = None
+        self._undo_ts_val: Optional[int] = None
+        self._undo_retrans = 0
+        self._spurious_retransmissions = 0
+        self._header_prediction = cfg.header_prediction
+        self._retx_coalesce = cfg.retx_coalesce
+        self._nagle = cfg.nagle
+        self._autocork = cfg.autocork
+        self._corked = False
         # For receiver
         self._receiver_isn: Optional[int] = None
+        # options of the peer's SYN, to answer it again if our SYN-ACK is lost
+        self._peer_syn_options: Optional[TcpOptions] = None
         self._reassembler = StreamReassembler(self._recv_capacity)
         self._fin_received = False
+        # right edge of the last advertised window, as a stream index
+        self._rcv_adv_right = 0
+        # stream index of the latest out-of-order segment, its SACK block goes first
+        self._sack_recent = 0
+        # duplicate data to report in the next ACK (D-SACK)
+        self._dsack: Optional[Tuple[int, int]] = None
+        # receive buffer autotuning: bytes_read and clock at the start of the
+        # current measurement, and the memory charged to _rmem_allocated
+        self._rcvbuf_autotuning = cfg.rcvbuf_autotuning
+        self._recv_capacity_min = cfg.recv_capacity
+        self._recv_capacity_max = max(cfg.recv_capacity_max, cfg.recv_capacity)
+        self._recv_memory_limit = cfg.recv_memory_limit
+        self._rcvq_seq = 0
+        self._rcvq_time = 0
+        self._rmem_charged = 0
+        # delayed ACK: an ACK is owed to the peer but not sent yet
+        self._delayed_ack = cfg.delayed_ack
+        self._delack_timeout = cfg.DELACK_TIMEOUT
+        self._quickack = cfg.QUICKACK_SEGMENTS
+        self._ack_pending = False
+        self._ack_now = False
+        self._full_segs_unacked = 0
+        self._delack_elapsed = 0
+        self._batching = False
+        # (from_state, to_state) transition counts
+        self._transitions: Counter = Counter()
 
     def connect(self):
         if self._state != TcpState.CLOSED:
             raise RuntimeError(
                 'tcp state is not closed when calling connect()')
+        # an ECN-setup SYN carries both ECE and CWR
         self._send_segment(TcpSegment(TcpHeader(
-            syn=True
+            syn=True,
+            ece=self._ecn,
+            cwr=self._ecn,
+            options=self._syn_options()
         )))
-        self._state = TcpState.SYN_SENT
+        self._set_state(TcpState.SYN_SENT)
 
     def write(self, data: bytes) -> int:
         if len(data) == 0:
@@ -61,41 +195,113 @@ class TcpConnection:
         self._fill_window()
         return write_size
     
+    def set_nodelay(self, nodelay: bool):
+        self._nagle = not nodelay
+        if nodelay:
+            self._fill_window()
+
+    def cork(self):
+        self._corked = True
+
+    def uncork(self):
+        self._corked = False
+        self._fill_window()
+
     def read(self,n: int) -> bytes:
-        return self._reassembler.stream_out.read(n)
+        data = self._reassembler.stream_out.read(n)
+        self.send_window_update()
+        return data
+
+    def send_window_update(self):
+        """
+        Called after the application drains outbound_stream: retune the
+        receive buffer and tell the peer once the window has opened by a
+        worthwhile amount
+        """
+        self._rcv_space_adjust()
+        if not self.syn_received or self._fin_received:
+            return
+        if self._state not in (TcpState.ESTABLISHED, TcpState.FIN_WAIT_1, TcpState.FIN_WAIT_2):
+            return
+        right = self._reassembler.ack_index + self.window_size
+        if right - self._rcv_adv_right >= self._window_update_threshold:
+            self._send_ack()
     
     def set_listening(self):
         if self._state != TcpState.CLOSED:
             raise RuntimeError(
                 'tcp state is not closed when calling set_listening()')
-        self._state = TcpState.LISTEN
+        self._set_state(TcpState.LISTEN)
+
+    def segments_received(self, segs: Iterable[TcpSegment]):
+        """
+        Process a batch of segments and answer them with one cumulative ACK
+        """
+        self._batching = True
+        try:
+            for seg in segs:
+                self.segment_received(seg)
+        finally:
+            self._batching = False
+        if self._ack_now:
+            self._send_ack()
 
     def segment_received(self, seg: TcpSegment):
         self._last_recv_et = 0
         rst = seg.header.rst
         if rst:
-            self._state = TcpState.CLOSED
+            self._set_state(TcpState.CLOSED)
             self._active = False
+            self._release_buffer_memory()
             self._stream_in.error = True
             self._reassembler._stream_out.error = True
             return
-        try:
-            callback = {
-                TcpState.CLOSED: self._fsm_closed,
-                TcpState.LISTEN: self._fsm_listen,
-                TcpState.SYN_SENT: self._fsm_syn_sent,
-                TcpState.SYN_RECEIVED: self._fsm_syn_received,
-                TcpState.ESTABLISHED: self._fsm_eastablished,
-                TcpState.CLOSE_WAIT: self._fsm_closed_wait,
-                TcpState.LAST_ACK: self._fsm_last_ack,
-                TcpState.FIN_WAIT_1: self._fsm_fin_wait_1,
-                TcpState.FIN_WAIT_2: self._fsm_fin_wait_2,
-                TcpState.CLOSING: self._fsm_closing,
-                TcpState.TIME_WAIT: self._fsm_time_wait
-            }[self._state]
-            callback(seg)
-        except KeyError as _:
+        if (self._state == TcpState.ESTABLISHED and self._header_prediction and
+                self._fast_path(seg)):
+            return
+        handler = self._FSM.get(self._state)
+        if handler is None:
             raise RuntimeError(f'Unknown tcp state: {self._state}')
+        handler(self, seg)
+
+    def _fast_path(self, seg: TcpSegment) -> bool:
+        """
+        Header prediction (Van Jacobson): a segment with only ACK set, the
+        expected seqno, an unchanged window and a fresh timestamp is either
+        a pure ACK for new data or in-order data acking nothing new.
+        Returns False to fall back to the FSM
+        """
+        header = seg.header
+        # ESTABLISHED: SYN received, FIN not yet
+        if (header.syn or header.fin or header.urg or not header.ack or
+                header.ece or header.cwr or seg.ce or header.options.sack_blocks or
+                header.seqno != self._wrap_receiver(1 + self._reassembler.ack_index) or
+                header.win << self._snd_wscale != self._receiver_window_size):
+            return False
+        ts_ecr = None
+        if self._ts_ok:
+            ts_val = header.options.ts_val
+            if ts_val is None or ((ts_val - self._ts_recent) & 0xffffffff) >= (1 << 31):
+                return False
+            ts_ecr = header.options.ts_ecr
+        snd_una = (self._outgoing_segments[0].header.seqno
+                   if self._outgoing_segments else self.next_seqno)
+        payload = seg.payload
+        if payload:
+            if (header.ackno != snd_una or self.unassembled_bytes or
+                    len(payload) > self.window_size):
+                return False
+            if self._ts_ok:
+                self._ts_recent = ts_val
+            self._reassembler.data_received(self._reassembler.ack_index, payload, False)
+            self._schedule_ack(full_sized=len(payload) >= self._max_payload_size)
+            return True
+        if header.ackno == snd_una or self._persist_enabled:
+            return False
+        if self._ts_ok:
+            self._ts_recent = ts_val
+        self._ack_received(header.ackno, header.win, ts_ecr)
+        return True
 
     def _fsm_closed(self, seg: TcpSegment):
         pass
@@ -104,12 +310,16 @@ class TcpConnection:
         if not seg.header.syn:
             return
         self._receiver_isn = seg.header.seqno
+        self._peer_syn_options = seg.header.options
+        self._negotiate_options(seg)
         self._send_segment(TcpSegment(TcpHeader(
             syn=True,
             ack=True,
-            ackno=uint32_plus(seg.header.seqno)
+            ackno=uint32_plus(seg.header.seqno),
+            ece=self._ecn_ok,
+            options=self._syn_options(seg.header.options)
         )))
-        self._state = TcpState.SYN_RECEIVED
+        self._set_state(TcpState.SYN_RECEIVED)
 
     def _fsm_syn_sent(self, seg: TcpSegment):
         expected_ackno = uint32_plus(self._sender_isn)
@@ -127,12 +337,15 @@ class TcpConnection:
         log('FSM','receive segment with '+','.join(seg_attrs))
         
         self._receiver_isn = seg.header.seqno
+        self._negotiate_options(seg)
+        # the window in a SYN segment is never scaled
         self._receiver_window_size = seg.header.win
         self._send_segment(TcpSegment(TcpHeader(
             ack=True,
             ackno=uint32_plus(seg.header.seqno, 1)
         )))
-        self._state = TcpState.ESTABLISHED
+        self._set_state(TcpState.ESTABLISHED)
+        self._stop_retransmission_timer()
 
     def _fsm_syn_received(self, seg: TcpSegment):
         assert self._receiver_isn is not None
@@ -142,71 +355,58 @@ class TcpConnection:
             seg.header.ackno == uint32_plus(self._sender_isn)
         ):
             return
-        self._receiver_window_size = seg.header.win
-        self._state = TcpState.ESTABLISHED
+        self._receiver_window_size = seg.header.win << self._snd_wscale
+        self._set_state(TcpState.ESTABLISHED)
+        self._stop_retransmission_timer()
 
     def _fsm_eastablished(self, seg: TcpSegment):
+        """
+        ESTABLISHED and CLOSE_WAIT: take in data and FIN, then process the ACK
+        """
         # receiver operation
-        seqno = seg.header.seqno
-        seqno_absolute = self._unwrap_receiver(seqno)
+        if self._paws_reject(seg):
+            self._schedule_ack(immediate=True)
+            return
+        if self._ecn_ok:
+            # the peer reduced its window, stop echoing unless CE is set again
+            if seg.header.cwr:
+                self._ece_pending = False
+            if seg.ce:
+                self._ece_pending = True
+        seqno_absolute = self._unwrap_receiver(seg.header.seqno)
         stream_index = seqno_absolute - int(self.syn_received)
         eof = seg.header.fin
-        if eof and  len(seg.payload) == 0:
-            self._state = TcpState.CLOSE_WAIT
-            self._fin_received = True
-            log('FSM', f'receive FIN at {stream_index}')
-            self._send_segment(TcpSegment(TcpHeader(
-                ack=True,
-                ackno=self.ackno
-            )))
         if len(seg.payload) > 0:
             log('FSM', f'receive data at {stream_index} with payload length {len(seg.payload)}')
+            # out-of-order data, or data filling a hole, is acknowledged at once
+            ack_index = self._reassembler.ack_index
+            in_order = stream_index == ack_index and self.unassembled_bytes == 0
+            if stream_index > ack_index:
+                self._sack_recent = stream_index
+            elif stream_index < ack_index:
+                self._dsack = (stream_index, min(stream_index + len(seg.payload), ack_index))
             self._reassembler.data_received(stream_index, seg.payload, eof)
-            assert self.ackno
-            self._send_segment(TcpSegment(TcpHeader(
-                ack=True,
-                ackno=self.ackno
-            )))
-            if eof:
-                self._state = TcpState.CLOSE_WAIT
-                self._fin_received = True
-                ('FSM', f'receive FIN at {stream_index}')
-        # sender operation
-        if seg.header.ack:
-            self._receiver_window_size = seg.header.win
-            self._ack_received(seg.header.ackno)
-
-    def _fsm_closed_wait(self, seg: TcpSegment):
-        # receiver operation
-        seqno = seg.header.seqno
-        seqno_absolute = self._unwrap_receiver(seqno)
-        stream_index = seqno_absolute - int(self.syn_received)
-        eof = seg.header.fin
-        if eof and  len(seg.payload) == 0:
-            self._state = TcpState.CLOSE_WAIT
+            # so are segments that did not advance ackno, such as window probes,
+            # and CE marks, which the peer should hear about within an RTT
+            self._schedule_ack(
+                immediate=(eof or seg.ce or not in_order or self.unassembled_bytes > 0 or
+                           self._reassembler.ack_index == ack_index),
+                full_sized=len(seg.payload) >= self._max_payload_size)
+        if eof:
+            log('FSM', f'receive FIN at {stream_index + len(seg.payload)}')
+            if len(seg.payload) == 0:
+                self._reassembler.data_received(stream_index, b'', True)
             self._fin_received = True
-            log('FSM', f'receive FIN at {stream_index}')
-            self._send_segment(TcpSegment(TcpHeader(
-                ack=True,
-                ackno=self.ackno
-            )))
-        if len(seg.payload) > 0:
-            log('FSM', f'receive data at {stream_index} with payload length {len(seg.payload)}')
-            self._reassembler.data_received(stream_index, seg.payload, eof)
-            assert self.ackno
-            self._send_segment(TcpSegment(TcpHeader(
-                ack=True,
-                ackno=self.ackno
-            )))
-            if eof:
-                self._state = TcpState.CLOSE_WAIT
-                self._fin_received = True
-                ('FSM', f'receive FIN at {stream_index}')
+            self._set_state(TcpState.CLOSE_WAIT)
+            if len(seg.payload) == 0:
+                self._schedule_ack(immediate=True)
         # sender operation
         if seg.header.ack:
-            self._receiver_window_size = seg.header.win
-            self._ack_received(seg.header.ackno)
-
+            self._ack_received(seg.header.ackno, seg.header.win,
+                               seg.header.options.ts_ecr if self._ts_ok else None,
+                               seg.header.options.sack_blocks if self._sack_ok else (),
+                               self._ecn_ok and seg.header.ece,
+                               seg.length_in_sequence_space)
 
     def _fsm_last_ack(self, seg: TcpSegment):
         expected_ackno = self._wrap_sender(self._next_seqno_absolute)
@@ -215,31 +415,67 @@ class TcpConnection:
             seg.header.ackno == expected_ackno
         ):
             return
-        self._state = TcpState.CLOSED
+        self._set_state(TcpState.CLOSED)
+        self._stop_retransmission_timer()
+
+    def _receive_after_fin(self, seg: TcpSegment) -> bool:
+        """
+        FIN_WAIT_1 and FIN_WAIT_2: until the peer sends its own FIN it may
+        still send data and acknowledge ours. Returns False for segments
+        to drop
+        """
+        if self._paws_reject(seg):
+            self._schedule_ack(immediate=True)
+            return False
+        if seg.header.ack:
+            self._ack_received(seg.header.ackno, seg.header.win,
+                               seg.header.options.ts_ecr if self._ts_ok else None,
+                               seg.header.options.sack_blocks if self._sack_ok else (),
+                               seq_len=seg.length_in_sequence_space)
+        if seg.payload:
+            stream_index = self._unwrap_receiver(seg.header.seqno) - 1
+            log('FSM', f'receive data at {stream_index} with payload length {len(seg.payload)}')
+            self._reassembler.data_received(stream_index, seg.payload, False)
+        if (seg.payload or seg.header.fin) and not self._fin_in_order(seg):
+            # a FIN is acknowledged once accepted, one past a hole is dropped
+            # and the peer sends it again
+            self._schedule_ack(immediate=True)
+        return True
+
+    def _fin_in_order(self, seg: TcpSegment) -> bool:
+        """
+        Whether seg carries a FIN right after all the data received so far
+        """
+        return seg.header.fin and uint32_plus(seg.header.seqno, len(seg.payload)) == self.ackno
+
+    def _fin_accepted(self, seg: TcpSegment):
+        self._fin_received = True
+        fin_index = self._unwrap_receiver(seg.header.seqno) - 1 + len(seg.payload)
+        self._reassembler.data_received(fin_index, b'', True)
 
     def _fsm_fin_wait_1(self, seg: TcpSegment):
         seg_attrs=[]
-        if seg.header.fin and seg.header.ack:
-            expected_ackno = self._wrap_sender(self._next_seqno_absolute)
-            if not (
-                seg.header.ack and
-                seg.header.ackno == expected_ackno
-            ):
-                return
+        if not self._receive_after_fin(seg):
+            return
+        expected_ackno = self._wrap_sender(self._next_seqno_absolute)
+        fin = self._fin_in_order(seg)
+        if fin and seg.header.ack and seg.header.ackno == expected_ackno:
             seg_attrs.append('fin=1')
             seg_attrs.append('ack=1')
             seg_attrs.append(f'ackno={seg.header.ackno}')
             seg_attrs.append(f'seqno={seg.header.seqno}')
             log('FSM','receive segment with '+','.join(seg_attrs))
-            self._fin_received = True
+            self._fin_accepted(seg)
             self._send_segment(TcpSegment(TcpHeader(
                 ack=True,
                 ackno=self.ackno
             )))
-            self._state = TcpState.TIME_WAIT
-        elif seg.header.fin:
-            self._state = TcpState.CLOSING
-            self._fin_received = True
+            self._set_state(TcpState.TIME_WAIT)
+            self._stop_retransmission_timer()
+        elif fin:
+            # simultaneous close, the peer's FIN does not acknowledge ours yet
+            self._set_state(TcpState.CLOSING)
+            self._fin_accepted(seg)
             self._send_segment(TcpSegment(TcpHeader(
                 ack=True,
                 ackno=self.ackno
@@ -247,7 +483,6 @@ class TcpConnection:
             log('FSM','receive segment with fin=1')
             return
         else:
-            expected_ackno = self._wrap_sender(self._next_seqno_absolute)
             if not (
                 seg.header.ack and
                 seg.header.ackno == expected_ackno
@@ -256,20 +491,20 @@ class TcpConnection:
             seg_attrs.append('ack=1')
             seg_attrs.append(f'ackno={seg.header.seqno}')
             log('FSM','receive segment with '+','.join(seg_attrs))
-            self._state = TcpState.FIN_WAIT_2
+            self._set_state(TcpState.FIN_WAIT_2)
+            self._stop_retransmission_timer()
 
     def _fsm_fin_wait_2(self, seg: TcpSegment):
-        if (
-            seg.header.fin and
-            seg.header.seqno == self.ackno
-        ):
+        if not self._receive_after_fin(seg):
+            return
+        if self._fin_in_order(seg):
             assert self.ackno
-            self._fin_received = True
+            self._fin_accepted(seg)
             self._send_segment(TcpSegment(TcpHeader(
                 ack=True,
                 ackno=self.ackno
             )))
-            self._state = TcpState.TIME_WAIT
+            self._set_state(TcpState.TIME_WAIT)
             self._linger_after_stream_finish = True
             seg_attrs=[]
             seg_attrs.append('fin=1')
@@ -283,8 +518,9 @@ class TcpConnection:
             seg.header.ackno == expected_ackno
         ):
             return
-        self._state = TcpState.TIME_WAIT
+        self._set_state(TcpState.TIME_WAIT)
         self._linger_after_stream_finish = True
+        self._stop_retransmission_timer()
         seg_attrs=[]
         seg_attrs.append('ack=1')
         seg_attrs.append(f'ackno={seg.header.ackno}')
@@ -297,6 +533,22 @@ class TcpConnection:
                 ackno=uint32_plus(seg.header.seqno, 1)
             )))
 
+    # state dispatch table, shared by all connections; bound methods kept
+    # per instance would make every connection a reference cycle
+    _FSM = {
+        TcpState.CLOSED: _fsm_closed,
+        TcpState.LISTEN: _fsm_listen,
+        TcpState.SYN_SENT: _fsm_syn_sent,
+        TcpState.SYN_RECEIVED: _fsm_syn_received,
+        TcpState.ESTABLISHED: _fsm_eastablished,
+        TcpState.CLOSE_WAIT: _fsm_eastablished,
+        TcpState.LAST_ACK: _fsm_last_ack,
+        TcpState.FIN_WAIT_1: _fsm_fin_wait_1,
+        TcpState.FIN_WAIT_2: _fsm_fin_wait_2,
+        TcpState.CLOSING: _fsm_closing,
+        TcpState.TIME_WAIT: _fsm_time_wait
+    }
+
     def _wrap_sender(self, n: int) -> int:
         return wrap(n, self._sender_isn)
 
@@ -312,35 +564,195 @@ class TcpConnection:
         assert self._receiver_isn is not None
         return unwrap(n, self._receiver_isn, checkpoint)
 
-    def _ack_received(self, ackno: int):
+    def _paws_reject(self, seg: TcpSegment) -> bool:
         """
-        Remove acked segments from outgoing
-        Reset timer
+        PAWS (RFC 7323): drop segments whose TSval is older than TS.Recent,
+        the sequence number alone cannot tell after 2^32 bytes
+        """
+        if not self._ts_ok:
+            return False
+        ts_val = seg.header.options.ts_val
+        if ts_val is None:
+            return False
+        if ((ts_val - self._ts_recent) & 0xffffffff) >= (1 << 31):
+            log('FSM', f'PAWS drop segment with TSval {ts_val} < {self._ts_recent}')
+            return True
+        # only a segment covering the left window edge may update TS.Recent
+        if self._unwrap_receiver(seg.header.seqno) <= self._reassembler.ack_index + 1:
+            self._ts_recent = ts_val
+        return False
+
+    @property
+    def _ts_now(self) -> int:
+        return (self._clock_ms + self._ts_offset) & 0xffffffff
+
+    def _ts_to_clock(self, ts: int) -> int:
+        return (ts - self._ts_offset) & 0xffffffff
+
+    def _rtt_sample(self, rtt: int):
+        """
+        RFC 6298 smoothed RTT and RTO
+        """
+        if rtt < 0 or rtt >= (1 << 31):
+            return
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2
+        else:
+            self._rttvar = 0.75 * self._rttvar + 0.25 * abs(self._srtt - rtt)
+            self._srtt = 0.875 * self._srtt + 0.125 * rtt
+        rto = int(self._srtt + max(1, 4 * self._rttvar))
+        self._retx_timeout = min(max(rto, self._min_rto), self._max_rto)
+        self._rto = self._retx_timeout
+
+    @staticmethod
+    def _window_scale_for(capacity: int, max_scale: int) -> int:
+        wscale = 0
+        while (capacity >> wscale) > 0xffff and wscale < max_scale:
+            wscale += 1
+        return wscale
+
+    def _syn_options(self, peer: Optional[TcpOptions] = None) -> TcpOptions:
+        """
+        Options for our SYN, or for a SYN-ACK answering the peer's options
         """
-        def ack_valid(ackno_absolute: int) -> bool:
-            if not self._outgoing_segments:
-                return ackno_absolute <= self._next_seqno_absolute
-            first_seqno_absolute = self._unwrap_sender(
-                self._outgoing_segments[0].header.seqno)
-            return first_seqno_absolute <= ackno_absolute <= self._next_seqno_absolute
+        opts = TcpOptions()
+        if peer is None or peer.mss is not None:
+            opts.mss = self._mss
+        if self._window_scaling and (peer is None or peer.wscale is not None):
+            opts.wscale = self._rcv_wscale
+        if self._timestamps and (peer is None or peer.ts_val is not None):
+            opts.ts_val = self._ts_now
+            opts.ts_ecr = peer.ts_val if peer is not None else 0
+        if self._sack and (peer is None or peer.sack_permitted):
+            opts.sack_permitted = True
+        return opts
 
+    def _negotiate_options(self, syn: TcpSegment):
+        opts = syn.header.options
+        self._sack_ok = self._sack and opts.sack_permitted
+        # ECN-setup SYN has ECE and CWR, ECN-setup SYN-ACK has only ECE
+        self._ecn_ok = (self._ecn and syn.header.ece and
+                        syn.header.cwr != syn.header.ack)
+        self._ts_ok = self._timestamps and opts.ts_val is not None
+        if self._ts_ok:
+            self._ts_recent = opts.ts_val
+            if syn.header.ack:
+                self._rtt_sample(self._clock_ms - self._ts_to_clock(opts.ts_ecr))
+        # window scaling is in effect only when both SYNs carry the option
+        if self._window_scaling and opts.wscale is not None:
+            self._snd_wscale = min(opts.wscale, TcpConfig.MAX_WINDOW_SCALE)
+        else:
+            self._rcv_wscale = 0
+            self._snd_wscale = 0
+        # a peer without the MSS option is assumed to accept ours
+        mss = self._mss if opts.mss is None else min(self._mss, opts.mss)
+        if self._ts_ok:
+            # the advertised MSS does not account for options we add to every segment
+            mss -= TCPOLEN_TIMESTAMP_ALIGNED
+        self._max_payload_size = mss
+        if self._mtu_probing:
+            self._max_payload_size = min(mss, self._mtu_probe_base)
+            self._mtu_probe_low = self._max_payload_size
+            self._mtu_probe_high = mss
+        self._cwnd = self._initial_window * self._max_payload_size
+
+    def _ack_received(self, ackno: int, win: int, ts_ecr: Optional[int] = None,
+                      sack_blocks: Sequence[Tuple[int, int]] = (), ece: bool = False,
+                      seq_len: int = 0):
+        """
+        Update the peer's window (scaled)
+        Remove acked segments from outgoing, mark SACKed ones
+        Take an RTT sample from the echoed timestamp
+        Run RACK loss detection
+        Reduce cwnd on an ECN echo
+        Reset timer
+        """
+        window_unchanged = win << self._snd_wscale == self._receiver_window_size
+        self._receiver_window_size = win << self._snd_wscale
         ackno_absolute = self._unwrap_sender(ackno)
-        if not ack_valid(ackno_absolute):
+        first_unacked = self._snd_una
+        if ackno_absolute > self._next_seqno_absolute:
+            return
+        if self._outgoing_segments and ackno_absolute < first_unacked:
             return
+        delivered: List[TcpSegment] = []
+        retransmission_acked = False
         while self._outgoing_segments:
             seg = self._outgoing_segments[0]
-            expected_ackno_absolute = self._unwrap_sender(
-                seg.header.seqno + seg.length_in_sequence_space)
-            if ackno_absolute >= expected_ackno_absolute:
+            seg_len = seg.length_in_sequence_space
+            if ackno_absolute >= seg.seqno_absolute + seg_len:
                 self._outgoing_segments.popleft()
+                self._bytes_in_flight -= seg_len
+                self._clear_marks(seg)
+                if not seg.sacked:
+                    delivered.append(seg)
+                retransmission_acked |= seg.retransmitted
+                if seg is self._mtu_probe:
+                    self._mtu_probe_acked()
                 self._rto = self._retx_timeout
                 self._consecutive_retransmissions = 0
                 self._time_elapsed = 0
             else:
                 break
+        if ts_ecr is not None and ackno_absolute > first_unacked:
+            self._rtt_sample(self._clock_ms - self._ts_to_clock(ts_ecr))
+        if ackno_absolute > first_unacked:
+            self._snd_buf_adjust(ackno_absolute - first_unacked)
+        if self._undo_state is not None and self._spurious_retransmission(
+                ackno_absolute, ts_ecr if retransmission_acked else None, sack_blocks):
+            self._undo_recovery()
+        sacked = self._sack_received(sack_blocks) if sack_blocks else []
+        delivered += sacked
         if not self._outgoing_segments:
             self._timer_enabled = False
+        if self._rack:
+            if delivered:
+                self._tlp_outstanding = False
+                self._rack_update(delivered)
+            self._rack_detect_loss()
+        if self._congestion_control:
+            acked = ackno_absolute - first_unacked
+            delivered_bytes = acked + sum(seg.length_in_sequence_space for seg in sacked)
+            # a duplicate ACK carries no data, SYN or FIN (RFC 5681)
+            if acked == 0 and window_unchanged and seq_len == 0 and self._outgoing_segments:
+                self._dupacks += 1
+                if not self._sack_ok:
+                    # without SACK each duplicate ACK stands for one delivered segment
+                    delivered_bytes += self._max_payload_size
+            else:
+                self._dupacks = 0
+            self._congestion_ack(ackno_absolute, acked, delivered_bytes)
+        if ece and ackno_absolute > self._ecn_cwr_point:
+            self._ecn_echo_received()
+        self._send_lost()
         self._fill_window()
+        self._arm_tlp()
+
+    def _schedule_ack(self, immediate: bool = False, full_sized: bool = False):
+        """
+        Owe the peer an ACK; send it now or leave it to the delayed ACK timer
+        """
+        self._ack_pending = True
+        if not self._delayed_ack:
+            immediate = True
+        elif self._quickack > 0:
+            self._quickack -= 1
+            immediate = True
+        if full_sized:
+            self._full_segs_unacked += 1
+            if self._full_segs_unacked >= 2:
+                immediate = True
+        if immediate:
+            self._ack_now = True
+        if self._ack_now and not self._batching:
+            self._send_ack()
+
+    def _send_ack(self):
+        self._send_segment(TcpSegment(TcpHeader(
+            ack=True,
+            ackno=self.ackno
+        )))
 
     def _send_segment(
         self,
@@ -348,11 +760,39 @@ class TcpConnection:
     ):
         seg.header.seqno = self.next_seqno
         self._next_seqno_absolute += seg.length_in_sequence_space
-        seg.header.win = self.window_size
+        wscale = 0 if seg.header.syn else self._rcv_wscale
+        seg.header.win = min(self._advertised_window() >> wscale, 0xffff)
+        self._rcv_adv_right = self._reassembler.ack_index + (seg.header.win << wscale)
+        if self._ts_ok and not seg.header.syn:
+            seg.header.options.ts_val = self._ts_now
+            seg.header.options.ts_ecr = self._ts_recent
+        if seg.header.ack:
+            # every ACK we send is cumulative, so it settles any pending one
+            self._ack_pending = False
+            self._ack_now = False
+            self._full_segs_unacked = 0
+            self._delack_elapsed = 0
+        if self._sack_ok and seg.header.ack and (self.unassembled_bytes or self._dsack):
+            seg.header.options.sack_blocks = self._sack_blocks()
+            self._dsack = None
+        if self._ecn_ok and not seg.header.syn:
+            seg.header.ece = self._ece_pending
         self._segments_out.append(seg)
         if len(seg.payload) > 0:
+            seg.seqno_absolute = self._next_seqno_absolute - seg.length_in_sequence_space
+            self._bytes_in_flight += seg.length_in_sequence_space
+            if self._ecn_ok:
+                # only new data is ECN-capable, not ACKs or retransmissions
+                seg.ect = True
+                seg.header.cwr = self._cwr_pending
+                self._cwr_pending = False
+            seg.sent_time = self._clock_ms
             self._outgoing_segments.append(seg)
-        if not self._timer_enabled:
+            if self._in_recovery:
+                self._prr_out += seg.length_in_sequence_space
+            if self._tlp_timer is None:
+                self._arm_tlp()
+        if not self._timer_enabled and seg.length_in_sequence_space > 0:
             self._timer_enabled = True
             self._time_elapsed = 0
         seg_attrs = []
@@ -370,24 +810,146 @@ class TcpConnection:
             seg_attrs.append(f'payload_len={len(seg.payload)}')
         log('FSM', 'send segment with ' + ','.join(seg_attrs))
 
+    @property
+    def _window_update_threshold(self) -> int:
+        return max(min(self._max_payload_size, self._recv_capacity // 2),
+                   1 << self._rcv_wscale)
+
+    def _advertised_window(self) -> int:
+        """
+        Receiver SWS avoidance (Clark): only move the right edge of the
+        window forward by at least min(MSS, half the buffer), never back
+        """
+        ack_index = self._reassembler.ack_index
+        right = ack_index + self.window_size
+        if right - self._rcv_adv_right < self._window_update_threshold:
+            return max(self._rcv_adv_right - ack_index, 0)
+        return self.window_size
+
+    def _rcv_space_adjust(self):
+        """
+        Dynamic right-sizing: once per RTT, grow the buffer to twice what the
+        application read if that was more than half of it. Give the growth
+        back while autotuned buffers exceed the memory limit
+        """
+        if not self._rcvbuf_autotuning or self._rcv_memory_pressure():
+            return
+        rtt = self._srtt if self._srtt is not None else self._retx_timeout
+        if self._clock_ms - self._rcvq_time < rtt:
+            return
+        bytes_read = self._reassembler.stream_out.bytes_read
+        copied = bytes_read - self._rcvq_seq
+        self._rcvq_seq = bytes_read
+        self._rcvq_time = self._clock_ms
+        if 2 * copied > self._recv_capacity:
+            self._set_recv_capacity(min(2 * copied, self._recv_capacity_max))
+
+    def _rcv_memory_pressure(self) -> bool:
+        """
+        While autotuned buffers exceed the memory limit, shrink ours back
+        as far as the window already advertised allows
+        """
+        if TcpConnection._rmem_allocated <= self._recv_memory_limit:
+            return False
+        self._set_recv_capacity(self._recv_capacity_min)
+        return True
+
+    def _set_recv_capacity(self, capacity: int):
+        # never retract the right edge already advertised to the peer
+        bytes_read = self._reassembler.stream_out.bytes_read
+        self._reassembler.capacity = max(capacity, self._rcv_adv_right - bytes_read)
+        self._recv_capacity = self._reassembler.capacity
+        charge = max(self._recv_capacity - self._recv_capacity_min, 0)
+        with TcpConnection._mem_lock:
+            TcpConnection._rmem_allocated += charge - self._rmem_charged
+        self._rmem_charged = charge
+
+    def _release_buffer_memory(self):
+        with TcpConnection._mem_lock:
+            TcpConnection._rmem_allocated -= self._rmem_charged
+            TcpConnection._wmem_allocated -= self._wmem_charged
+        self._rmem_charged = 0
+        self._wmem_charged = 0
+
+    def _snd_buf_adjust(self, acked: int):
+        """
+        Send buffer autosizing: at the end of each RTT round, if the
+        application kept the buffer full, grow it to twice the bytes the
+        peer acked in that round (2 x BDP), or to 2 x cwnd when congestion
+        control runs, so the pipe does not drain
+        """
+        if not self._sndbuf_autosizing:
+            return
+        self._snd_delivered += acked
+        rtt = self._srtt if self._srtt is not None else self._retx_timeout
+        if self._clock_ms - self._snd_round_start < rtt:
+            return
+        delivered = self._snd_delivered
+        self._snd_delivered = 0
+        self._snd_round_start = self._clock_ms
+        if self._stream_in.remaining_capacity > 0:
+            return
+        headroom = self._send_memory_limit - TcpConnection._wmem_allocated
+        if self._congestion_control:
+            delivered = max(delivered, self._cwnd)
+        target = min(2 * delivered, self._send_capacity_max,
+                     self._send_capacity + max(headroom, 0))
+        if target > self._send_capacity:
+            self._set_send_capacity(target)
+
+    def _set_send_capacity(self, capacity: int):
+        self._stream_in.capacity = max(capacity, self._stream_in.size)
+        self._send_capacity = self._stream_in.capacity
+        charge = max(self._send_capacity - self._send_capacity_min, 0)
+        with TcpConnection._mem_lock:
+            TcpConnection._wmem_allocated += charge - self._wmem_charged
+        self._wmem_charged = charge
+
+    @property
+    def _snd_una(self) -> int:
+        """
+        Absolute seqno of the oldest unacknowledged data
+        """
+        if self._outgoing_segments:
+            return self._outgoing_segments[0].seqno_absolute
+        return self._next_seqno_absolute
+
     @property
     def available_receiver_space(self):
         if len(self._outgoing_segments) == 0:
             return self._receiver_window_size
-        window_left = self._unwrap_sender(self._outgoing_segments[0].header.seqno)
-        window_right = window_left + self._receiver_window_size
+        window_right = self._outgoing_segments[0].seqno_absolute + self._receiver_window_size
         available_space = window_right - self._next_seqno_absolute
-        return available_space
+        return max(available_space, 0)
 
-    def _fill_window(self):
+    def _fill_window(self, window_probe: bool = False):
         if self.fin_sent:
             return
         send_size = min(self._stream_in.size + int(self._stream_in.input_ended),
-                        self.available_receiver_space)
+                        1 if window_probe else self.available_receiver_space)
+        if self._congestion_control and not window_probe:
+            cwnd_space = max(self._cwnd - self._pipe(), 0)
+            if cwnd_space < send_size:
+                # whole segments only, cwnd does not cut segments short
+                cwnd_space -= cwnd_space % self._max_payload_size
+            send_size = min(send_size, cwnd_space)
         assert send_size >= 0
         while send_size > 0:
-            payload_size = min(send_size - int(self._stream_in.input_ended),
-                               self._max_payload_size)
+            # the FIN only takes the last unit of the window once all data fits
+            payload_size = min(send_size, self._stream_in.size, self._max_payload_size)
+            if self._hold_small_segment(payload_size):
+                break
+            is_probe = False
+            if self._mtu_probing and payload_size == self._max_payload_size:
+                probe_size = self._next_mtu_probe_size()
+                if probe_size and send_size - int(self._stream_in.input_ended) >= probe_size:
+                    payload_size = probe_size
+                    is_probe = True
+            if self._autocork and payload_size > 0:
+                appended = self._append_to_queued_segment(payload_size)
+                if appended > 0:
+                    send_size -= appended
+                    continue
             payload = self._stream_in.read(payload_size)
             assert not self._stream_in.error
             seg = TcpSegment(TcpHeader(
@@ -399,17 +961,482 @@ class TcpConnection:
             if self._stream_in.eof and send_size > 0:
                 seg.header.fin = True
                 if self._state == TcpState.ESTABLISHED:
-                    self._state = TcpState.FIN_WAIT_1
+                    self._set_state(TcpState.FIN_WAIT_1)
                 elif self._state == TcpState.CLOSE_WAIT:
-                    self._state = TcpState.LAST_ACK
+                    self._set_state(TcpState.LAST_ACK)
                 self._fin_sent = True
                 send_size -= 1
             self._send_segment(seg)
+            if is_probe:
+                self._mtu_probe = seg
+        if not window_probe:
+            self._update_persist_timer()
 
-    def tick(self, ms_since_last_tick: int):
-        self._last_recv_et += ms_since_last_tick
-        if not self._timer_enabled:
+    def _update_persist_timer(self):
+        """
+        Arm the persist timer while the peer's window is zero and we have
+        something to send; disarm it, restarting the RTO, when the window opens
+        """
+        zero_window = (
+            self._receiver_window_size == 0 and
+            self._state in (TcpState.ESTABLISHED, TcpState.CLOSE_WAIT) and
+            (self._stream_in.size > 0 or self._stream_in.input_ended or
+             len(self._outgoing_segments) > 0)
+        )
+        if zero_window and not self._persist_enabled:
+            self._persist_enabled = True
+            self._persist_elapsed = 0
+            self._persist_timeout = self._retx_timeout
+        elif not zero_window and self._persist_enabled:
+            self._persist_enabled = False
+            self._time_elapsed = 0
+            if self._outgoing_segments:
+                self._timer_enabled = True
+
+    def _send_window_probe(self):
+        """
+        Send one byte (or the FIN) past the closed window to elicit an ACK
+        """
+        if self._outgoing_segments:
+            head = self._outgoing_segments[0]
+            probe = TcpSegment(TcpHeader(
+                ack=True,
+                seqno=head.header.seqno,
+                ackno=self.ackno,
+                fin=head.header.fin and len(head.payload) <= 1
+            ), head.payload[:1])
+            self._retransmit(probe)
+        else:
+            self._fill_window(window_probe=True)
+            if self._fin_sent:
+                # the probe carried our FIN, which the RTO looks after
+                self._update_persist_timer()
+
+    def _next_mtu_probe_size(self) -> int:
+        if self._mtu_probe is not None:
+            return 0
+        if self._mtu_probe_high - self._mtu_probe_low < self._mtu_probe_threshold:
+            return 0
+        return (self._mtu_probe_low + self._mtu_probe_high + 1) // 2
+
+    def _mtu_probe_acked(self):
+        assert self._mtu_probe is not None
+        self._mtu_probe_low = len(self._mtu_probe.payload)
+        self._max_payload_size = self._mtu_probe_low
+        self._mtu_probe = None
+
+    def _mtu_probe_lost(self):
+        """
+        The probe was too big: lower the search ceiling and resend all its
+        bytes in segments of the last size known to work
+        """
+        probe = self._outgoing_segments.popleft()
+        assert probe is self._mtu_probe
+        self._clear_marks(probe)
+        self._mtu_probe = None
+        self._mtu_probe_high = len(probe.payload) - 1
+        seqno_absolute = probe.seqno_absolute
+        pieces = []
+        for i in range(0, len(probe.payload), self._max_payload_size):
+            piece = TcpSegment(TcpHeader(
+                ack=True,
+                seqno=self._wrap_sender(seqno_absolute + i),
+                ackno=self.ackno,
+                win=probe.header.win
+            ), probe.payload[i:i + self._max_payload_size])
+            piece.seqno_absolute = seqno_absolute + i
+            pieces.append(piece)
+        pieces[-1].header.fin = probe.header.fin
+        self._outgoing_segments.extendleft(reversed(pieces))
+        for piece in pieces:
+            self._retransmit(piece)
+
+    def _hold_small_segment(self, payload_size: int) -> bool:
+        """
+        Nagle/cork: a sub-MSS segment waits unless it carries the end of the stream
+        """
+        if payload_size >= self._max_payload_size or self._stream_in.input_ended:
+            return False
+        return self._corked or (self._nagle and self.bytes_in_flight > 0)
+
+    def _append_to_queued_segment(self, payload_size: int) -> int:
+        """
+        Autocork: grow the last data segment if it has not left segments_out yet
+        """
+        if not self._segments_out or not self._outgoing_segments:
+            return 0
+        last = self._segments_out[-1]
+        if last is not self._outgoing_segments[-1] or last.header.fin:
+            return 0
+        size = min(payload_size, self._max_payload_size - len(last.payload))
+        if size <= 0:
+            return 0
+        last.payload += self._stream_in.read(size)
+        self._next_seqno_absolute += size
+        self._bytes_in_flight += size
+        if last.lost:
+            self._lost_out += size
+        return size
+
+    def _coalesce_head(self):
+        """
+        Repacketize on retransmit: replace the leading small outstanding
+        segments with one segment of up to MSS covering the same bytes.
+        Only segments with the head's SACK, loss and retransmission marks
+        are merged, so the merged one keeps them and the scoreboard holds
+        """
+        outgoing = self._outgoing_segments
+        head = outgoing[0]
+        marks = (head.sacked, head.lost, head.retransmitted)
+        size = len(head.payload)
+        count = 1
+        while count < len(outgoing) and not outgoing[count - 1].header.fin:
+            seg = outgoing[count]
+            if (seg is self._mtu_probe or size + len(seg.payload) > self._max_payload_size or
+                    (seg.sacked, seg.lost, seg.retransmitted) != marks):
+                break
+            size += len(seg.payload)
+            count += 1
+        if count == 1:
+            return
+        pieces = [outgoing.popleft() for _ in range(count)]
+        merged = TcpSegment(TcpHeader(
+            ack=True,
+            seqno=head.header.seqno,
+            ackno=self.ackno,
+            win=head.header.win,
+            fin=pieces[-1].header.fin
+        ), b''.join(seg.payload for seg in pieces))
+        merged.seqno_absolute = head.seqno_absolute
+        merged.sent_time = head.sent_time
+        merged.sacked, merged.lost, merged.retransmitted = marks
+        outgoing.appendleft(merged)
+        log('FSM', f'coalesce {count} segments into {size} bytes for retransmission')
+
+    def _retransmit(self, seg: TcpSegment):
+        """
+        Resend an outstanding segment, with a fresh timestamp
+        """
+        if self._ts_ok:
+            seg.header.options.ts_val = self._ts_now
+            seg.header.options.ts_ecr = self._ts_recent
+        if self._sack_ok:
+            seg.header.options.sack_blocks = self._sack_blocks()
+        if self._ecn_ok:
+            seg.header.ece = self._ece_pending
+            seg.ect = False
+        seg.sent_time = self._clock_ms
+        seg.retransmitted = True
+        if seg.lost:
+            seg.lost = False
+            self._lost_out -= seg.length_in_sequence_space
+        if self._in_recovery:
+            self._prr_out += seg.length_in_sequence_space
+        if self._undo_state is not None:
+            self._undo_retrans += 1
+        self._segments_out.append(seg)
+
+    def _sack_blocks(self) -> List[Tuple[int, int]]:
+        """
+        SACK blocks for the out-of-order data we hold, the block holding the
+        most recently received segment first (RFC 2018), after a D-SACK
+        block for duplicate data (RFC 2883)
+        """
+        blocks = []
+        for start, end in self._reassembler.unassembled_ranges:
+            block = (self._wrap_receiver(1 + start), self._wrap_receiver(1 + end))
+            if start <= self._sack_recent < end:
+                blocks.insert(0, block)
+            else:
+                blocks.append(block)
+        if self._dsack is not None:
+            start, end = self._dsack
+            blocks.insert(0, (self._wrap_receiver(1 + start), self._wrap_receiver(1 + end)))
+        return blocks
+
+    def _pipe(self) -> int:
+        """
+        Bytes still in the network (RFC 6675): outstanding, minus what the
+        peer SACKed and what is marked lost but not retransmitted yet
+        """
+        return self._bytes_in_flight - self._sacked_out - self._lost_out
+
+    def _mark_lost(self, seg: TcpSegment):
+        if not seg.lost and not seg.sacked:
+            seg.lost = True
+            self._lost_out += seg.length_in_sequence_space
+
+    def _clear_marks(self, seg: TcpSegment):
+        """
+        Take a segment leaving the queue out of the SACKed and lost totals
+        """
+        if seg.sacked:
+            self._sacked_out -= seg.length_in_sequence_space
+        elif seg.lost:
+            self._lost_out -= seg.length_in_sequence_space
+
+    def _congestion_ack(self, ackno_absolute: int, acked: int, delivered: int):
+        """
+        Grow cwnd outside recovery (slow start, then congestion avoidance);
+        enter recovery on DUPACK_THRESHOLD duplicate ACKs or a RACK loss;
+        inside it, let PRR set cwnd from the data delivered
+        """
+        mss = self._max_payload_size
+        if self._in_recovery and ackno_absolute >= self._recovery_point:
+            self._in_recovery = False
+            self._cwnd = self._ssthresh
+            if self._undo_retrans > 0:
+                self._undo_state = None
+            log('FSM', f'exit recovery with cwnd {self._cwnd}')
+            return
+        if not self._in_recovery:
+            if self._dupacks == self._dupack_threshold and self._outgoing_segments:
+                self._mark_lost(self._outgoing_segments[0])
+            if self._lost_out:
+                self._enter_recovery()
+            elif acked:
+                if self._cwnd < self._ssthresh:
+                    self._cwnd += min(acked, mss)
+                else:
+                    self._cwnd += max(mss * mss // self._cwnd, 1)
+                return
+            else:
+                return
+        self._prr_delivered += delivered
+        pipe = self._pipe()
+        if pipe > self._ssthresh:
+            # proportional part: spread the reduction over the episode
+            sndcnt = -(-self._prr_delivered * self._ssthresh // self._recover_fs) - self._prr_out
+        else:
+            # slow start reduction bound: catch up to ssthresh
+            limit = max(self._prr_delivered - self._prr_out, delivered) + mss
+            sndcnt = min(self._ssthresh - pipe, limit)
+        if self._prr_out == 0:
+            # the fast retransmit goes out on the first ACK of the episode
+            sndcnt = max(sndcnt, mss)
+        self._cwnd = pipe + max(sndcnt, 0)
+
+    def _enter_recovery(self):
+        if self._undo_state is None:
+            self._save_undo_state()
+        flight = self._bytes_in_flight - self._sacked_out
+        self._ssthresh = max(flight // 2, 2 * self._max_payload_size)
+        self._recover_fs = max(flight, 1)
+        self._prr_delivered = 0
+        self._prr_out = 0
+        self._recovery_point = self._next_seqno_absolute
+        self._in_recovery = True
+        log('FSM', f'enter recovery with ssthresh {self._ssthresh}')
+
+    def _ecn_echo_received(self):
+        """
+        The peer saw a CE mark: halve cwnd as for a loss, but without
+        retransmitting, once per window of data; CWR goes out on the next
+        new segment
+        """
+        if self._congestion_control and not self._in_recovery:
+            self._ssthresh = max(self._pipe() // 2, 2 * self._max_payload_size)
+            self._cwnd = self._ssthresh
+            # the congestion was real, there is nothing to undo
+            self._undo_state = None
+            log('FSM', f'ECN echo, reduce cwnd to {self._cwnd}')
+        self._ecn_cwr_point = self._next_seqno_absolute
+        self._cwr_pending = True
+
+    def _congestion_timeout(self):
+        """
+        RTO: collapse cwnd to one segment; everything not SACKed is lost
+        and goes out again as the window reopens in slow start
+        """
+        self._ssthresh = max(self._pipe() // 2, 2 * self._max_payload_size)
+        self._cwnd = self._max_payload_size
+        self._in_recovery = False
+        self._dupacks = 0
+        for seg in self._outgoing_segments:
+            self._mark_lost(seg)
+
+    def _send_lost(self):
+        """
+        Retransmit segments marked lost, as far as cwnd allows
+        """
+        if not self._lost_out:
+            return
+        for seg in self._outgoing_segments:
+            if not seg.lost:
+                continue
+            if (self._congestion_control and
+                    self._pipe() + seg.length_in_sequence_space > self._cwnd):
+                break
+            log('FSM', f'retransmit lost segment {seg.header.seqno}')
+            self._retransmit(seg)
+            if not self._lost_out:
+                break
+
+    def _save_undo_state(self):
+        self._undo_state = (self._rto, self._consecutive_retransmissions,
+                            self._cwnd, self._ssthresh)
+        self._undo_ts_val = self._ts_now if self._ts_ok else None
+        self._undo_retrans = 0
+
+    def _segment_index(self, seqno_absolute: int) -> int:
+        """
+        Index of the first outstanding segment starting at or after seqno_absolute
+        """
+        outgoing = self._outgoing_segments
+        lo, hi = 0, len(outgoing)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if outgoing[mid].seqno_absolute < seqno_absolute:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _sack_received(self, sack_blocks: Sequence[Tuple[int, int]]) -> List[TcpSegment]:
+        """
+        Mark outstanding segments covered by a SACK block, return the newly marked.
+        Each block is found by bisection and walked only up to its right edge
+        """
+        outgoing = self._outgoing_segments
+        sacked = []
+        for left, right in sack_blocks:
+            right = self._unwrap_sender(right)
+            i = self._segment_index(self._unwrap_sender(left))
+            while i < len(outgoing):
+                seg = outgoing[i]
+                if seg.seqno_absolute + seg.length_in_sequence_space > right:
+                    break
+                i += 1
+                if seg.sacked:
+                    continue
+                if seg.lost:
+                    # delivered after all, it needs no retransmission
+                    seg.lost = False
+                    self._lost_out -= seg.length_in_sequence_space
+                seg.sacked = True
+                self._sacked_out += seg.length_in_sequence_space
+                sacked.append(seg)
+        return sacked
+
+    def _spurious_retransmission(self, ackno_absolute: int, ts_ecr: Optional[int],
+                                 sack_blocks: Sequence[Tuple[int, int]]) -> bool:
+        """
+        Eifel (RFC 3522): the ACK for the retransmission echoes a TSval
+        older than the retransmission, so the original got through.
+        D-SACK (RFC 2883): the peer reported every retransmission of the
+        episode as duplicate data
+        """
+        if ts_ecr is not None and self._undo_ts_val is not None:
+            if ((ts_ecr - self._undo_ts_val) & 0xffffffff) >= (1 << 31):
+                return True
+            # the retransmission was needed, the episode cannot be undone
+            self._undo_state = None
+            return False
+        if sack_blocks:
+            left, right = (self._unwrap_sender(edge) for edge in sack_blocks[0])
+            covered = any(self._unwrap_sender(l) <= left and right <= self._unwrap_sender(r)
+                          for l, r in sack_blocks[1:])
+            if right <= ackno_absolute or covered:
+                # a duplicate arrived, RACK waits longer before marking losses
+                self._reo_wnd_mult += 1
+                self._undo_retrans -= 1
+                return self._undo_retrans <= 0
+        return False
+
+    def _undo_recovery(self):
+        """
+        The retransmissions were spurious: restore the state saved at the
+        first RTO of the episode
+        """
+        log('FSM', 'spurious retransmission, undo recovery')
+        (self._rto, self._consecutive_retransmissions,
+         self._cwnd, self._ssthresh) = self._undo_state
+        self._in_recovery = False
+        self._undo_state = None
+        self._undo_ts_val = None
+        self._undo_retrans = 0
+        self._spurious_retransmissions += 1
+
+    def _rack_update(self, delivered: List[TcpSegment]):
+        """
+        RACK: remember the most recently sent of the delivered segments
+        """
+        for seg in delivered:
+            rtt = self._clock_ms - seg.sent_time
+            if seg.retransmitted and self._min_rtt is not None and rtt < self._min_rtt:
+                # too fast, this acknowledges the original transmission
+                continue
+            self._min_rtt = rtt if self._min_rtt is None else min(self._min_rtt, rtt)
+            end_seq = seg.seqno_absolute + seg.length_in_sequence_space
+            if (seg.sent_time, end_seq) > (self._rack_xmit_time, self._rack_end_seq):
+                self._rack_xmit_time = seg.sent_time
+                self._rack_end_seq = end_seq
+                self._rack_rtt = rtt
+
+    def _rack_detect_loss(self):
+        """
+        RACK: a segment sent before the most recently delivered one is lost
+        once it is overdue by more than the reordering window (min_rtt / 4).
+        Lost segments are marked for _send_lost, the others arm the
+        reordering timer
+        """
+        self._rack_timer = None
+        if self._rack_xmit_time < 0:
             return
+        reo_wnd = (self._min_rtt or 0) // 4 * self._reo_wnd_mult
+        if self._srtt is not None:
+            reo_wnd = min(reo_wnd, int(self._srtt))
+        timeout = 0
+        for seg in self._outgoing_segments:
+            end_seq = seg.seqno_absolute + seg.length_in_sequence_space
+            if (seg.sent_time, end_seq) >= (self._rack_xmit_time, self._rack_end_seq):
+                if not seg.retransmitted:
+                    # the queue is in seqno order, so everything after a
+                    # segment sent only once was sent later still
+                    break
+                continue
+            if seg.sacked:
+                continue
+            remaining = seg.sent_time + self._rack_rtt + reo_wnd - self._clock_ms
+            if remaining <= 0:
+                if not seg.lost:
+                    log('FSM', f'RACK marks segment {seg.header.seqno} lost')
+                self._mark_lost(seg)
+            else:
+                timeout = max(timeout, remaining)
+        if timeout:
+            self._rack_timer = timeout
+
+    def _arm_tlp(self):
+        """
+        Schedule a tail loss probe 2 * SRTT after the last send or ACK,
+        plus the peer's delayed ACK time when a single segment is in flight
+        """
+        self._tlp_timer = None
+        if (not self._rack or not self._outgoing_segments or self._tlp_outstanding or
+                self._rack_timer is not None or self._persist_enabled):
+            return
+        pto = 2 * self._srtt if self._srtt is not None else self._retx_timeout
+        if len(self._outgoing_segments) == 1:
+            pto += self._max_ack_delay
+        self._tlp_timer = max(int(min(pto, self._rto)), 1)
+
+    def _send_tlp(self):
+        """
+        Tail loss probe: send new data if the window allows, otherwise
+        retransmit the last outstanding segment to elicit SACK feedback
+        """
+        self._tlp_timer = None
+        self._tlp_outstanding = True
+        next_seqno = self._next_seqno_absolute
+        self._fill_window()
+        if self._next_seqno_absolute == next_seqno and self._outgoing_segments:
+            log('FSM', 'send tail loss probe')
+            self._retransmit(self._outgoing_segments[-1])
+        # the RTO restarts from the probe
+        self._time_elapsed = 0
+
+    def _tick_retransmission_timer(self, ms_since_last_tick: int):
         self._time_elapsed += ms_since_last_tick
         if self._time_elapsed >= self._rto and self.state != TcpState.CLOSE_WAIT:
             if self._consecutive_retransmissions >= self._max_retx_attempts:
@@ -419,7 +1446,11 @@ class TcpConnection:
                     rst=True
                 )))
                 self._active = False
+                self._release_buffer_memory()
                 return
+            # a lost probe says the path MTU is smaller, not that the path is
+            # congested (RFC 4821): no cwnd cut, no backoff
+            probe_lost = False
             # assert self._outgoing_segments
             if len(self._outgoing_segments) == 0:
                 if self._state == TcpState.FIN_WAIT_1:
@@ -433,17 +1464,93 @@ class TcpConnection:
                         fin=True
                     )))
                 elif self._state == TcpState.SYN_SENT:
+                    self._next_seqno_absolute -= 1
                     self._send_segment(TcpSegment(TcpHeader(
-                        syn=True
+                        syn=True,
+                        options=self._syn_options()
                     )))
+                elif self._state == TcpState.SYN_RECEIVED:
+                    assert self._receiver_isn is not None
+                    self._next_seqno_absolute -= 1
+                    self._send_segment(TcpSegment(TcpHeader(
+                        syn=True,
+                        ack=True,
+                        ackno=uint32_plus(self._receiver_isn),
+                        ece=self._ecn_ok,
+                        options=self._syn_options(self._peer_syn_options)
+                    )))
+            elif self._outgoing_segments[0] is self._mtu_probe:
+                probe_lost = True
+                self._mtu_probe_lost()
             else:
-                self._segments_out.append(self._outgoing_segments[0])
-            if self._receiver_window_size:
+                if self._consecutive_retransmissions == 0 and not self._in_recovery:
+                    # a new episode, save what a spurious timeout would undo
+                    self._save_undo_state()
+                if self._congestion_control:
+                    self._congestion_timeout()
+                if self._retx_coalesce:
+                    self._coalesce_head()
+                self._retransmit(self._outgoing_segments[0])
+            self._tlp_timer = None
+            self._tlp_outstanding = False
+            if not probe_lost:
                 self._rto = (self._rto << 1)
+                self._consecutive_retransmissions += 1
             self._timer_enabled = True
             self._time_elapsed = 0
-            self._consecutive_retransmissions += 1
-        
+
+    def _stop_retransmission_timer(self):
+        """
+        Called when our SYN or FIN is acknowledged
+        """
+        if self._outgoing_segments:
+            return
+        self._timer_enabled = False
+        self._rto = self._retx_timeout
+        self._consecutive_retransmissions = 0
+
+    def tick(self, ms_since_last_tick: int):
+        self._clock_ms += ms_since_last_tick
+        self._last_recv_et += ms_since_last_tick
+        if self._outgoing_segments or not self._stream_in.empty:
+            self._snd_idle = 0
+        else:
+            self._snd_idle += ms_since_last_tick
+            # idle for longer than an RTO (RFC 2861): give the growth back
+            if self._wmem_charged and self._snd_idle >= self._retx_timeout:
+                self._set_send_capacity(self._send_capacity_min)
+        # reads retune the receive buffer, this covers an application that
+        # stopped reading
+        if self._rmem_charged:
+            self._rcv_memory_pressure()
+        if self._ack_pending:
+            self._delack_elapsed += ms_since_last_tick
+            if self._delack_elapsed >= self._delack_timeout:
+                self._send_ack()
+        if self._rack_timer is not None:
+            self._rack_timer -= ms_since_last_tick
+            if self._rack_timer <= 0:
+                self._rack_detect_loss()
+                if self._congestion_control:
+                    self._congestion_ack(self._snd_una, 0, 0)
+                self._send_lost()
+                self._arm_tlp()
+        if self._tlp_timer is not None:
+            self._tlp_timer -= ms_since_last_tick
+            if self._tlp_timer <= 0:
+                self._send_tlp()
+        if self._persist_enabled:
+            self._persist_elapsed += ms_since_last_tick
+            if self._persist_elapsed >= self._persist_timeout:
+                self._send_window_probe()
+                self._persist_elapsed = 0
+                self._persist_timeout = min(self._persist_timeout << 1,
+                                            self._persist_timeout_max)
+        elif self._timer_enabled:
+            self._tick_retransmission_timer(ms_since_last_tick)
+            if not self._active:
+                return
+
         if self.state == TcpState.LAST_ACK:
             return  # 当处于LAST_ACK时，需要进行确认-重传，不再进行_should_shutdown()的判断，防止直接关闭
 
@@ -451,10 +1558,41 @@ class TcpConnection:
             if self._linger_after_stream_finish:
                 if self._last_recv_et >= 2 * self.MSL:
                     self._active = False
-                    self._state = TcpState.CLOSED
+                    self._release_buffer_memory()
+                    self._set_state(TcpState.CLOSED)
             else:
                 self._active = False
-                self._state = TcpState.CLOSED
+                self._release_buffer_memory()
+                self._set_state(TcpState.CLOSED)
+
+    @property
+    def next_timeout(self) -> Optional[int]:
+        """
+        Milliseconds until tick() has something to do (the earliest of the
+        delayed ACK, RACK, TLP, persist, RTO, send buffer idle and TIME_WAIT
+        timers), None when no timer is armed. Valid until the connection
+        is next fed a segment, written to or ticked
+        """
+        if not self._active:
+            return None
+        timeouts = []
+        if self._ack_pending:
+            timeouts.append(self._delack_timeout - self._delack_elapsed)
+        if self._rack_timer is not None:
+            timeouts.append(self._rack_timer)
+        if self._tlp_timer is not None:
+            timeouts.append(self._tlp_timer)
+        if self._persist_enabled:
+            timeouts.append(self._persist_timeout - self._persist_elapsed)
+        elif self._timer_enabled and self.state != TcpState.CLOSE_WAIT:
+            timeouts.append(self._rto - self._time_elapsed)
+        if (self._wmem_charged and not self._outgoing_segments and
+                self._stream_in.empty):
+            timeouts.append(self._retx_timeout - self._snd_idle)
+        if self.state != TcpState.LAST_ACK and self._should_shutdown():
+            timeouts.append(2 * self.MSL - self._last_recv_et
+                            if self._linger_after_stream_finish else 0)
+        return max(min(timeouts), 0) if timeouts else None
 
     def shutdown_write(self):
         self._stream_in.end_input()
@@ -468,16 +1606,29 @@ class TcpConnection:
     
     def shutdown(self):
         self._send_segment(TcpSegment(TcpHeader(rst=True)))
-        self._state = TcpState.CLOSED
+        self._set_state(TcpState.CLOSED)
         self._active = False
+        self._release_buffer_memory()
         self._stream_in.error = True
         self._reassembler._stream_out.error = True
 
 
+    def _set_state(self, state: int):
+        if state != self._state:
+            self._transitions[(self._state, state)] += 1
+            self._state = state
+
     @property
     def state(self) -> int:
         return self._state
 
+    @property
+    def transitions(self) -> Counter:
+        """
+        How many times each (from_state, to_state) transition was taken
+        """
+        return self._transitions
+
     @property
     def syn_received(self) -> bool:
         return self._receiver_isn is not None
@@ -492,7 +1643,14 @@ class TcpConnection:
 
     @property
     def bytes_in_flight(self) -> int:
-        return sum(seg.length_in_sequence_space for seg in self._outgoing_segments)
+        return self._bytes_in_flight
+
+    @property
+    def spurious_retransmissions(self) -> int:
+        """
+        How many retransmission episodes turned out to be unnecessary
+        """
+        return self._spurious_retransmissions
 
     @property
     def consecutive_retransmissions(self):
@@ -536,3 +1694,18 @@ class TcpConnection:
             return None
         assert self._receiver_isn is not None
         return self._wrap_receiver(1 + self._reassembler.ack_index + int(self.fin_received))
+
+    @property
+    def ts_val(self) -> Optional[int]:
+        return self._ts_now if self._ts_ok else None
+
+    @property
+    def ts_recent(self) -> Optional[int]:
+        return self._ts_recent if self._ts_ok else None
+
+    def continue_timestamps(self, ts_val: int):
+        """
+        Send TSvals from ts_val on, so a connection reusing a 4-tuple that
+        was in TIME_WAIT stays ahead of the old one for the peer's PAWS
+        """
+        self._ts_offset = (ts_val - self._clock_ms) & 0xffffffff
@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import hashlib
+import os
+from collections import deque
+from random import randint
+from typing import TYPE_CHECKING, Deque, Dict, List, Optional, Tuple
+
+from config import TcpConfig
+from logger import log
+from tcp_connection import TcpConnection
+from tcp_segment import TcpSegment, TcpHeader, TcpOptions
+from tcp_state import TcpState
+from utils import UINT32_MAX, uint32_plus
+
+if TYPE_CHECKING:
+    from tcp_mux import TcpMultiplexer, FourTuple
+
+# MSS values a SYN cookie can encode, as in Linux
+SYN_COOKIE_MSS = (536, 1300, 1440, 1460)
+# the cookie counter advances every 64 s, a cookie is good for two of them
+SYN_COOKIE_PERIOD_MS = 64 * 1000
+SYN_COOKIE_MAX_AGE = 2
+
+
+class SynCookies:
+    """
+    Stateless SYN-ACK sequence numbers (Bernstein): the top 5 bits hold
+    a counter of 64 s periods, the next 3 bits an index into
+    SYN_COOKIE_MSS and the low 24 bits a keyed hash of the 4-tuple, the
+    peer's ISN and the counter
+    """
+    def __init__(self, secret: Optional[bytes] = None):
+        self._secret = secret if secret is not None else os.urandom(16)
+
+    def _hash(self, four_tuple: FourTuple, peer_isn: int, count: int) -> int:
+        data = f'{four_tuple}/{peer_isn}/{count}'.encode()
+        digest = hashlib.blake2s(data, key=self._secret, digest_size=3).digest()
+        return int.from_bytes(digest, 'big')
+
+    def make(self, four_tuple: FourTuple, peer_isn: int, mss: int, now_ms: int) -> Tuple[int, int]:
+        """
+        The cookie for a SYN advertising mss, and the MSS it encodes
+        """
+        index = 0
+        for i, value in enumerate(SYN_COOKIE_MSS):
+            if value <= mss:
+                index = i
+        count = (now_ms // SYN_COOKIE_PERIOD_MS) & 0x1f
+        cookie = (count << 27) | (index << 24) | self._hash(four_tuple, peer_isn, count)
+        return cookie, SYN_COOKIE_MSS[index]
+
+    def check(self, four_tuple: FourTuple, peer_isn: int, cookie: int, now_ms: int) -> Optional[int]:
+        """
+        The MSS encoded in a cookie we handed out, None if it is forged or too old
+        """
+        count = cookie >> 27
+        index = (cookie >> 24) & 0x7
+        age = ((now_ms // SYN_COOKIE_PERIOD_MS) - count) & 0x1f
+        if age > SYN_COOKIE_MAX_AGE or index >= len(SYN_COOKIE_MSS):
+            return None
+        if cookie & 0xffffff != self._hash(four_tuple, peer_isn, count):
+            return None
+        return SYN_COOKIE_MSS[index]
+
+
+class TcpListener:
+    """
+    A passive open on (local ip, port) of a TcpMultiplexer. Each SYN gets
+    a TcpConnection in the SYN queue, which moves to the accept queue once
+    the handshake completes. Past syn_backlog half-open connections the
+    listener answers with SYN cookies and allocates nothing until a valid
+    ACK comes back. accept() hands out established connections
+    """
+    def __init__(self, mux: TcpMultiplexer, local_ip: str, port: int,
+                 backlog: int, cfg: TcpConfig):
+        self._mux = mux
+        self.local_ip = local_ip
+        self.port = port
+        self._backlog = backlog
+        self._cfg = cfg
+        self._syn_backlog = cfg.syn_backlog
+        self._syncookies = cfg.syncookies
+        self._cookies = SynCookies()
+        self._syn_queue: Dict[TcpConnection, None] = {}
+        self._accept_queue: Deque[TcpConnection] = deque()
+        self.cookies_sent = 0
+        self.cookies_accepted = 0
+        self.syns_dropped = 0
+
+    def __len__(self) -> int:
+        return len(self._accept_queue)
+
+    @property
+    def syn_queue_size(self) -> int:
+        return len(self._syn_queue)
+
+    def accept(self) -> Optional[TcpConnection]:
+        """
+        The oldest established connection, None when there is none yet
+        """
+        return self._accept_queue.popleft() if self._accept_queue else None
+
+    def close(self):
+        """
+        Stop listening; connections not accepted yet are reset
+        """
+        self._mux.unlisten(self)
+        for conn in list(self._syn_queue) + list(self._accept_queue):
+            self._mux.abort(conn)
+        self._syn_queue.clear()
+        self._accept_queue.clear()
+
+    def segments_received(self, four_tuple: FourTuple, segs: List[TcpSegment]):
+        """
+        Segments for a 4-tuple the multiplexer has no connection for
+        """
+        for i, seg in enumerate(segs):
+            header = seg.header
+            if header.rst:
+                continue
+            if header.syn and not header.ack:
+                conn = self._syn_received(four_tuple, seg)
+            elif header.ack and not header.syn and self._syncookies:
+                conn = self._cookie_ack_received(four_tuple, seg)
+                i += 1
+            else:
+                conn = None
+            if conn is not None:
+                # the rest of the batch belongs to the new connection
+                self._mux.segments_received(segs[i:])
+                return
+
+    def connection_updated(self, conn: TcpConnection) -> bool:
+        """
+        Called for connections in the SYN queue after they were fed or
+        ticked; True once the connection has left the queue
+        """
+        if not conn.active:
+            del self._syn_queue[conn]
+            return True
+        if conn.state in (TcpState.LISTEN, TcpState.SYN_RECEIVED):
+            return False
+        del self._syn_queue[conn]
+        self._accept_queue.append(conn)
+        return True
+
+    def _syn_received(self, four_tuple: FourTuple, seg: TcpSegment) -> Optional[TcpConnection]:
+        if len(self._accept_queue) >= self._backlog:
+            # nobody is accepting, a cookie would not help either
+            self.syns_dropped += 1
+            return None
+        if len(self._syn_queue) < self._syn_backlog:
+            conn = TcpConnection(self._cfg, randint(0, UINT32_MAX))
+            conn.set_listening()
+            self._syn_queue[conn] = None
+            self._mux.add(conn, four_tuple, listener=self)
+            return conn
+        if not self._syncookies:
+            self.syns_dropped += 1
+            return None
+        peer_mss = seg.header.options.mss
+        cookie, _ = self._cookies.make(
+            four_tuple, seg.header.seqno,
+            # RFC 1122 default when the SYN carries no MSS option
+            536 if peer_mss is None else peer_mss, self._mux.now)
+        # only the peer's MSS survives in the cookie, so no other options
+        # are offered; the SYN-ACK advertises our own MSS
+        our_mss = self._cfg.mss if self._cfg.mss is not None else self._cfg.MAX_PAYLOAD_SIZE
+        syn_ack = TcpSegment(TcpHeader(
+            syn=True,
+            ack=True,
+            seqno=cookie,
+            ackno=uint32_plus(seg.header.seqno),
+            win=min(self._cfg.recv_capacity, 0xffff),
+            options=TcpOptions(mss=our_mss)
+        ))
+        self._mux.send_segment(four_tuple, syn_ack)
+        self.cookies_sent += 1
+        log('FSM', f'SYN queue full, send SYN cookie to {four_tuple}')
+        return None
+
+    def _cookie_ack_received(self, four_tuple: FourTuple, seg: TcpSegment) -> Optional[TcpConnection]:
+        if len(self._accept_queue) >= self._backlog:
+            return None
+        cookie = (seg.header.ackno - 1) & UINT32_MAX
+        peer_isn = (seg.header.seqno - 1) & UINT32_MAX
+        mss = self._cookies.check(four_tuple, peer_isn, cookie, self._mux.now)
+        if mss is None:
+            return None
+        # replay the handshake the cookie stands for
+        conn = TcpConnection(self._cfg, cookie)
+        conn.set_listening()
+        conn.segment_received(TcpSegment(TcpHeader(
+            syn=True,
+            seqno=peer_isn,
+            options=TcpOptions(mss=mss)
+        )))
+        conn.segments_out.clear()
+        conn.segment_received(seg)
+        if conn.state != TcpState.ESTABLISHED:
+            return None
+        self._accept_queue.append(conn)
+        self._mux.add(conn, four_tuple)
+        self.cookies_accepted += 1
+        return conn
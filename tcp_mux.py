@@ -0,0 +1,310 @@
+import select
+import selectors
+from copy import copy
+from random import randint
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from config import TcpConfig, FdAdapterConfig
+from event_loop import EventLoop
+from fd_adapter import TcpOverIpv4OverTunAdapter
+from ipv4 import IPv4Header
+from logger import log
+from port_allocator import EphemeralPortAllocator
+from tcp_connection import TcpConnection
+from tcp_listener import TcpListener
+from tcp_segment import TcpSegment, TCP_HEADER_LENGTH
+from tcp_socket import TCP_TICK_MS, TCP_READ_BATCH
+from tcp_state import TcpState
+from time_wait import TimeWaitTable
+from timer_wheel import ConnectionTimers
+from utils import UINT32_MAX, timestamp_ms, uint32_plus
+
+# (local ip, local port, remote ip, remote port)
+FourTuple = Tuple[str, int, str, int]
+
+
+class TcpMultiplexer:
+    """
+    Many TcpConnections over one TUN adapter in one thread: incoming
+    segments are dispatched through a table keyed by 4-tuple, what the
+    connections queue in segments_out goes out through a single write
+    path, and their timers run off one timer wheel. Segments for a
+    4-tuple with no connection go to the TcpListener on its local
+    address, if there is one. Connections entering TIME_WAIT are freed
+    and leave an entry in a TimeWaitTable instead.
+
+    The application reads and writes through the multiplexer, so each
+    connection's clock is current and its output is picked up.
+    """
+    def __init__(self, adapter: TcpOverIpv4OverTunAdapter, cfg: Optional[TcpConfig] = None):
+        self._adapter = adapter
+        self._cfg = cfg if cfg is not None else TcpConfig()
+        if self._cfg.mss is None and self._adapter.mtu:
+            # on a copy, the caller's config may be shared with other adapters
+            self._cfg = copy(self._cfg)
+            self._cfg.mss = self._adapter.mtu - IPv4Header.HEADER_LENGTH - TCP_HEADER_LENGTH
+        self._connections: Dict[FourTuple, TcpConnection] = {}
+        self._addresses: Dict[TcpConnection, FourTuple] = {}
+        # connections with segments waiting in segments_out
+        self._pending: Dict[TcpConnection, None] = {}
+        self._listeners: Dict[Tuple[str, int], TcpListener] = {}
+        # connections in a listener's SYN queue
+        self._half_open: Dict[TcpConnection, TcpListener] = {}
+        self._time_wait = TimeWaitTable(2 * self._cfg.MSL)
+        # called with each connection after it was fed, written to or ticked
+        self.on_update: Optional[Callable[[TcpConnection], None]] = None
+        self._ports = EphemeralPortAllocator(self._cfg.ephemeral_port_range)
+        # local ports connect() picked for connections
+        self._ephemeral: Dict[TcpConnection, int] = {}
+        self._timers = ConnectionTimers()
+        self._time = timestamp_ms()
+        self._loop = EventLoop()
+        self._loop.add_rule(
+            self._adapter,
+            selectors.EVENT_READ,
+            callback=self.read_adapter
+        )
+        self._loop.add_rule(
+            self._adapter,
+            selectors.EVENT_WRITE,
+            callback=self.flush,
+            interest=lambda: len(self._pending) > 0
+        )
+
+    def __len__(self) -> int:
+        return len(self._connections)
+
+    def connection(self, four_tuple: FourTuple) -> Optional[TcpConnection]:
+        return self._connections.get(four_tuple)
+
+    def address(self, conn: TcpConnection) -> FourTuple:
+        return self._addresses[conn]
+
+    @property
+    def connections(self) -> List[TcpConnection]:
+        return list(self._connections.values())
+
+    @property
+    def now(self) -> int:
+        return self._timers.now
+
+    def in_time_wait(self, four_tuple: FourTuple) -> bool:
+        return four_tuple in self._time_wait
+
+    def add(self, conn: TcpConnection, four_tuple: FourTuple,
+            listener: Optional[TcpListener] = None):
+        if four_tuple in self._connections:
+            raise RuntimeError(f'connection {four_tuple} already exists')
+        self._connections[four_tuple] = conn
+        self._addresses[conn] = four_tuple
+        if listener is not None:
+            self._half_open[conn] = listener
+        self._timers.add(conn)
+        self._touch(conn)
+
+    def remove(self, conn: TcpConnection):
+        four_tuple = self._addresses.pop(conn, None)
+        if four_tuple is None:
+            return
+        del self._connections[four_tuple]
+        self._timers.remove(conn)
+        self._pending.pop(conn, None)
+        self._half_open.pop(conn, None)
+        port = self._ephemeral.pop(conn, None)
+        if port is not None:
+            self._ports.release(port)
+
+    def listen(self, local_ip: str, port: int, backlog: int = 128) -> TcpListener:
+        """
+        Accept connections to port on local_ip, '0.0.0.0' for any address
+        """
+        if (local_ip, port) in self._listeners:
+            raise RuntimeError(f'{local_ip}:{port} is already listening')
+        listener = TcpListener(self, local_ip, port, backlog, self._cfg)
+        self._listeners[(local_ip, port)] = listener
+        return listener
+
+    def unlisten(self, listener: TcpListener):
+        self._listeners.pop((listener.local_ip, listener.port), None)
+
+    def connect(self, adapter_cfg: FdAdapterConfig) -> TcpConnection:
+        """
+        Open a connection; with sport 0 a free ephemeral port is picked,
+        one whose 4-tuple is neither in use nor in TIME_WAIT
+        """
+        sport = adapter_cfg.sport
+        if sport == 0:
+            sport = self._ports.allocate(
+                adapter_cfg.saddr, adapter_cfg.daddr, adapter_cfg.dport,
+                lambda port: self._taken((adapter_cfg.saddr, port,
+                                          adapter_cfg.daddr, adapter_cfg.dport)))
+        four_tuple = (adapter_cfg.saddr, sport, adapter_cfg.daddr, adapter_cfg.dport)
+        entry = self._time_wait.get(four_tuple)
+        if entry is None:
+            conn = TcpConnection(self._cfg, randint(0, UINT32_MAX))
+        elif self._time_wait.reusable(four_tuple, self.now):
+            # start past everything the old connection sent, in sequence and in time
+            conn = TcpConnection(self._cfg, uint32_plus(entry.seqno, 65535 + 2))
+            ts_val = self._time_wait.ts_val(four_tuple, self.now)
+            assert ts_val is not None
+            conn.continue_timestamps(uint32_plus(ts_val))
+            self._time_wait.remove(four_tuple)
+        else:
+            raise RuntimeError(f'connection {four_tuple} is in TIME_WAIT')
+        conn.connect()
+        self.add(conn, four_tuple)
+        if sport != adapter_cfg.sport:
+            self._ephemeral[conn] = sport
+        return conn
+
+    def _taken(self, four_tuple: FourTuple) -> bool:
+        return four_tuple in self._connections or four_tuple in self._time_wait
+
+    def write(self, conn: TcpConnection, data: bytes) -> int:
+        self._timers.sync(conn)
+        n = conn.write(data)
+        self._touch(conn)
+        return n
+
+    def read(self, conn: TcpConnection, n: int) -> bytes:
+        self._timers.sync(conn)
+        data = conn.read(n)
+        self._touch(conn)
+        return data
+
+    def shutdown_write(self, conn: TcpConnection):
+        self._timers.sync(conn)
+        conn.shutdown_write()
+        self._touch(conn)
+
+    def abort(self, conn: TcpConnection):
+        """
+        Reset the connection
+        """
+        conn.shutdown()
+        self._touch(conn)
+
+    def send_segment(self, four_tuple: FourTuple, seg: TcpSegment):
+        """
+        Write a segment that belongs to no connection, a SYN cookie
+        """
+        local_ip, local_port, remote_ip, remote_port = four_tuple
+        seg.header.sport = local_port
+        seg.header.dport = remote_port
+        seg.src_ip = local_ip
+        seg.dst_ip = remote_ip
+        self._adapter.write_segment(seg)
+
+    def segments_received(self, segs: Iterable[TcpSegment]):
+        """
+        Dispatch segments read from the adapter, each connection gets its
+        share as one batch
+        """
+        batches: Dict[FourTuple, List[TcpSegment]] = {}
+        for seg in segs:
+            four_tuple = (seg.dst_ip, seg.header.dport, seg.src_ip, seg.header.sport)
+            batches.setdefault(four_tuple, []).append(seg)
+        for four_tuple, batch in batches.items():
+            conn = self._connections.get(four_tuple)
+            if conn is None:
+                if four_tuple in self._time_wait:
+                    batch = self._time_wait_segments(four_tuple, batch)
+                if batch:
+                    self._unknown_segments(four_tuple, batch)
+                continue
+            self._timers.sync(conn)
+            conn.segments_received(batch)
+            self._touch(conn)
+
+    def _time_wait_segments(self, four_tuple: FourTuple, segs: List[TcpSegment]) -> List[TcpSegment]:
+        """
+        Answer segments for a 4-tuple in TIME_WAIT; what follows a SYN
+        allowed to reuse it is returned for a listener
+        """
+        for i, seg in enumerate(segs):
+            if seg.header.syn and not seg.header.ack:
+                if self._time_wait.syn_acceptable(four_tuple, seg):
+                    self._time_wait.remove(four_tuple)
+                    return segs[i:]
+                continue
+            reply = self._time_wait.reply(four_tuple, seg, self.now)
+            if reply is not None:
+                self.send_segment(four_tuple, reply)
+        return []
+
+    def _unknown_segments(self, four_tuple: FourTuple, segs: List[TcpSegment]):
+        local_ip, local_port = four_tuple[:2]
+        listener = self._listeners.get((local_ip, local_port))
+        if listener is None:
+            listener = self._listeners.get(('0.0.0.0', local_port))
+        if listener is not None:
+            listener.segments_received(four_tuple, segs)
+            return
+        log('FSM', f'drop {len(segs)} segments for unknown connection {four_tuple}')
+
+    def flush(self):
+        """
+        Write what every connection has queued, then forget the closed
+        ones and move those in TIME_WAIT to the TIME_WAIT table
+        """
+        pending = list(self._pending)
+        self._pending.clear()
+        for conn in pending:
+            while conn.segments_out:
+                self.send_segment(self._addresses[conn], conn.segments_out.popleft())
+            if not conn.active:
+                self.remove(conn)
+            elif conn.state == TcpState.TIME_WAIT:
+                self._time_wait.add(self._addresses[conn], conn, self.now)
+                self.remove(conn)
+
+    @property
+    def next_timeout(self) -> Optional[int]:
+        """
+        Milliseconds until tick() has work to do, None when no timer is pending
+        """
+        timeouts = [t for t in (self._timers.next_wakeup(), self._time_wait.next_expiry(self.now))
+                    if t is not None]
+        return min(timeouts) if timeouts else None
+
+    def tick(self, ms_since_last_tick: int):
+        for conn in self._timers.advance(ms_since_last_tick):
+            self._touch(conn)
+        self._time_wait.expire(self.now)
+
+    def _touch(self, conn: TcpConnection):
+        """
+        After the connection was fed, written to or ticked: rearm its
+        timer and queue its output
+        """
+        self._timers.update(conn)
+        if conn.segments_out or not conn.active or conn.state == TcpState.TIME_WAIT:
+            self._pending[conn] = None
+        listener = self._half_open.get(conn)
+        if listener is not None and listener.connection_updated(conn):
+            del self._half_open[conn]
+        if self.on_update is not None:
+            self.on_update(conn)
+
+    def read_adapter(self):
+        """
+        Read a batch of segments from the adapter and dispatch them
+        """
+        segs = []
+        for _ in range(TCP_READ_BATCH):
+            seg = self._adapter.read_segment()
+            if seg:
+                segs.append(seg)
+            if not select.select([self._adapter], [], [], 0)[0]:
+                break
+        self.segments_received(segs)
+
+    def run_once(self, timeout_ms: int = TCP_TICK_MS):
+        self._loop.wait_next_event(timeout_ms)
+        now = timestamp_ms()
+        self.tick(now - self._time)
+        self._time = now
+
+    def run(self, condition: Callable[[], bool] = lambda: True):
+        while condition():
+            self.run_once()
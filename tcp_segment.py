@@ -1,5 +1,5 @@
 import struct
-from typing import Optional
+from typing import List, Optional, Tuple
 
 from utils import checksum, inet_aton
 
@@ -13,9 +13,9 @@ from utils import checksum, inet_aton
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
     |                    Acknowledgment Number                      |
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
-    |  Data |           |U|A|P|R|S|F|                               |
-    | Offset| Reserved  |R|C|S|S|Y|I|            Window             |
-    |       |           |G|K|H|T|N|N|                               |
+    |  Data |       |C|E|U|A|P|R|S|F|                               |
+    | Offset| Rsrvd |W|C|R|C|S|S|Y|I|            Window             |
+    |       |       |R|E|G|K|H|T|N|N|                               |
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
     |           Checksum            |         Urgent Pointer        |
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
@@ -28,6 +28,23 @@ from utils import checksum, inet_aton
 TCP_HEADER_LENGTH = 20
 IPPROTO_TCP = 6
 
+TCP_MAX_OPTIONS_LENGTH = 40
+
+TCPOPT_EOL = 0
+TCPOPT_NOP = 1
+TCPOPT_MSS = 2
+TCPOPT_WSCALE = 3
+TCPOPT_SACK_PERM = 4
+TCPOPT_SACK = 5
+TCPOPT_TIMESTAMP = 8
+TCPOLEN_TIMESTAMP_ALIGNED = 12
+
+_MSS_OPT = struct.Struct('!BBH')
+_WSCALE_OPT = struct.Struct('!BBBB')
+_TS_OPT = struct.Struct('!BBBBII')
+_SACK_BLOCK = struct.Struct('!II')
+_TS_VALUES = struct.Struct('!II')
+
 
 def tcp_checksum(src_ip: str, dst_ip: str, tcp_header: bytes, tcp_data: bytes):
     if not src_ip or not dst_ip:
@@ -41,6 +58,112 @@ def tcp_checksum(src_ip: str, dst_ip: str, tcp_header: bytes, tcp_data: bytes):
     return checksum(pseudo_header + tcp_header + tcp_data)
 
 
+class TcpOptions:
+    """
+    Decoded TCP options, None/False/empty when an option is absent.
+
+    sack_blocks holds (left edge, right edge) pairs of wrapped seqnos.
+    """
+    __slots__ = ('mss', 'wscale', 'sack_permitted', 'ts_val', 'ts_ecr', 'sack_blocks')
+
+    def __init__(
+        self,
+        mss: Optional[int] = None,
+        wscale: Optional[int] = None,
+        sack_permitted: bool = False,
+        ts_val: Optional[int] = None,
+        ts_ecr: int = 0,
+        sack_blocks: Optional[List[Tuple[int, int]]] = None
+    ):
+        self.mss = mss
+        self.wscale = wscale
+        self.sack_permitted = sack_permitted
+        self.ts_val = ts_val
+        self.ts_ecr = ts_ecr
+        self.sack_blocks = sack_blocks if sack_blocks is not None else []
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, TcpOptions):
+            return NotImplemented
+        return all(getattr(self, f) == getattr(other, f) for f in self.__slots__)
+
+    def __repr__(self):
+        fields = ', '.join(f'{f}={getattr(self, f)!r}' for f in self.__slots__)
+        return f'TcpOptions({fields})'
+
+    @property
+    def empty(self) -> bool:
+        return (self.mss is None and self.wscale is None and
+                not self.sack_permitted and self.ts_val is None and
+                not self.sack_blocks)
+
+    def serialize(self) -> bytes:
+        """
+        Encode in the same order and alignment as Linux, padded to 4 bytes
+        """
+        if self.empty:
+            return b''
+        parts = []
+        if self.mss is not None:
+            parts.append(_MSS_OPT.pack(TCPOPT_MSS, 4, self.mss))
+        if self.ts_val is not None:
+            if self.sack_permitted:
+                parts.append(_TS_OPT.pack(
+                    TCPOPT_SACK_PERM, 2, TCPOPT_TIMESTAMP, 10, self.ts_val, self.ts_ecr))
+            else:
+                parts.append(_TS_OPT.pack(
+                    TCPOPT_NOP, TCPOPT_NOP, TCPOPT_TIMESTAMP, 10, self.ts_val, self.ts_ecr))
+        elif self.sack_permitted:
+            parts.append(bytes((TCPOPT_NOP, TCPOPT_NOP, TCPOPT_SACK_PERM, 2)))
+        if self.wscale is not None:
+            parts.append(_WSCALE_OPT.pack(TCPOPT_NOP, TCPOPT_WSCALE, 3, self.wscale))
+        if self.sack_blocks:
+            used = sum(len(p) for p in parts)
+            n = min(len(self.sack_blocks), (TCP_MAX_OPTIONS_LENGTH - used - 4) // 8)
+            if n > 0:
+                parts.append(bytes((TCPOPT_NOP, TCPOPT_NOP, TCPOPT_SACK, 2 + 8 * n)))
+                for left, right in self.sack_blocks[:n]:
+                    parts.append(_SACK_BLOCK.pack(left, right))
+        data = b''.join(parts)
+        if len(data) % 4:
+            data += bytes(4 - len(data) % 4)
+        return data
+
+    @classmethod
+    def deserialize(cls, data: bytes) -> 'TcpOptions':
+        """
+        Unknown options are skipped, a malformed length ends parsing
+        """
+        opts = cls()
+        i = 0
+        end = len(data)
+        while i < end:
+            kind = data[i]
+            if kind == TCPOPT_EOL:
+                break
+            if kind == TCPOPT_NOP:
+                i += 1
+                continue
+            if i + 1 >= end:
+                break
+            length = data[i + 1]
+            if length < 2 or i + length > end:
+                break
+            if kind == TCPOPT_MSS and length == 4:
+                opts.mss = (data[i + 2] << 8) | data[i + 3]
+            elif kind == TCPOPT_WSCALE and length == 3:
+                opts.wscale = data[i + 2]
+            elif kind == TCPOPT_SACK_PERM and length == 2:
+                opts.sack_permitted = True
+            elif kind == TCPOPT_TIMESTAMP and length == 10:
+                opts.ts_val, opts.ts_ecr = _TS_VALUES.unpack_from(data, i + 2)
+            elif kind == TCPOPT_SACK and length >= 10 and (length - 2) % 8 == 0:
+                opts.sack_blocks = [_SACK_BLOCK.unpack_from(data, j)
+                                    for j in range(i + 2, i + length, 8)]
+            i += length
+        return opts
+
+
 class TcpHeader:
     def __init__(
         self,
@@ -49,6 +172,8 @@ class TcpHeader:
         seqno = 0,
         ackno = 0,
         doff = TCP_HEADER_LENGTH // 4,
+        cwr = False,
+        ece = False,
         urg = False,
         ack = False,
         psh = False,
@@ -57,13 +182,16 @@ class TcpHeader:
         fin = False,
         win = 0,
         cksum = 0,
-        uptr = 0
+        uptr = 0,
+        options: Optional[TcpOptions] = None
     ):
         self.sport = sport
         self.dport = dport
         self.seqno = seqno
         self.ackno = ackno
         self.doff = doff
+        self.cwr = cwr
+        self.ece = ece
         self.urg = urg
         self.ack = ack
         self.psh = psh
@@ -73,6 +201,7 @@ class TcpHeader:
         self.win = win
         self.cksum = cksum
         self.uptr = uptr
+        self.options = options if options is not None else TcpOptions()
 
     def serialize(
             self,
@@ -80,7 +209,9 @@ class TcpHeader:
             dst_ip: str,
             payload_data: bytes
         ):
-        flags = (self.urg << 5 | self.ack << 4 | self.psh << 3 | self.rst << 2 | self.syn << 1 | self.fin)
+        flags = (self.cwr << 7 | self.ece << 6 | self.urg << 5 | self.ack << 4 | self.psh << 3 | self.rst << 2 | self.syn << 1 | self.fin)
+        options = self.options.serialize()
+        self.doff = (TCP_HEADER_LENGTH + len(options)) // 4
 
         # Pack the header fields into a binary format
         header_data = struct.pack(
@@ -90,11 +221,11 @@ class TcpHeader:
             self.seqno,       # Sequence Number
             self.ackno,       # Acknowledgment Number
             (self.doff << 4) | 0,  # Data Offset (4 bits) and Reserved (4 bits)
-            flags,            # Flags (6 bits) and Reserved (2 bits)
+            flags,            # Flags (8 bits)
             self.win,         # Window
             0,                # Checksum
             self.uptr         # Urgent Pointer
-        )
+        ) + options
         cksum = tcp_checksum(src_ip, dst_ip, header_data, payload_data)
         self.cksum = cksum
         header_data = header_data[:16] + struct.pack('!H', cksum) + header_data[18:]
@@ -107,17 +238,24 @@ class TcpHeader:
         src_ip: str,
         dst_ip: str
     ) -> Optional['TcpHeader']:
-        header_data = data[:TCP_HEADER_LENGTH]
+        if len(data) < TCP_HEADER_LENGTH:
+            return None
+        header_len = (data[12] >> 4) * 4
+        if header_len < TCP_HEADER_LENGTH or header_len > len(data):
+            return None
+        header_data = data[:header_len]
         origin_header_data = header_data[:16] + b'\x00\x00' + header_data[18:]
-        payload_data = data[TCP_HEADER_LENGTH:]
+        payload_data = data[header_len:]
         expected_cksum = struct.unpack('!H', header_data[16:18])[0]
         cksum = tcp_checksum(src_ip, dst_ip, origin_header_data, payload_data)
         if cksum != expected_cksum:
             return None
 
-        fields = struct.unpack('!HHIIBBHHH', header_data)
+        fields = struct.unpack('!HHIIBBHHH', header_data[:TCP_HEADER_LENGTH])
         doff_reserved = fields[4]
         flags = fields[5]
+        cwr = bool(flags & 0x80)
+        ece = bool(flags & 0x40)
         urg = bool(flags & 0x20)
         ack = bool(flags & 0x10)
         psh = bool(flags & 0x08)
@@ -131,6 +269,8 @@ class TcpHeader:
         hdr.seqno = fields[2]
         hdr.ackno = fields[3]
         hdr.doff = doff_reserved >> 4
+        hdr.cwr = cwr
+        hdr.ece = ece
         hdr.urg = urg
         hdr.ack = ack
         hdr.psh = psh
@@ -140,6 +280,8 @@ class TcpHeader:
         hdr.win = fields[6]
         hdr.cksum = fields[7]
         hdr.uptr = fields[8]
+        if header_len > TCP_HEADER_LENGTH:
+            hdr.options = TcpOptions.deserialize(header_data[TCP_HEADER_LENGTH:])
 
         return hdr
 
@@ -156,6 +298,16 @@ class TcpSegment:
         self.payload = payload
         self.src_ip = src_ip
         self.dst_ip = dst_ip
+        # sender bookkeeping while queued for retransmission, never serialized
+        self.seqno_absolute = 0
+        self.sent_time = 0
+        self.sacked = False
+        self.lost = False
+        self.retransmitted = False
+        # ECN codepoint of the carrying IP datagram: ect asks the adapter to
+        # send ECT(0), ce is set by the adapter when the router marked CE
+        self.ect = False
+        self.ce = False
 
     def serialize(self) -> bytes:
         return self.header.serialize(self.src_ip, self.dst_ip, self.payload) + self.payload
@@ -170,7 +322,7 @@ class TcpSegment:
         header = TcpHeader.deserialize(data, src_ip, dst_ip)
         if not header:
             return None
-        payload = data[TCP_HEADER_LENGTH:]
+        payload = data[header.doff * 4:]
         seg = cls(header, payload, src_ip, dst_ip)
         return seg
 
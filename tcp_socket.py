@@ -1,6 +1,11 @@
+import asyncio
+import select
 import selectors
-from typing import Callable
-from threading import Thread
+import socket
+from collections import deque
+from copy import copy
+from typing import Callable, Deque
+from threading import Event, Thread
 from typing import Optional
 import os
 import random
@@ -10,21 +15,35 @@ from tcp_connection import TcpConnection
 from tcp_state import TcpState
 from config import TcpConfig, FdAdapterConfig
 from fd_adapter import FdAdapter,TcpOverIpv4OverTunAdapter
-from utils import timestamp_ms
+from ipv4 import IPv4Header
+from port_allocator import EphemeralPortAllocator
+from tcp_segment import TCP_HEADER_LENGTH
+from utils import UINT32_MAX, timestamp_ms
 
 TCP_TICK_MS = 10
+# 每次最多从 adapter 连续读取的数据段个数
+TCP_READ_BATCH = 16
 
 class TcpSocket:
-    def __init__(self, datagram_adapater: FdAdapter):
+    def __init__(self, datagram_adapater: FdAdapter, cfg: Optional[TcpConfig] = None):
         # self.thread_data = io.BytesIO()
         # r_fd,w_fd=os.pipe()
         self.thread_data = SocketPair()
         self._adapter = datagram_adapater
         self._loop = EventLoop()
         self._abort = False
-        self._cfg = TcpConfig()
-        self._tcp = TcpConnection(self._cfg)
+        self._cfg = cfg if cfg is not None else TcpConfig()
+        if self._cfg.mss is None and self._adapter.mtu:
+            # on a copy, the caller's config may be shared with other sockets
+            self._cfg = copy(self._cfg)
+            self._cfg.mss = self._adapter.mtu - IPv4Header.HEADER_LENGTH - TCP_HEADER_LENGTH
+        self._tcp = TcpConnection(self._cfg, random.randint(0, UINT32_MAX))
         self._tcp_thread: Optional[Thread] = None
+        # calls into the connection made by the application thread, run by
+        # the TCP thread so TcpConnection is only ever touched from there
+        self._commands: Deque[Callable[[], None]] = deque()
+        # set by the TCP thread once the connection is no longer active
+        self._finished = Event()
         # has tcp socket shutdown the incoming data?
         self.inbound_shutdown = False
         # has tcp socket shutdown the outcoming data?
@@ -47,13 +66,18 @@ class TcpSocket:
         self._tcp.set_listening()
         self._tcp_loop(lambda: self._tcp.state in [TcpState.LISTEN, TcpState.SYN_RECEIVED])
         # print(f'Successfully receive connection from {adapter_cfg.daddr}:{adapter_cfg.dport}')
-        self._tcp_thread = Thread(target=self._tcp_main, args=[self])
+        self._tcp_thread = Thread(target=self._tcp_main)
         self._tcp_thread.start()
 
     def _tcp_main(self):
         try:
             assert self._tcp
             self._tcp_loop(lambda:True)
+            if self._abort and self._tcp.active:
+                # close() gave up waiting, reset the connection
+                self._tcp.shutdown()
+                while self._tcp.segments_out:
+                    self._adapter.write(self._tcp.segments_out.popleft())
             os.close(self._adapter.fileno())
             self.thread_data.parent_sock.close()
             self.thread_data.child_sock.close()
@@ -62,10 +86,13 @@ class TcpSocket:
         except Exception as e:
             print(f"Exception in TCPConnection runner thread: {e}")
             raise
+        finally:
+            self._finished.set()
 
     def _tcp_loop(self, condition: Callable[[], bool]):
         base_time = timestamp_ms()
         while condition():
+            self._run_commands()
             ret = self._loop.wait_next_event(TCP_TICK_MS)
             if not ret or self._abort:
                 break
@@ -74,6 +101,12 @@ class TcpSocket:
                 self._tcp.tick(next_time - base_time)
                 self._adapter.tick(next_time - base_time)
                 base_time = next_time
+            if not self._tcp.active:
+                self._finished.set()
+
+    def _run_commands(self):
+        while self._commands:
+            self._commands.popleft()()
 
     def _init_tcp(self):
         """
@@ -82,9 +115,14 @@ class TcpSocket:
         """
         assert self._tcp
         def on_adapter_readable():
-            seg = self._adapter.read()
-            if seg:
-                self._tcp.segment_received(seg)
+            segs = []
+            for _ in range(TCP_READ_BATCH):
+                seg = self._adapter.read()
+                if seg:
+                    segs.append(seg)
+                if not select.select([self._adapter], [], [], 0)[0]:
+                    break
+            self._tcp.segments_received(segs)
             if self.thread_data.closed and self._tcp.bytes_in_flight == 0 and not self.fully_acked:
                 self.fully_acked = True
             # log("FSM","adapter -> tcp")
@@ -118,6 +156,13 @@ class TcpSocket:
             remaining_capacity = self._tcp.inbound_stream.remaining_capacity
             # data = self.thread_data.read(remaining_capacity)
             data = self.thread_data.recv(remaining_capacity)
+            # a cork() made before send() has to hold this data
+            self._run_commands()
+            if not data:
+                # close() shut down the application's end, after all it sent
+                self._tcp.shutdown_write()
+                self.outbound_shutdown = True
+                return
             amount_written = self._tcp.write(data)
             # log("FSM","thread -> tcp")
             if amount_written != len(data):
@@ -128,6 +173,8 @@ class TcpSocket:
                 self.outbound_shutdown = True
 
         def thread_read_cancelled():
+            if self.outbound_shutdown:
+                return
             self._tcp.shutdown_write()
             self.outbound_shutdown = True
 
@@ -152,6 +199,7 @@ class TcpSocket:
             buf = outbound.peek_output(amount_to_write)
             bytes_written = self.thread_data.send(buf)
             outbound.pop_output(bytes_written)
+            self._tcp.send_window_update()
             # log("FSM","tcp -> thread")
             if outbound.error or outbound.eof:
                 self.thread_data.close()
@@ -174,28 +222,75 @@ class TcpSocket:
     def recv(self, buf_size: int) -> bytes:
         return self.thread_data.child_sock.recv(buf_size)
 
-    def close(self):
-        self._tcp.shutdown_write()
-        while(self._tcp.active):
+    def set_nodelay(self, nodelay: bool):
+        """
+        TCP_NODELAY: send small segments at once instead of waiting for ACKs
+        """
+        self._commands.append(lambda: self._tcp.set_nodelay(nodelay))
+
+    def cork(self):
+        """
+        TCP_CORK: hold partial segments until uncork() for bulk writes.
+        Like set_nodelay(), applied by the TCP thread on its next tick
+        """
+        self._commands.append(self._tcp.cork)
+
+    def uncork(self):
+        self._commands.append(self._tcp.uncork)
+
+    def close(self, timeout: Optional[float] = None) -> bool:
+        """
+        Send the FIN and wait for the TCP thread to see the connection
+        finish. After timeout seconds the connection is reset instead.
+        Returns whether it finished before the timeout
+        """
+        # the TCP thread sends the FIN once it has read everything sent before
+        try:
+            self.thread_data.child_sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            # the TCP thread already closed the socketpair
             pass
+        finished = self._tcp_thread is None or self._finished.wait(timeout)
         self._abort=True
         if self._tcp_thread:
             self._tcp_thread.join()
+        return finished
+
+    async def aclose(self, timeout: Optional[float] = None) -> bool:
+        """
+        close() from a coroutine, waiting in an executor thread
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.close, timeout)
 
 class Address:
     def __init__(self, ip, port = 80):
         self.ip = ip
         self.port = port 
 
+# ports of FullTCPSockets in this process
+_ephemeral_ports = EphemeralPortAllocator()
+
+
 class FullTCPSocket(TcpSocket):
+    LOCAL_IP = "169.254.144.9"
+
     def __init__(self):
         super().__init__(TcpOverIpv4OverTunAdapter('tun144'))
-    
+        self._port: Optional[int] = None
+
     def connect(self,address:Address):
-        multiplexer_config=FdAdapterConfig(
-            saddr="169.254.144.9",
-            sport=random.randint(0, 65535),
+        self._port = _ephemeral_ports.allocate(self.LOCAL_IP, address.ip, address.port)
+        self._adapter.config = FdAdapterConfig(
+            saddr=self.LOCAL_IP,
+            sport=self._port,
             daddr=address.ip,
             dport=address.port
         )
-        super().connect(multiplexer_config)
+        super().connect()
+
+    def close(self, timeout: Optional[float] = None) -> bool:
+        finished = super().close(timeout)
+        if self._port is not None:
+            _ephemeral_ports.release(self._port)
+            self._port = None
+        return finished
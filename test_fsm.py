@@ -1,4 +1,6 @@
+import gc
 import unittest
+import weakref
 import select
 import random
 from math import ceil
@@ -568,6 +570,79 @@ class FsmTest(FsmTestBase):
         conn.tick(2*TcpConfig.MSL)
         self.assertEqual(conn.state, TcpState.CLOSED)
 
+    def test_half_close(self):
+        cap = 1000
+        sender_isn, receiver_isn = 10000, 20000
+        # the peer keeps sending after our FIN, its FIN comes with the last data
+        conn = self.new_eastablished_connection(cap, sender_isn, receiver_isn)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, seqno=receiver_isn+1, win=10)))
+        conn.shutdown_write()
+        self.expectSegment(conn, fin=True, seqno=sender_isn+1)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, seqno=receiver_isn+1, ackno=sender_isn+2), b'abc'))
+        self.assertEqual(conn.state, TcpState.FIN_WAIT_2)
+        self.expectSegment(conn, ack=True, ackno=receiver_isn+4)
+        conn.segment_received(TcpSegment(TcpHeader(fin=True, seqno=receiver_isn+4), b'de'))
+        self.expectSegment(conn, ack=True, ackno=receiver_isn+7)
+        self.assertEqual(conn.state, TcpState.TIME_WAIT)
+        self.assertEqual(conn.read(5), b'abcde')
+        self.assertTrue(conn.outbound_stream.eof)
+
+    def test_out_of_order_fin(self):
+        sender_isn, receiver_isn = 10000, 20000
+        # FIN_WAIT_1, our FIN acked: a FIN past a hole is not taken
+        conn = self.new_eastablished_connection(1000, sender_isn, receiver_isn)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, seqno=receiver_isn+1, ackno=sender_isn+1, win=10)))
+        conn.shutdown_write()
+        self.expectSegment(conn, fin=True, seqno=sender_isn+1)
+        conn.segment_received(TcpSegment(
+            TcpHeader(fin=True, ack=True, seqno=receiver_isn+6, ackno=sender_isn+2), b'fghij'))
+        self.assertEqual(conn.state, TcpState.FIN_WAIT_2)
+        self.expectSegment(conn, ack=True, ackno=receiver_isn+1)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, seqno=receiver_isn+1, ackno=sender_isn+2), b'abcde'))
+        self.expectSegment(conn, ack=True, ackno=receiver_isn+11)
+        conn.segment_received(TcpSegment(
+            TcpHeader(fin=True, ack=True, seqno=receiver_isn+6, ackno=sender_isn+2), b'fghij'))
+        self.expectSegment(conn, ack=True, ackno=receiver_isn+12)
+        self.assertEqual(conn.state, TcpState.TIME_WAIT)
+        self.assertEqual(conn.read(10), b'abcdefghij')
+
+        # FIN_WAIT_1, our FIN not acked yet: no CLOSING either
+        conn = self.new_eastablished_connection(1000, sender_isn, receiver_isn)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, seqno=receiver_isn+1, ackno=sender_isn+1, win=10)))
+        conn.shutdown_write()
+        self.expectSegment(conn, fin=True, seqno=sender_isn+1)
+        conn.segment_received(TcpSegment(TcpHeader(fin=True, seqno=receiver_isn+6), b'fghij'))
+        self.assertEqual(conn.state, TcpState.FIN_WAIT_1)
+        self.expectSegment(conn, ack=True, ackno=receiver_isn+1)
+        self.assertFalse(conn.outbound_stream.eof)
+
+    def test_simultaneous_close(self):
+        sender_isn, receiver_isn = 10000, 20000
+        # FIN_WAIT_1 -> (fin crossing ours) -> CLOSING -> (ack) -> TIME_WAIT
+        conn = self.new_eastablished_connection(1000, sender_isn, receiver_isn)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, seqno=receiver_isn+1, ackno=sender_isn+1, win=10)))
+        conn.shutdown_write()
+        self.expectSegment(conn, fin=True, seqno=sender_isn+1)
+        conn.segment_received(TcpSegment(TcpHeader(fin=True, ack=True, seqno=receiver_isn+1, ackno=sender_isn+1)))
+        self.assertEqual(conn.state, TcpState.CLOSING)
+        self.expectSegment(conn, ack=True, ackno=receiver_isn+2)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, seqno=receiver_isn+2, ackno=sender_isn+2)))
+        self.assertEqual(conn.state, TcpState.TIME_WAIT)
+        conn.tick(2*TcpConfig.MSL)
+        self.assertEqual(conn.state, TcpState.CLOSED)
+
+    def test_fin_waits_for_window(self):
+        sender_isn, receiver_isn = 10000, 20000
+        conn = self.new_eastablished_connection(1000, sender_isn, receiver_isn)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, seqno=receiver_isn+1, ackno=sender_isn+1, win=1)))
+        conn.write(b'ab')
+        conn.shutdown_write()
+        # a one byte window takes data, not the FIN
+        self.expectSegment(conn, fin=False, payload=b'a')
+        self.expectNoSegment(conn)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, seqno=receiver_isn+1, ackno=sender_isn+2, win=2)))
+        self.expectSegment(conn, fin=True, payload=b'b')
+
     def test_passive_close(self):
         cap = 1000
         sender_isn, receiver_isn = 10000, 20000
@@ -607,6 +682,38 @@ class FsmTest(FsmTestBase):
         conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=sender_isn+2)))
         self.assertEqual(conn.state, TcpState.CLOSED)           #CLOSED
 
+    def test_transition_counters(self):
+        cap = 1000
+        sender_isn, receiver_isn = 10000, 20000
+        conn = self.new_eastablished_connection(cap, sender_isn, receiver_isn)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, seqno=receiver_isn+1, win=10)))
+        conn.segment_received(TcpSegment(TcpHeader(fin=True, seqno=receiver_isn+1)))
+        # a retransmitted FIN is not a transition
+        conn.segment_received(TcpSegment(TcpHeader(fin=True, seqno=receiver_isn+1)))
+        conn.shutdown_write()
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=sender_isn+2)))
+        self.assertEqual(conn.state, TcpState.CLOSED)
+        self.assertEqual(dict(conn.transitions), {
+            (TcpState.CLOSED, TcpState.SYN_SENT): 1,
+            (TcpState.SYN_SENT, TcpState.ESTABLISHED): 1,
+            (TcpState.ESTABLISHED, TcpState.CLOSE_WAIT): 1,
+            (TcpState.CLOSE_WAIT, TcpState.LAST_ACK): 1,
+            (TcpState.LAST_ACK, TcpState.CLOSED): 1,
+        })
+
+    def test_freed_without_gc(self):
+        # no reference cycles: a dropped connection goes away at once
+        gc.disable()
+        try:
+            conn = self.new_eastablished_connection(1000, 10000, 20000)
+            conn.segment_received(TcpSegment(TcpHeader(ack=True, seqno=20001, ackno=10001, win=10)))
+            conn.write(b'hello')
+            ref = weakref.ref(conn)
+            del conn
+            self.assertIsNone(ref())
+        finally:
+            gc.enable()
+
     def tearDown(self):
         self.r_sock.close()
         self.w_sock.close()
@@ -0,0 +1,93 @@
+import unittest
+
+from config import FdAdapterConfig, TcpConfig
+from port_allocator import EphemeralPortAllocator
+from test_tcp_mux import MultiplexerTestBase, LOCAL_IP, REMOTE_IP
+
+
+class PortAllocatorTest(unittest.TestCase):
+    def test_exhausts_range(self):
+        ports = EphemeralPortAllocator((1000, 1099))
+        allocated = {ports.allocate(LOCAL_IP, REMOTE_IP, 80) for _ in range(100)}
+        self.assertEqual(allocated, set(range(1000, 1100)))
+        self.assertEqual(len(ports), 100)
+        with self.assertRaises(RuntimeError):
+            ports.allocate(LOCAL_IP, REMOTE_IP, 80)
+        ports.release(1042)
+        self.assertNotIn(1042, ports)
+        self.assertEqual(ports.allocate(LOCAL_IP, REMOTE_IP, 80), 1042)
+
+    def test_per_destination_offset(self):
+        ports = EphemeralPortAllocator(secret=b's' * 16)
+        other = EphemeralPortAllocator(secret=b's' * 16)
+        # the first port for a destination does not depend on other destinations
+        ports.allocate(LOCAL_IP, REMOTE_IP, 443)
+        self.assertEqual(ports.allocate(LOCAL_IP, REMOTE_IP, 80),
+                         other.allocate(LOCAL_IP, REMOTE_IP, 80) + 1)
+        first = EphemeralPortAllocator(secret=b't' * 16).allocate(LOCAL_IP, REMOTE_IP, 80)
+        self.assertNotEqual(first, other.allocate(LOCAL_IP, REMOTE_IP, 443) - 1)
+
+    def test_skips_ports_in_use(self):
+        ports = EphemeralPortAllocator((1000, 1009))
+        busy = set(range(1000, 1009))
+        self.assertEqual(ports.allocate(LOCAL_IP, REMOTE_IP, 80, lambda port: port in busy), 1009)
+        with self.assertRaises(RuntimeError):
+            ports.allocate(LOCAL_IP, REMOTE_IP, 80, lambda port: port in busy)
+
+    def test_invalid_range(self):
+        with self.assertRaises(ValueError):
+            EphemeralPortAllocator((0, 100))
+
+
+class MultiplexerPortsTest(MultiplexerTestBase):
+    def close_all(self, conns):
+        for conn in conns:
+            self.mux.shutdown_write(conn)
+        self.exchange()
+        # local port of the connection to each peer
+        local_ports = {self.mux.address(conn)[3]: self.mux.address(conn)[1] for conn in conns}
+        replies = []
+        for port, peer in self.peers.items():
+            peer.shutdown_write()
+            while peer.segments_out:
+                reply = peer.segments_out.popleft()
+                reply.header.sport, reply.header.dport = port, local_ports[port]
+                reply.src_ip, reply.dst_ip = REMOTE_IP, LOCAL_IP
+                replies.append(reply)
+        self.mux.segments_received(replies)
+        self.exchange()
+        self.peers.clear()
+
+    def test_churn(self):
+        self.mux._ports = EphemeralPortAllocator((40000, 40063))
+        # each round takes the whole range, the ports are free again once
+        # the previous round's connections are in TIME_WAIT
+        for n in range(4):
+            conns = [self.mux.connect(FdAdapterConfig(
+                saddr=LOCAL_IP, daddr=REMOTE_IP, dport=1000 + 64 * n + i))
+                for i in range(64)]
+            self.assertEqual({self.mux.address(conn)[1] for conn in conns},
+                             set(range(40000, 40064)))
+            self.exchange()
+            self.close_all(conns)
+            self.assertEqual(len(self.mux), 0)
+
+    def test_avoids_time_wait(self):
+        self.mux._ports = EphemeralPortAllocator((40000, 40001))
+        addr = FdAdapterConfig(saddr=LOCAL_IP, daddr=REMOTE_IP, dport=80)
+        first = self.mux.connect(addr)
+        port = self.mux.address(first)[1]
+        self.exchange()
+        self.close_all([first])
+        self.assertTrue(self.mux.in_time_wait((LOCAL_IP, port, REMOTE_IP, 80)))
+        second = self.mux.connect(addr)
+        self.assertNotEqual(self.mux.address(second)[1], port)
+        with self.assertRaises(RuntimeError):
+            self.mux.connect(addr)
+        # another destination may share the port in TIME_WAIT
+        other = self.mux.connect(FdAdapterConfig(saddr=LOCAL_IP, daddr=REMOTE_IP, dport=81))
+        self.assertEqual(self.mux.address(other)[1], port)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 import random
+import threading
 import unittest
 from typing import Optional
 
@@ -310,6 +311,222 @@ class ReceiverWindowTest(ReceiverTestBase):
         self.assertEqual(conn.assembled_bytes, 3)
         self.assertEqual(conn.window_size, cap-3)
 
+    def test_window_update_on_read(self):
+        cap = 4000
+        isn = 1000
+        mss = TcpConfig.MAX_PAYLOAD_SIZE
+        conn = self.new_eastablished_connection(cap, isn)
+        for i in range(cap // mss):
+            conn.segment_received(TcpSegment(TcpHeader(seqno=isn+1+i*mss), b'x' * mss))
+            self.expectSegment(conn, ack=True, win=cap-(i+1)*mss)
+        # small reads do not announce a sliver of window
+        conn.read(mss // 2)
+        self.expectNoSegment(conn)
+        conn.segment_received(TcpSegment(TcpHeader(seqno=isn+1+cap+10), b'y'))
+        self.expectSegment(conn, ack=True, ackno=isn+1+cap, win=0)
+        # once it has opened by an MSS the peer is told
+        conn.read(mss // 2)
+        self.expectSegment(conn, ack=True, ackno=isn+1+cap, win=mss)
+        self.expectNoSegment(conn)
+        conn.read(1)
+        self.expectNoSegment(conn)
+
+
+class ReceiverDelayedAckTest(ReceiverTestBase):
+    def new_delayed_ack_connection(self, isn: int) -> TcpConnection:
+        cfg = TcpConfig()
+        cfg.delayed_ack = True
+        conn = TcpConnection(cfg, sender_isn=isn)
+        conn.set_listening()
+        conn.segment_received(TcpSegment(TcpHeader(syn=True, seqno=isn)))
+        self.expectSegment(conn, syn=True, ack=True)
+        conn.segment_received(TcpSegment(
+            TcpHeader(ack=True, seqno=uint32_plus(isn, 1), ackno=uint32_plus(isn, 1), win=10)))
+        self.assertEqual(conn.state, TcpState.ESTABLISHED)
+        return conn
+
+    def test_quickack_then_delay(self):
+        isn = 1000
+        mss = TcpConfig.MAX_PAYLOAD_SIZE
+        conn = self.new_delayed_ack_connection(isn)
+        offset = 0
+        for _ in range(TcpConfig.QUICKACK_SEGMENTS):
+            conn.segment_received(TcpSegment(TcpHeader(seqno=isn+1+offset), b'a'))
+            offset += 1
+            self.expectSegment(conn, ack=True, ackno=isn+1+offset)
+        # small in-order segment waits for the delayed ACK timer
+        conn.segment_received(TcpSegment(TcpHeader(seqno=isn+1+offset), b'b'))
+        offset += 1
+        self.expectNoSegment(conn)
+        conn.tick(TcpConfig.DELACK_TIMEOUT - 1)
+        self.expectNoSegment(conn)
+        conn.tick(1)
+        self.expectSegment(conn, ack=True, ackno=isn+1+offset)
+        self.expectNoSegment(conn)
+        # every second full-sized segment is acknowledged right away
+        conn.segment_received(TcpSegment(TcpHeader(seqno=isn+1+offset), b'x' * mss))
+        offset += mss
+        self.expectNoSegment(conn)
+        conn.segment_received(TcpSegment(TcpHeader(seqno=isn+1+offset), b'y' * mss))
+        offset += mss
+        self.expectSegment(conn, ack=True, ackno=isn+1+offset)
+        self.expectNoSegment(conn)
+
+    def test_out_of_order_and_fin_ack_immediately(self):
+        isn = 1000
+        conn = self.new_delayed_ack_connection(isn)
+        conn._quickack = 0
+        conn.segment_received(TcpSegment(TcpHeader(seqno=isn+3), b'c'))
+        self.expectSegment(conn, ack=True, ackno=isn+1)
+        conn.segment_received(TcpSegment(TcpHeader(seqno=isn+1), b'ab'))
+        self.expectSegment(conn, ack=True, ackno=isn+4)
+        conn.segment_received(TcpSegment(TcpHeader(seqno=isn+4, fin=True)))
+        self.expectSegment(conn, ack=True, ackno=isn+5)
+        self.assertEqual(conn.state, TcpState.CLOSE_WAIT)
+
+    def test_batch_coalesces_acks(self):
+        isn = 1000
+        conn = self.new_eastablished_connection(4000, isn)
+        conn.segments_received([
+            TcpSegment(TcpHeader(seqno=isn+1), b'ab'),
+            TcpSegment(TcpHeader(seqno=isn+5), b'ef'),
+            TcpSegment(TcpHeader(seqno=isn+3), b'cd'),
+        ])
+        self.expectSegment(conn, ack=True, ackno=isn+7)
+        self.expectNoSegment(conn)
+        self.expectBytes(conn, b'abcdef')
+
+
+class ReceiverAutotuningTest(ReceiverTestBase):
+    def setUp(self):
+        self._rmem_allocated = TcpConnection._rmem_allocated
+
+    def tearDown(self):
+        TcpConnection._rmem_allocated = self._rmem_allocated
+
+    def new_autotuning_connection(self, isn: int, cfg: TcpConfig) -> TcpConnection:
+        cfg.recv_capacity = 4000
+        cfg.rcvbuf_autotuning = True
+        conn = TcpConnection(cfg, sender_isn=isn)
+        conn.set_listening()
+        conn.segment_received(TcpSegment(TcpHeader(syn=True, seqno=isn)))
+        self.expectSegment(conn, syn=True, ack=True, win=4000)
+        conn.segment_received(TcpSegment(
+            TcpHeader(ack=True, seqno=uint32_plus(isn, 1), ackno=uint32_plus(isn, 1), win=10)))
+        self.assertEqual(conn.state, TcpState.ESTABLISHED)
+        return conn
+
+    def fill_and_read(self, conn: TcpConnection, isn: int, offset: int, size: int):
+        mss = TcpConfig.MAX_PAYLOAD_SIZE
+        for i in range(0, size, mss):
+            conn.segment_received(TcpSegment(TcpHeader(seqno=isn+1+offset+i), b'x' * mss))
+            self.expectSegment(conn, ack=True)
+        conn.tick(TcpConfig.TIMEOUT_DFLT)
+        self.assertEqual(len(conn.read(size)), size)
+
+    def test_grows_with_read_rate(self):
+        isn = 1000
+        cfg = TcpConfig()
+        cfg.recv_capacity_max = 10000
+        conn = self.new_autotuning_connection(isn, cfg)
+        self.fill_and_read(conn, isn, 0, 4000)
+        self.expectSegment(conn, ack=True, ackno=isn+1+4000, win=8000)
+        self.fill_and_read(conn, isn, 4000, 8000)
+        self.expectSegment(conn, ack=True, ackno=isn+1+12000, win=10000)
+        # a slow reader does not grow the buffer
+        conn.segment_received(TcpSegment(TcpHeader(seqno=isn+1+12000), b'x' * 1000))
+        self.expectSegment(conn, ack=True, win=9000)
+        conn.tick(TcpConfig.TIMEOUT_DFLT)
+        conn.read(1000)
+        self.assertEqual(conn.window_size, 10000)
+
+    def test_shrinks_under_memory_pressure(self):
+        isn = 1000
+        cfg = TcpConfig()
+        cfg.recv_memory_limit = 6000
+        conn = self.new_autotuning_connection(isn, cfg)
+        self.fill_and_read(conn, isn, 0, 4000)
+        self.expectSegment(conn, ack=True, win=8000)
+        self.assertEqual(TcpConnection._rmem_allocated, self._rmem_allocated + 4000)
+        # other connections push the total over the limit
+        TcpConnection._rmem_allocated += 10000
+        self.fill_and_read(conn, isn, 4000, 8000)
+        self.expectSegment(conn, ack=True, ackno=isn+1+12000, win=4000)
+        self.assertEqual(TcpConnection._rmem_allocated, self._rmem_allocated + 10000)
+
+    def test_shrinks_without_reads(self):
+        isn = 1000
+        cfg = TcpConfig()
+        cfg.recv_memory_limit = 6000
+        conn = self.new_autotuning_connection(isn, cfg)
+        self.fill_and_read(conn, isn, 0, 4000)
+        self.expectSegment(conn, ack=True, win=8000)
+        # the peer fills the window and closes; the application's last read
+        # grows the buffer past the limit, then it stops reading
+        mss = TcpConfig.MAX_PAYLOAD_SIZE
+        for i in range(0, 8000, mss):
+            conn.segment_received(TcpSegment(TcpHeader(seqno=isn+1+4000+i), b'x' * mss))
+            self.expectSegment(conn, ack=True)
+        conn.segment_received(TcpSegment(TcpHeader(fin=True, seqno=isn+1+12000)))
+        self.expectSegment(conn, ack=True, ackno=isn+1+12000+1, win=0)
+        conn.tick(TcpConfig.TIMEOUT_DFLT)
+        self.assertEqual(len(conn.read(8000)), 8000)
+        self.assertEqual(conn._recv_capacity, 16000)
+        self.assertGreater(TcpConnection._rmem_allocated, cfg.recv_memory_limit)
+        conn.tick(1)
+        self.assertEqual(conn._recv_capacity, 4000)
+        self.assertEqual(TcpConnection._rmem_allocated, self._rmem_allocated)
+
+    def test_memory_total_updated_under_lock(self):
+        conn = self.new_autotuning_connection(1000, TcpConfig())
+        # connections on other TcpSocket threads wait for the lock
+        with TcpConnection._mem_lock:
+            grow = threading.Thread(target=conn._set_recv_capacity, args=[8000])
+            grow.start()
+            grow.join(0.1)
+            self.assertTrue(grow.is_alive())
+            self.assertEqual(TcpConnection._rmem_allocated, self._rmem_allocated)
+        grow.join(5)
+        self.assertEqual(TcpConnection._rmem_allocated, self._rmem_allocated + 4000)
+        conn._release_buffer_memory()
+        self.assertEqual(TcpConnection._rmem_allocated, self._rmem_allocated)
+
+
+class ReceiverHeaderPredictionTest(ReceiverTestBase):
+    def run_script(self, header_prediction: bool):
+        isn, isn2 = 1000, 5000
+        cfg = TcpConfig()
+        cfg.header_prediction = header_prediction
+        conn = TcpConnection(cfg, sender_isn=isn2)
+        conn.set_listening()
+        conn.segment_received(TcpSegment(TcpHeader(syn=True, seqno=isn, win=4000)))
+        conn.segment_received(TcpSegment(
+            TcpHeader(ack=True, seqno=isn+1, ackno=isn2+1, win=4000)))
+        conn.write(b'0123456789')
+        script = [
+            # in-order data
+            TcpSegment(TcpHeader(ack=True, seqno=isn+1, ackno=isn2+1, win=4000), b'abc'),
+            # pure ACK of new data
+            TcpSegment(TcpHeader(ack=True, seqno=isn+4, ackno=isn2+5, win=4000)),
+            # duplicate ACK, window change, out-of-order and hole filling data
+            TcpSegment(TcpHeader(ack=True, seqno=isn+4, ackno=isn2+5, win=4000)),
+            TcpSegment(TcpHeader(ack=True, seqno=isn+4, ackno=isn2+7, win=3000)),
+            TcpSegment(TcpHeader(ack=True, seqno=isn+6, ackno=isn2+7, win=3000), b'fg'),
+            TcpSegment(TcpHeader(ack=True, seqno=isn+4, ackno=isn2+7, win=3000), b'de'),
+            TcpSegment(TcpHeader(ack=True, seqno=isn+8, ackno=isn2+11, win=3000), b'hij'),
+            TcpSegment(TcpHeader(ack=True, fin=True, seqno=isn+11, ackno=isn2+11, win=3000)),
+        ]
+        for seg in script:
+            conn.segment_received(seg)
+        self.expectBytes(conn, b'abcdefghij')
+        self.assertEqual(conn.state, TcpState.CLOSE_WAIT)
+        self.assertEqual(conn.bytes_in_flight, 0)
+        return [(seg.header.seqno, seg.header.ackno, seg.header.win, seg.header.syn,
+                 seg.header.fin, seg.payload) for seg in conn.segments_out]
+
+    def test_same_segments_as_slow_path(self):
+        self.assertEqual(self.run_script(True), self.run_script(False))
+
 
 if __name__ == '__main__':
     unittest.main()
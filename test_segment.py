@@ -1,6 +1,7 @@
 import unittest
 from tcp_segment import *
 from ipv4 import *
+from utils import UINT32_MAX
 
 
 class TestSegment(unittest.TestCase):
@@ -29,6 +30,52 @@ class TestSegment(unittest.TestCase):
                 self.assertEqual(v, seg2.header.__dict__[f])
             self.assertEqual(seg.payload, seg2.payload)
 
+    def test_window_scale_option(self):
+        header = TcpHeader(sport=1, dport=2, seqno=3, syn=True, win=65535, options=TcpOptions(wscale=7))
+        seg = TcpSegment(header, b'data', '10.0.0.1', '10.0.0.2')
+        data = seg.serialize()
+        self.assertEqual(header.doff, 6)
+        seg2 = TcpSegment.deserialize(data, '10.0.0.1', '10.0.0.2')
+        assert seg2
+        self.assertEqual(seg2.header.options.wscale, 7)
+        self.assertEqual(seg2.header.doff, 6)
+        self.assertEqual(seg2.payload, b'data')
+
+    def test_options(self):
+        cases = [
+            TcpOptions(mss=1460, sack_permitted=True, ts_val=1, ts_ecr=0, wscale=7),
+            TcpOptions(mss=536, ts_val=UINT32_MAX, ts_ecr=12345),
+            TcpOptions(sack_permitted=True, wscale=0),
+            TcpOptions(ts_val=5, ts_ecr=6, sack_blocks=[(100, 200), (300, 400), (500, 600)]),
+            TcpOptions(sack_blocks=[(1, 2), (3, 4), (5, 6), (7, 8)]),
+        ]
+        for opts in cases:
+            header = TcpHeader(sport=1, dport=2, seqno=3, ack=True, options=opts)
+            data = TcpSegment(header, b'payload', '10.0.0.1', '10.0.0.2').serialize()
+            self.assertEqual(header.doff * 4, len(data) - len(b'payload'))
+            self.assertLessEqual(header.doff, 15)
+            seg = TcpSegment.deserialize(data, '10.0.0.1', '10.0.0.2')
+            assert seg
+            self.assertEqual(seg.header.options, opts)
+            self.assertEqual(seg.header.doff, header.doff)
+            self.assertEqual(seg.payload, b'payload')
+
+    def test_ecn_flags(self):
+        for cwr, ece in ((True, True), (False, True), (True, False)):
+            header = TcpHeader(sport=1, dport=2, seqno=3, syn=True, cwr=cwr, ece=ece)
+            data = TcpSegment(header, b'', '10.0.0.1', '10.0.0.2').serialize()
+            self.assertEqual(data[13], cwr << 7 | ece << 6 | 0x02)
+            seg = TcpSegment.deserialize(data, '10.0.0.1', '10.0.0.2')
+            assert seg
+            self.assertEqual((seg.header.cwr, seg.header.ece, seg.header.syn), (cwr, ece, True))
+
+    def test_unknown_options_skipped(self):
+        raw = bytes([TCPOPT_NOP, 30, 4, 0xab, 0xcd, TCPOPT_WSCALE, 3, 9, TCPOPT_EOL, 0, 0, 0])
+        opts = TcpOptions.deserialize(raw)
+        self.assertEqual(opts, TcpOptions(wscale=9))
+        # a truncated option ends parsing without raising
+        self.assertEqual(TcpOptions.deserialize(bytes([TCPOPT_MSS, 4, 5])), TcpOptions())
+
     def test_checksum(self):
         seg = TcpSegment(
             TcpHeader(
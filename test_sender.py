@@ -1,15 +1,54 @@
 import unittest
 import random
+from collections import deque
+from typing import Any, Dict, Optional, Tuple
 
 from config import TcpConfig
+from fd_adapter import TcpOverIpv4OverTunAdapter
+from ipv4 import IPv4Datagram
 from tcp_connection import TcpConnection
-from tcp_segment import TcpHeader, TcpSegment
+from tcp_segment import TcpHeader, TcpOptions, TcpSegment
 from tcp_state import TcpState
 from utils import UINT32_MAX, uint32_plus
 from test_receiver import TcpTestBase
 
 
+def connected_pair(
+    rtt: int = 0,
+    peer_overrides: Optional[Dict[str, Any]] = None,
+    **overrides
+) -> Tuple[TcpConnection, TcpConnection]:
+    """
+    a connected to b by a three-way handshake, with the TcpConfig
+    attributes in overrides set on both sides and those in peer_overrides
+    on b only. a's clock advances by rtt / 2 on each leg
+    """
+    cfg = TcpConfig()
+    for name, value in overrides.items():
+        setattr(cfg, name, value)
+    peer_cfg = TcpConfig()
+    for name, value in {**overrides, **(peer_overrides or {})}.items():
+        setattr(peer_cfg, name, value)
+    a = TcpConnection(cfg, 1000)
+    b = TcpConnection(peer_cfg, 5000)
+    b.set_listening()
+    a.connect()
+    for src, dst in ((a, b), (b, a), (a, b)):
+        if rtt:
+            a.tick(rtt // 2)
+        while src.segments_out:
+            dst.segment_received(src.segments_out.popleft())
+    return a, b
+
+
 class SenderTestBase(TcpTestBase):
+    def connected_pair(self, rtt: int = 0, peer_overrides: Optional[Dict[str, Any]] = None,
+                       **overrides) -> Tuple[TcpConnection, TcpConnection]:
+        a, b = connected_pair(rtt, peer_overrides, **overrides)
+        self.assertEqual(a.state, TcpState.ESTABLISHED)
+        self.assertEqual(b.state, TcpState.ESTABLISHED)
+        return a, b
+
     def new_closed_connection(
         self,
         capacity: int,
@@ -269,7 +308,22 @@ class SenderTransmit(SenderTestBase):
         self.assertEqual(conn.bytes_in_flight, 3)
         self.expectSegment(conn, ack=True, payload=b'2')
         self.expectNoSegment(conn)
-        self.assertEqual(conn.next_seqno, isn+1+3)     
+        self.assertEqual(conn.next_seqno, isn+1+3)
+
+    def test_in_flight_across_wrap(self):
+        isn, isn2 = UINT32_MAX - 5, 20000
+        conn = self.new_eastablished_connection(1000, isn, isn2)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=uint32_plus(isn, 1), win=100)))
+        for data in (b'abcd', b'efgh', b'ijkl'):
+            conn.write(data)
+            self.expectSegment(conn, ack=True, payload=data)
+        self.assertEqual([seg.seqno_absolute for seg in conn._outgoing_segments], [1, 5, 9])
+        self.assertEqual(conn.bytes_in_flight, 12)
+        # the second segment ends past the 32-bit wrap
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=uint32_plus(isn, 9), win=100)))
+        self.assertEqual(conn.bytes_in_flight, 4)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=uint32_plus(isn, 13), win=100)))
+        self.assertEqual(conn.bytes_in_flight, 0)
 
 class SenderACK(SenderTestBase):
     def test_repeat_ACK(self):
@@ -320,6 +374,729 @@ class SenderACK(SenderTestBase):
         self.assertEqual(conn.next_seqno, isn+2)
         self.expectNoSegment(conn)
 
+class SenderWindowScale(SenderTestBase):
+    def test_scaled_windows(self):
+        isn, isn2 = 10000, 20000
+        cfg = TcpConfig()
+        cfg.recv_capacity = 4 * 1024 * 1024
+        cfg.send_capacity = 4 * 1024 * 1024
+        conn = TcpConnection(cfg, isn)
+        conn.connect()
+        seg = self.expectSegment(conn, syn=True, win=0xffff)
+        self.assertEqual(seg.header.options.wscale, 7)
+        conn.segment_received(TcpSegment(
+            TcpHeader(syn=True, ack=True, ackno=isn+1, seqno=isn2, win=1000, options=TcpOptions(wscale=3))))
+        self.assertEqual(conn.state, TcpState.ESTABLISHED)
+        self.expectSegment(conn, ack=True, win=cfg.recv_capacity >> 7)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=isn+1, win=20000)))
+        self.assertEqual(conn.available_receiver_space, 20000 << 3)
+        data = b'x' * 100000
+        self.assertEqual(conn.write(data), len(data))
+        self.assertEqual(conn.bytes_in_flight, len(data))
+
+    def test_peer_without_window_scale(self):
+        isn, isn2 = 10000, 20000
+        cfg = TcpConfig()
+        cfg.recv_capacity = 4 * 1024 * 1024
+        conn = TcpConnection(cfg, isn)
+        conn.connect()
+        self.expectSegment(conn, syn=True)
+        conn.segment_received(TcpSegment(
+            TcpHeader(syn=True, ack=True, ackno=isn+1, seqno=isn2, win=1000)))
+        self.expectSegment(conn, ack=True, win=0xffff)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=isn+1, win=20000)))
+        self.assertEqual(conn.available_receiver_space, 20000)
+
+
+class SenderMss(SenderTestBase):
+    def established(self, cfg: TcpConfig, peer_mss, isn=10000, isn2=20000) -> TcpConnection:
+        conn = TcpConnection(cfg, isn)
+        conn.connect()
+        conn.segment_received(TcpSegment(TcpHeader(
+            syn=True, ack=True, ackno=isn+1, seqno=isn2, win=60000,
+            options=TcpOptions(mss=peer_mss))))
+        conn.segments_out.clear()
+        return conn
+
+    def test_mss_negotiation(self):
+        cfg = TcpConfig()
+        cfg.mss = 1460
+        conn = TcpConnection(cfg, 10000)
+        conn.connect()
+        seg = self.expectSegment(conn, syn=True)
+        self.assertEqual(seg.header.options.mss, 1460)
+        conn = self.established(cfg, 1200)
+        conn.write(b'x' * 3000)
+        self.expectSegment(conn, payload_size=1200)
+        self.expectSegment(conn, payload_size=1200)
+        self.expectSegment(conn, payload_size=600)
+
+    def test_mtu_probing(self):
+        isn = 10000
+        cfg = TcpConfig()
+        cfg.mss = 1460
+        cfg.mtu_probing = True
+        conn = self.established(cfg, 1460, isn)
+        base = TcpConfig.MTU_PROBE_BASE_MSS
+        probe = (base + 1460 + 1) // 2
+        conn.write(b'x' * probe)
+        self.expectSegment(conn, payload_size=probe)
+        self.expectNoSegment(conn)
+        # probe acknowledged: it becomes the new segment size
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=isn+1+probe, win=60000)))
+        self.assertEqual(conn._max_payload_size, probe)
+        next_probe = (probe + 1460 + 1) // 2
+        conn.write(b'y' * next_probe)
+        self.expectSegment(conn, payload_size=next_probe)
+        self.expectNoSegment(conn)
+        # probe lost: it is resent at once in segments of the size known to work
+        rto = conn._rto
+        conn.tick(rto)
+        self.expectSegment(conn, seqno=isn+1+probe, payload_size=probe)
+        self.expectSegment(conn, seqno=isn+1+2*probe, payload_size=next_probe-probe)
+        self.expectNoSegment(conn)
+        # and it is not taken for congestion
+        self.assertEqual(conn._rto, rto)
+        self.assertEqual(conn.consecutive_retransmissions, 0)
+        self.assertEqual(conn.bytes_in_flight, next_probe)
+        self.assertEqual(conn._mtu_probe_high, next_probe - 1)
+        conn.segment_received(TcpSegment(TcpHeader(
+            ack=True, ackno=isn+1+2*probe, win=60000)))
+        self.assertEqual(conn.bytes_in_flight, next_probe - probe)
+
+    def test_probe_loss_keeps_cwnd(self):
+        isn = 10000
+        cfg = TcpConfig()
+        cfg.mss = 1460
+        cfg.mtu_probing = True
+        cfg.congestion_control = True
+        conn = self.established(cfg, 1460, isn)
+        probe = (TcpConfig.MTU_PROBE_BASE_MSS + 1460 + 1) // 2
+        conn.write(b'x' * probe)
+        self.expectSegment(conn, payload_size=probe)
+        cwnd, ssthresh = conn._cwnd, conn._ssthresh
+        conn.tick(conn._rto)
+        self.expectSegment(conn, payload_size=TcpConfig.MTU_PROBE_BASE_MSS)
+        self.expectSegment(conn, payload_size=probe - TcpConfig.MTU_PROBE_BASE_MSS)
+        self.expectNoSegment(conn)
+        self.assertEqual((conn._cwnd, conn._ssthresh), (cwnd, ssthresh))
+        self.assertEqual(conn._lost_out, 0)
+
+    def test_probe_not_fragmented(self):
+        cfg = TcpConfig()
+        cfg.mss = 1460
+        cfg.mtu_probing = True
+        conn = self.established(cfg, 1460)
+        probe_size = (TcpConfig.MTU_PROBE_BASE_MSS + 1460 + 1) // 2
+        conn.write(b'x' * probe_size)
+        probe = self.expectSegment(conn, payload_size=probe_size)
+        dgram = IPv4Datagram.deserialize(TcpOverIpv4OverTunAdapter.datagram(probe).serialize())
+        assert dgram
+        self.assertTrue(dgram.header.df)
+        self.assertFalse(dgram.header.mf)
+        self.assertEqual(dgram.header.offset, 0)
+
+
+class SenderTimestamps(SenderTestBase):
+    def deliver(self, src: TcpConnection, dst: TcpConnection):
+        while src.segments_out:
+            dst.segment_received(src.segments_out.popleft())
+
+    def test_rtt_sample_per_ack(self):
+        a, b = self.connected_pair()
+        self.assertTrue(a._ts_ok and b._ts_ok)
+        # the SYN-ACK echoes the SYN's TSval
+        self.assertEqual(a._srtt, 0)
+        self.assertEqual(a._max_payload_size, TcpConfig.MAX_PAYLOAD_SIZE - 12)
+        a.write(b'hello')
+        seg = a.segments_out[0]
+        self.assertIsNotNone(seg.header.options.ts_val)
+        self.deliver(a, b)
+        ack = b.segments_out[0]
+        self.assertEqual(ack.header.options.ts_ecr, seg.header.options.ts_val)
+        a.tick(50)
+        self.deliver(b, a)
+        self.assertEqual(a._srtt, 50 / 8)
+        self.assertEqual(a._rto, TcpConfig.MIN_RTO)
+        # a retransmission gets a fresh TSval, so its ACK is still a valid sample
+        a.write(b'world')
+        a.segments_out.clear()
+        a.tick(a._rto)
+        retx = a.segments_out[0]
+        self.assertEqual(retx.payload, b'world')
+        self.deliver(a, b)
+        a.tick(30)
+        self.deliver(b, a)
+        self.assertAlmostEqual(a._srtt, 50 / 8 * 7 / 8 + 30 / 8)
+
+    def test_paws(self):
+        a, b = self.connected_pair()
+        a.write(b'abc')
+        self.deliver(a, b)
+        b.segments_out.clear()
+        old = TcpSegment(TcpHeader(
+            ack=True, seqno=a.next_seqno, ackno=b.next_seqno, win=1000,
+            options=TcpOptions(ts_val=(b._ts_recent - 1) & UINT32_MAX)), b'stale')
+        b.segment_received(old)
+        self.expectSegment(b, ack=True, ackno=uint32_plus(1000, 4))
+        self.assertEqual(b.assembled_bytes, 3)
+
+
+class SenderPersist(SenderTestBase):
+    def test_zero_window_probe(self):
+        isn, isn2 = 10000, 20000
+        rto = TcpConfig.TIMEOUT_DFLT
+        conn = self.new_eastablished_connection(4000, isn, isn2)
+        conn.write(b'hello')
+        self.expectNoSegment(conn)
+        conn.tick(rto - 1)
+        self.expectNoSegment(conn)
+        conn.tick(1)
+        self.expectSegment(conn, payload=b'h', seqno=isn+1)
+        self.expectNoSegment(conn)
+        # the peer still has no room; probes back off exponentially
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=isn+1, win=0)))
+        timeout = rto
+        for _ in range(TcpConfig.MAX_RETX_ATTEMPTS + 2):
+            timeout = min(2 * timeout, TcpConfig.PERSIST_TIMEOUT_MAX)
+            conn.tick(timeout - 1)
+            self.expectNoSegment(conn)
+            conn.tick(1)
+            self.expectSegment(conn, payload=b'h', seqno=isn+1)
+            self.expectNoSegment(conn)
+        self.assertTrue(conn.active)
+        self.assertEqual(conn.consecutive_retransmissions, 0)
+        # the window reopens: the rest goes out at once
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=isn+2, win=100)))
+        self.expectSegment(conn, payload=b'ello', seqno=isn+2)
+        self.expectNoSegment(conn)
+        conn.tick(rto - 1)
+        self.expectNoSegment(conn)
+        conn.tick(1)
+        self.expectSegment(conn, payload=b'ello')
+
+    def test_idle_connection_does_not_time_out(self):
+        isn, isn2 = 10000, 20000
+        conn = self.new_eastablished_connection(4000, isn, isn2)
+        for _ in range(TcpConfig.MAX_RETX_ATTEMPTS + 1):
+            conn.tick(TcpConfig.MAX_RTO << TcpConfig.MAX_RETX_ATTEMPTS)
+        self.expectNoSegment(conn)
+        self.assertTrue(conn.active)
+
+
+class SenderNagle(SenderTestBase):
+    def test_nagle_holds_small_segments(self):
+        isn, isn2 = 10000, 20000
+        conn = self.new_eastablished_connection(4000, isn, isn2)
+        conn.set_nodelay(False)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=isn+1, win=4000)))
+        conn.write(b'ab')
+        self.expectSegment(conn, payload=b'ab')
+        conn.write(b'cd')
+        conn.write(b'ef')
+        self.expectNoSegment(conn)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=isn+3, win=4000)))
+        self.expectSegment(conn, payload=b'cdef', seqno=isn+3)
+        self.expectNoSegment(conn)
+        # full-sized segments are never held
+        conn.write(b'x' * TcpConfig.MAX_PAYLOAD_SIZE)
+        self.expectSegment(conn, payload_size=TcpConfig.MAX_PAYLOAD_SIZE)
+        self.expectNoSegment(conn)
+
+    def test_nodelay_flushes(self):
+        isn, isn2 = 10000, 20000
+        conn = self.new_eastablished_connection(4000, isn, isn2)
+        conn.set_nodelay(False)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=isn+1, win=4000)))
+        conn.write(b'ab')
+        conn.write(b'cd')
+        self.expectSegment(conn, payload=b'ab')
+        self.expectNoSegment(conn)
+        conn.set_nodelay(True)
+        self.expectSegment(conn, payload=b'cd')
+
+    def test_cork(self):
+        isn, isn2 = 10000, 20000
+        conn = self.new_eastablished_connection(4000, isn, isn2)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=isn+1, win=4000)))
+        conn.cork()
+        conn.write(b'ab')
+        conn.write(b'cd')
+        self.expectNoSegment(conn)
+        conn.uncork()
+        self.expectSegment(conn, payload=b'abcd')
+        self.expectNoSegment(conn)
+
+    def test_autocork(self):
+        isn, isn2 = 10000, 20000
+        cfg = TcpConfig()
+        cfg.autocork = True
+        conn = TcpConnection(cfg, isn)
+        conn.connect()
+        conn.segment_received(TcpSegment(
+            TcpHeader(syn=True, ack=True, ackno=isn+1, seqno=isn2, win=4000)))
+        conn.segments_out.clear()
+        conn.write(b'ab')
+        conn.write(b'cd')
+        self.expectSegment(conn, payload=b'abcd', seqno=isn+1)
+        self.expectNoSegment(conn)
+        self.assertEqual(conn.bytes_in_flight, 4)
+        conn.write(b'ef')
+        self.expectSegment(conn, payload=b'ef', seqno=isn+5)
+
+
+class SenderBufferAutosizing(SenderTestBase):
+    def setUp(self):
+        self._wmem_allocated = TcpConnection._wmem_allocated
+
+    def tearDown(self):
+        TcpConnection._wmem_allocated = self._wmem_allocated
+
+    def test_grows_when_application_limited_by_buffer(self):
+        isn, isn2 = 10000, 20000
+        cfg = TcpConfig()
+        cfg.send_capacity = 4000
+        cfg.sndbuf_autosizing = True
+        conn = TcpConnection(cfg, isn)
+        conn.connect()
+        self.expectSegment(conn, syn=True)
+        conn.segment_received(TcpSegment(
+            TcpHeader(syn=True, ack=True, ackno=isn+1, seqno=isn2, win=8000)))
+        self.expectSegment(conn, ack=True)
+        self.assertEqual(conn.write(b'x' * 4000), 4000)
+        self.assertEqual(conn.write(b'x' * 4000), 4000)
+        self.assertEqual(conn.write(b'x' * 8000), 4000)
+        conn.tick(TcpConfig.TIMEOUT_DFLT)
+        conn.segments_out.clear()
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=isn+1+8000, win=8000)))
+        # 8000 bytes were delivered in one round while the buffer was full
+        self.assertEqual(conn.inbound_stream.capacity, 16000)
+        self.assertEqual(TcpConnection._wmem_allocated, self._wmem_allocated + 12000)
+        self.assertEqual(conn.write(b'x' * 20000), 16000)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=isn+1+16000, win=16000)))
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=isn+1+28000, win=16000)))
+        conn.segments_out.clear()
+        # the buffer is given back after an idle RTO
+        conn.tick(TcpConfig.TIMEOUT_DFLT // 2)
+        self.assertEqual(conn.inbound_stream.capacity, 16000)
+        conn.tick(TcpConfig.TIMEOUT_DFLT // 2)
+        self.assertEqual(conn.inbound_stream.capacity, 4000)
+        self.assertEqual(TcpConnection._wmem_allocated, self._wmem_allocated)
+
+
+class SenderRetransmitCoalesce(SenderTestBase):
+    def test_small_segments_merged_on_timeout(self):
+        isn, isn2 = 10000, 20000
+        cfg = TcpConfig()
+        cfg.retx_coalesce = True
+        conn = TcpConnection(cfg, isn)
+        conn.connect()
+        self.expectSegment(conn, syn=True)
+        conn.segment_received(TcpSegment(
+            TcpHeader(syn=True, ack=True, ackno=isn+1, seqno=isn2, win=4000)))
+        self.expectSegment(conn, ack=True)
+        for i in range(10):
+            conn.write(b'%d' % i * 100)
+        conn.write(b'y' * 500)
+        self.assertEqual(len(conn.segments_out), 11)
+        conn.segments_out.clear()
+        conn.tick(TcpConfig.TIMEOUT_DFLT)
+        # ten 100-byte segments fit in one MSS, the 500-byte one does not
+        self.expectSegment(conn, seqno=isn+1, payload=b''.join(b'%d' % i * 100 for i in range(10)))
+        self.expectNoSegment(conn)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=isn+1+1000, win=4000)))
+        self.assertEqual(conn.bytes_in_flight, 500)
+        conn.tick(TcpConfig.TIMEOUT_DFLT)
+        self.expectSegment(conn, seqno=isn+1+1000, payload_size=500)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=isn+1+1500, win=4000)))
+        self.assertEqual(conn.bytes_in_flight, 0)
+
+    def test_partial_ack_keeps_merged_boundaries(self):
+        isn, isn2 = 10000, 20000
+        cfg = TcpConfig()
+        cfg.retx_coalesce = True
+        conn = TcpConnection(cfg, isn)
+        conn.connect()
+        conn.segment_received(TcpSegment(
+            TcpHeader(syn=True, ack=True, ackno=isn+1, seqno=isn2, win=4000)))
+        for _ in range(3):
+            conn.write(b'x' * 10)
+        conn.segments_out.clear()
+        conn.tick(TcpConfig.TIMEOUT_DFLT)
+        self.expectSegment(conn, seqno=isn+1, payload_size=30)
+        # an ACK inside the merged segment does not remove it
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=isn+1+10, win=4000)))
+        self.assertEqual(conn.bytes_in_flight, 30)
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=isn+1+30, win=4000)))
+        self.assertEqual(conn.bytes_in_flight, 0)
+
+
+    def test_merge_stops_at_sacked_segment(self):
+        a, b = self.connected_pair(retx_coalesce=True, congestion_control=True)
+        for _ in range(4):
+            a.write(b'x' * 10)
+        segs = list(a.segments_out)
+        a.segments_out.clear()
+        self.assertEqual(len(segs), 4)
+        b.segment_received(segs[2])
+        a.segment_received(self.expectSegment(b, ackno=1001))
+        a.tick(a._rto)
+        # the SACKed third segment is not folded into the retransmission
+        self.expectSegment(a, seqno=1001, payload_size=20)
+        self.assertEqual([(len(seg.payload), seg.sacked, seg.lost)
+                          for seg in a._outgoing_segments],
+                         [(20, False, False), (10, True, False), (10, False, True)])
+        self.assertEqual((a._sacked_out, a._lost_out), (10, 10))
+        self.assertEqual(a._pipe(), 20)
+
+
+class SenderRackTlp(SenderTestBase):
+    def connected_pair(self):
+        # a 50ms round trip
+        return super().connected_pair(rtt=50, rack=True)
+
+    def test_sack_blocks(self):
+        a, b = self.connected_pair()
+        self.assertTrue(a._sack_ok and b._sack_ok)
+        mss = a._max_payload_size
+        a.write(b'x' * 4 * mss)
+        segs = list(a.segments_out)
+        a.segments_out.clear()
+        self.assertEqual(len(segs), 4)
+        b.segment_received(segs[1])
+        b.segment_received(segs[3])
+        self.expectSegment(b, ackno=1001)
+        ack = self.expectSegment(b, ackno=1001)
+        # the block holding the latest segment comes first
+        self.assertEqual(ack.header.options.sack_blocks,
+                         [(1001 + 3 * mss, 1001 + 4 * mss), (1001 + mss, 1001 + 2 * mss)])
+        a.segment_received(ack)
+        self.assertEqual([seg.sacked for seg in a._outgoing_segments],
+                         [False, True, False, True])
+
+    def test_rack_detects_reordering_loss(self):
+        a, b = self.connected_pair()
+        mss = a._max_payload_size
+        a.write(b'x' * 3 * mss)
+        segs = list(a.segments_out)
+        a.segments_out.clear()
+        b.segment_received(segs[1])
+        b.segment_received(segs[2])
+        a.tick(50)
+        a.segments_out.clear()
+        while b.segments_out:
+            a.segment_received(b.segments_out.popleft())
+        # segs[0] was sent together with the delivered segs[2], it is lost
+        # once overdue by the reordering window min_rtt / 4
+        self.assertEqual(a._rack_timer, 50 // 4)
+        self.expectNoSegment(a)
+        a.tick(50 // 4)
+        self.expectSegment(a, seqno=1001, payload_size=mss)
+        self.expectNoSegment(a)
+        self.assertLess(a._rack_timer or 0, a._rto)
+
+    def test_tail_loss_probe(self):
+        a, b = self.connected_pair()
+        mss = a._max_payload_size
+        a.write(b'x' * 3 * mss)
+        segs = list(a.segments_out)
+        a.segments_out.clear()
+        b.segment_received(segs[0])
+        b.segment_received(segs[1])
+        a.tick(50)
+        while b.segments_out:
+            a.segment_received(b.segments_out.popleft())
+        self.assertEqual(a.bytes_in_flight, mss)
+        # PTO = 2 * SRTT + the peer's delayed ACK time, well before the RTO
+        pto = int(2 * a._srtt + TcpConfig.DELACK_TIMEOUT)
+        self.assertLess(pto, a._rto)
+        a.tick(pto - 1)
+        self.expectNoSegment(a)
+        a.tick(1)
+        probe = self.expectSegment(a, seqno=1001 + 2 * mss, payload_size=mss)
+        b.segment_received(probe)
+        a.segment_received(self.expectSegment(b, ackno=1001 + 3 * mss))
+        self.assertEqual(a.bytes_in_flight, 0)
+
+
+class SenderSpuriousRetransmission(SenderTestBase):
+    def test_dsack_reported(self):
+        a, b = self.connected_pair()
+        a.write(b'hello')
+        seg = a.segments_out.popleft()
+        b.segment_received(seg)
+        self.expectSegment(b, ackno=1006)
+        b.segment_received(seg)
+        ack = self.expectSegment(b, ackno=1006)
+        self.assertEqual(ack.header.options.sack_blocks, [(1001, 1006)])
+        # reported once
+        a.write(b'world')
+        b.segment_received(a.segments_out.popleft())
+        ack = self.expectSegment(b, ackno=1011)
+        self.assertEqual(ack.header.options.sack_blocks, [])
+
+    def test_eifel_detects_spurious_timeout(self):
+        a, b = self.connected_pair()
+        a.write(b'hello')
+        # a copy as it went on the wire, the retransmission refreshes the TSval
+        original = TcpSegment.deserialize(a.segments_out.popleft().serialize())
+        rto = a._rto
+        a.tick(rto)
+        self.expectSegment(a, payload=b'hello')
+        self.assertEqual(a.consecutive_retransmissions, 1)
+        # the original was only delayed, its ACK echoes the original TSval
+        b.segment_received(original)
+        a.segment_received(self.expectSegment(b, ackno=1006))
+        self.assertEqual(a.spurious_retransmissions, 1)
+        self.assertEqual(a.consecutive_retransmissions, 0)
+        self.assertEqual(a._rto, rto)
+
+    def test_eifel_genuine_loss(self):
+        a, b = self.connected_pair()
+        a.write(b'hello')
+        a.segments_out.clear()
+        a.tick(a._rto)
+        b.segment_received(self.expectSegment(a, payload=b'hello'))
+        a.segment_received(self.expectSegment(b, ackno=1006))
+        self.assertEqual(a.spurious_retransmissions, 0)
+        self.assertIsNone(a._undo_state)
+
+    def test_dsack_detects_spurious_timeout(self):
+        a, b = self.connected_pair(timestamps=False)
+        self.assertTrue(a._sack_ok)
+        a.write(b'hello')
+        original = a.segments_out.popleft()
+        a.tick(a._rto)
+        retx = self.expectSegment(a, payload=b'hello')
+        b.segment_received(original)
+        a.segment_received(self.expectSegment(b, ackno=1006))
+        self.assertEqual(a.spurious_retransmissions, 0)
+        b.segment_received(retx)
+        a.segment_received(self.expectSegment(b, ackno=1006))
+        self.assertEqual(a.spurious_retransmissions, 1)
+
+
+class SenderCongestionControl(SenderTestBase):
+    def connected_pair(self, **overrides):
+        return super().connected_pair(congestion_control=True, send_capacity=1 << 20,
+                                      recv_capacity=1 << 20, **overrides)
+
+    def exchange(self, a: TcpConnection, b: TcpConnection, segs):
+        """
+        Deliver segs to b and its ACKs back to a, return what a sent in response
+        """
+        sent = []
+        for seg in segs:
+            b.segment_received(seg)
+            while b.segments_out:
+                a.segment_received(b.segments_out.popleft())
+                sent += a.segments_out
+                a.segments_out.clear()
+        return sent
+
+    def test_slow_start(self):
+        a, b = self.connected_pair()
+        mss = a._max_payload_size
+        a.write(b'x' * 40 * mss)
+        segs = list(a.segments_out)
+        a.segments_out.clear()
+        self.assertEqual(len(segs), TcpConfig.INITIAL_WINDOW)
+        # every ACK opens cwnd by one segment and frees one
+        self.assertEqual(len(self.exchange(a, b, segs[:1])), 2)
+        self.assertEqual(a._cwnd, (TcpConfig.INITIAL_WINDOW + 1) * mss)
+
+    def test_prr_recovery(self):
+        a, b = self.connected_pair()
+        mss = a._max_payload_size
+        a.write(b'x' * 40 * mss)
+        segs = list(a.segments_out)
+        a.segments_out.clear()
+        # the first segment is lost; three duplicate ACKs start recovery
+        sent = self.exchange(a, b, segs[1:4])
+        self.assertFalse(a._in_recovery)
+        sent += self.exchange(a, b, segs[4:5])
+        self.assertTrue(a._in_recovery)
+        self.assertEqual(a._ssthresh, 9 * mss // 2)
+        retx = [seg for seg in sent if seg.retransmitted]
+        self.assertEqual([seg.header.seqno for seg in retx], [1001])
+        # the rest of the window: PRR sends about one segment per two delivered
+        recovery = self.exchange(a, b, segs[5:])
+        self.assertEqual(len(recovery), 2)
+        recovery += self.exchange(a, b, retx + sent[:3])
+        self.assertFalse(a._in_recovery)
+        # back in congestion avoidance from ssthresh
+        self.assertGreaterEqual(a._cwnd, a._ssthresh)
+        self.assertLess(a._cwnd, a._ssthresh + mss)
+
+    def test_data_is_not_a_duplicate_ack(self):
+        a, b = self.connected_pair()
+        # through the FSM, not the in-order data fast path
+        a._header_prediction = False
+        mss = a._max_payload_size
+        a.write(b'x' * 4 * mss)
+        a.segments_out.clear()
+        b.write(b'y' * 5 * mss)
+        # the peer's data repeats the ackno and the window of its last ACK
+        for seg in list(b.segments_out):
+            a.segment_received(seg)
+        self.assertEqual(a._dupacks, 0)
+        self.assertFalse(a._in_recovery)
+        self.assertFalse(any(seg.retransmitted for seg in a.segments_out))
+
+    def assertPipe(self, conn: TcpConnection):
+        self.assertEqual(conn._pipe(), sum(seg.length_in_sequence_space
+                                           for seg in conn._outgoing_segments
+                                           if not seg.sacked and not seg.lost))
+
+    def test_pipe_follows_marks(self):
+        a, b = self.connected_pair()
+        mss = a._max_payload_size
+        a.write(b'x' * 10 * mss)
+        segs = list(a.segments_out)
+        a.segments_out.clear()
+        self.assertPipe(a)
+        for seg in segs[1:4]:
+            self.exchange(a, b, [seg])
+            self.assertPipe(a)
+        # the third duplicate ACK marked the head lost and it went out again
+        self.assertEqual(a._sacked_out, 3 * mss)
+        self.assertEqual(a._lost_out, 0)
+        # after the RTO only the retransmitted head counts as in the network
+        a.tick(a._rto)
+        self.assertEqual(a._pipe(), mss)
+        self.assertPipe(a)
+        self.exchange(a, b, segs[4:])
+        self.assertPipe(a)
+        self.exchange(a, b, [segs[0]])
+        self.assertEqual((a._sacked_out, a._lost_out), (0, 0))
+        self.assertPipe(a)
+
+    def test_timeout_collapses_cwnd(self):
+        a, b = self.connected_pair()
+        mss = a._max_payload_size
+        a.write(b'x' * 4 * mss)
+        segs = list(a.segments_out)
+        a.segments_out.clear()
+        a.tick(a._rto)
+        head = self.expectSegment(a, seqno=1001)
+        self.expectNoSegment(a)
+        self.assertEqual(a._cwnd, mss)
+        self.assertEqual(a._ssthresh, 2 * mss)
+        # the rest went missing too and is resent in slow start
+        sent = self.exchange(a, b, [head])
+        self.assertEqual([seg.header.seqno for seg in sent], [1001 + mss, 1001 + 2 * mss])
+        self.exchange(a, b, sent)
+        self.assertEqual(a.bytes_in_flight, mss)
+
+
+class VisitCountingDeque(deque):
+    """
+    Counts the segments visited by walks over the retransmission queue
+    """
+    def __init__(self, iterable=()):
+        super().__init__(iterable)
+        self.visited = 0
+
+    def __iter__(self):
+        for seg in super().__iter__():
+            self.visited += 1
+            yield seg
+
+    def __getitem__(self, index):
+        self.visited += 1
+        return super().__getitem__(index)
+
+
+class SenderAckCost(SenderTestBase):
+    def segments_visited(self, outstanding: int, lost: int = 0, **overrides) -> int:
+        """
+        Segments walked while the peer acks the first ten of outstanding ones.
+        With lost set, that many are dropped first and the ten after them
+        come back as SACKed duplicate ACKs
+        """
+        a, b = self.connected_pair(send_capacity=1 << 24, recv_capacity=1 << 24, **overrides)
+        # let the whole queue out at once, past the unscaled SYN-ACK window
+        a._cwnd = a._receiver_window_size = 1 << 30
+        a._outgoing_segments = VisitCountingDeque(a._outgoing_segments)
+        a.write(b'x' * outstanding * a._max_payload_size)
+        segs = list(a.segments_out)
+        a.segments_out.clear()
+        self.assertEqual(len(segs), outstanding)
+        for seg in segs[lost:lost + 10]:
+            b.segment_received(seg)
+        while b.segments_out:
+            a.segment_received(b.segments_out.popleft())
+        self.assertEqual(len(a._outgoing_segments), outstanding - (0 if lost else 10))
+        self.assertEqual(a._sacked_out, 10 * a._max_payload_size if lost else 0)
+        return a._outgoing_segments.visited
+
+    def test_ack_cost_independent_of_queue_length(self):
+        for overrides in ({}, {'congestion_control': True}, {'rack': True}):
+            with self.subTest(**overrides):
+                self.assertEqual(self.segments_visited(100, **overrides),
+                                 self.segments_visited(1000, **overrides))
+
+    def test_sack_cost_logarithmic_in_queue_length(self):
+        for overrides in ({}, {'congestion_control': True}, {'rack': True}):
+            with self.subTest(**overrides):
+                # only the bisection for each SACK block grows, logarithmically
+                few = self.segments_visited(100, lost=1, **overrides)
+                many = self.segments_visited(1000, lost=1, **overrides)
+                self.assertLess(many, 2 * few)
+
+
+class SenderEcn(SenderTestBase):
+    exchange = SenderCongestionControl.exchange
+
+    def connected_pair(self, ecn: bool = True):
+        # a always asks for ECN, b agrees when ecn is set
+        return super().connected_pair(peer_overrides={'ecn': ecn}, congestion_control=True, ecn=True,
+                                      send_capacity=1 << 20, recv_capacity=1 << 20)
+
+    def test_negotiation(self):
+        cfg = TcpConfig()
+        cfg.ecn = True
+        conn = TcpConnection(cfg, 1000)
+        conn.connect()
+        syn = self.expectSegment(conn, syn=True)
+        self.assertTrue(syn.header.ece and syn.header.cwr)
+        a, b = self.connected_pair(ecn=False)
+        self.assertFalse(a._ecn_ok or b._ecn_ok)
+        a.write(b'data')
+        self.assertFalse(self.expectSegment(a, payload=b'data').ect)
+        a, b = self.connected_pair()
+        self.assertTrue(a._ecn_ok and b._ecn_ok)
+        a.write(b'data')
+        seg = self.expectSegment(a, payload=b'data')
+        self.assertTrue(seg.ect)
+        self.assertFalse(seg.header.ece or seg.header.cwr)
+
+    def test_ce_reduces_cwnd_once_per_window(self):
+        a, b = self.connected_pair()
+        mss = a._max_payload_size
+        a.write(b'x' * 40 * mss)
+        segs = list(a.segments_out)
+        a.segments_out.clear()
+        segs[0].ce = True
+        b.segment_received(segs[0])
+        ack = self.expectSegment(b, ack=True, ackno=1001 + mss)
+        self.assertTrue(ack.header.ece)
+        a.segment_received(ack)
+        self.assertEqual(a._ssthresh, 9 * mss // 2)
+        self.assertEqual(a._cwnd, a._ssthresh)
+        self.assertFalse(a._in_recovery)
+        self.assertFalse(any(seg.retransmitted for seg in a.segments_out))
+        # b keeps echoing; the rest of the window does not reduce again
+        sent = list(a.segments_out)
+        a.segments_out.clear()
+        sent += self.exchange(a, b, segs[1:])
+        self.assertEqual(a._ssthresh, 9 * mss // 2)
+        # the first new segment carries CWR, which ends the echo
+        self.assertTrue(sent[0].header.cwr)
+        self.assertFalse(any(seg.header.cwr for seg in sent[1:]))
+        b.segment_received(sent[0])
+        self.assertFalse(self.expectSegment(b, ack=True).header.ece)
+
 
 if __name__ == '__main__':
     unittest.main()
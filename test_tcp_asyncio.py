@@ -0,0 +1,130 @@
+import asyncio
+import socket
+import unittest
+from collections import deque
+from typing import Deque, Optional
+
+from tcp_asyncio import TcpDriver, open_connection, start_server
+from tcp_segment import TcpSegment
+from test_tcp_mux import LOCAL_IP, REMOTE_IP
+
+
+class LoopbackTunAdapter:
+    """
+    One end of a wire between two drivers: written segments land in the
+    other end's inbox, and a byte on a socketpair per segment makes that
+    end readable for add_reader()
+    """
+    def __init__(self):
+        self.mtu: Optional[int] = None
+        self.inbox: Deque[TcpSegment] = deque()
+        self.peer: Optional[LoopbackTunAdapter] = None
+        self._rsock, self._wsock = socket.socketpair()
+        self._rsock.setblocking(False)
+
+    @staticmethod
+    def pair():
+        a, b = LoopbackTunAdapter(), LoopbackTunAdapter()
+        a.peer, b.peer = b, a
+        return a, b
+
+    def fileno(self) -> int:
+        return self._rsock.fileno()
+
+    def close(self):
+        self._rsock.close()
+        self._wsock.close()
+
+    def read_segment(self) -> Optional[TcpSegment]:
+        self._rsock.recv(1)
+        return self.inbox.popleft() if self.inbox else None
+
+    def write_segment(self, seg: TcpSegment):
+        assert self.peer
+        copy = TcpSegment.deserialize(seg.serialize(), seg.src_ip, seg.dst_ip)
+        assert copy
+        self.peer.inbox.append(copy)
+        self.peer._wsock.send(b'.')
+
+
+class AsyncioTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client_adapter, self.server_adapter = LoopbackTunAdapter.pair()
+        self.client = TcpDriver(self.client_adapter)  # type: ignore[arg-type]
+        self.server = TcpDriver(self.server_adapter)  # type: ignore[arg-type]
+
+    async def asyncTearDown(self):
+        self.client.close()
+        self.server.close()
+        self.client_adapter.close()
+        self.server_adapter.close()
+
+    async def test_echo(self):
+        async def echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            data = await reader.read()
+            writer.write(data.upper())
+            writer.close()
+            await writer.wait_closed()
+
+        server = await start_server(self.server, echo, REMOTE_IP, 80)
+        reader, writer = await open_connection(self.client, REMOTE_IP, 80, local_ip=LOCAL_IP)
+        self.assertEqual(writer.get_extra_info('peername'), (REMOTE_IP, 80))
+        writer.write(b'hello ')
+        writer.write(b'world')
+        writer.write_eof()
+        self.assertEqual(await asyncio.wait_for(reader.read(), 5), b'HELLO WORLD')
+        writer.close()
+        await asyncio.wait_for(writer.wait_closed(), 5)
+        server.close()
+        await server.wait_closed()
+
+    async def test_bulk_transfer(self):
+        payload = bytes(range(256)) * 4096
+        received = asyncio.get_running_loop().create_future()
+
+        async def sink(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            received.set_result(await reader.read())
+            writer.close()
+
+        async with await start_server(self.server, sink, REMOTE_IP, 80):
+            reader, writer = await open_connection(self.client, REMOTE_IP, 80, local_ip=LOCAL_IP)
+            writer.write(payload)
+            # the send buffer cannot take it all, drain waits for the peer's ACKs
+            self.assertGreater(writer.transport.get_write_buffer_size(), 0)
+            await asyncio.wait_for(writer.drain(), 10)
+            writer.write_eof()
+            self.assertEqual(await asyncio.wait_for(received, 10), payload)
+            self.assertEqual(await asyncio.wait_for(reader.read(), 5), b'')
+            writer.close()
+
+    async def test_reset(self):
+        async def reset(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            writer.transport.abort()
+
+        async with await start_server(self.server, reset, REMOTE_IP, 80):
+            reader, writer = await open_connection(self.client, REMOTE_IP, 80, local_ip=LOCAL_IP)
+            with self.assertRaises(ConnectionResetError):
+                await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+
+    async def test_many_clients(self):
+        async def greet(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            name = await reader.readline()
+            writer.write(b'hi ' + name)
+            await writer.drain()
+            writer.close()
+
+        async def client(i: int) -> bytes:
+            reader, writer = await open_connection(self.client, REMOTE_IP, 80, local_ip=LOCAL_IP)
+            writer.write(b'%d\n' % i)
+            reply = await reader.read()
+            writer.close()
+            return reply
+
+        async with await start_server(self.server, greet, REMOTE_IP, 80):
+            replies = await asyncio.wait_for(asyncio.gather(*(client(i) for i in range(50))), 10)
+        self.assertEqual(replies, [b'hi %d\n' % i for i in range(50)])
+
+
+if __name__ == '__main__':
+    unittest.main()
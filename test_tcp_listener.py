@@ -0,0 +1,184 @@
+import unittest
+from collections import deque
+from random import randint
+from typing import Dict, Optional
+
+from config import TcpConfig
+from tcp_connection import TcpConnection
+from tcp_listener import SynCookies
+from tcp_segment import TcpHeader, TcpSegment
+from tcp_state import TcpState
+from tcp_mux import TcpMultiplexer
+from test_tcp_mux import FakeTunAdapter, LOCAL_IP, REMOTE_IP
+from utils import UINT32_MAX
+
+
+class ListenerTestBase(unittest.TestCase):
+    def setUp(self):
+        self.cfg = TcpConfig()
+        self.cfg.syn_backlog = 4
+        self.adapter = FakeTunAdapter()
+        self.mux = TcpMultiplexer(self.adapter, self.cfg)  # type: ignore[arg-type]
+        self.listener = self.mux.listen(LOCAL_IP, 80, backlog=8)
+        # clients by their own port
+        self.clients: Dict[int, TcpConnection] = {}
+
+    def connect(self, port: int, cfg: Optional[TcpConfig] = None) -> TcpConnection:
+        client = TcpConnection(cfg if cfg is not None else TcpConfig(), randint(0, UINT32_MAX))
+        client.connect()
+        self.clients[port] = client
+        return client
+
+    def client_segments(self):
+        segs = []
+        for port, client in self.clients.items():
+            while client.segments_out:
+                seg = client.segments_out.popleft()
+                seg.header.sport, seg.header.dport = port, 80
+                seg.src_ip, seg.dst_ip = REMOTE_IP, LOCAL_IP
+                segs.append(seg)
+        return segs
+
+    def exchange(self):
+        while True:
+            self.mux.segments_received(self.client_segments())
+            self.mux.flush()
+            if not self.adapter.written:
+                return
+            while self.adapter.written:
+                seg = self.adapter.written.popleft()
+                self.assertEqual((seg.src_ip, seg.dst_ip), (LOCAL_IP, REMOTE_IP))
+                self.clients[seg.header.dport].segment_received(seg)
+
+    def accept_all(self):
+        accepted = []
+        while True:
+            conn = self.listener.accept()
+            if conn is None:
+                return accepted
+            accepted.append(conn)
+
+
+class ListenerTest(ListenerTestBase):
+    def test_accept(self):
+        clients = [self.connect(50000 + i) for i in range(4)]
+        self.exchange()
+        self.assertTrue(all(client.state == TcpState.ESTABLISHED for client in clients))
+        accepted = self.accept_all()
+        self.assertEqual(len(accepted), 4)
+        self.assertEqual(self.listener.syn_queue_size, 0)
+        self.assertEqual(self.listener.cookies_sent, 0)
+        for conn in accepted:
+            port = self.mux.address(conn)[3]
+            self.mux.write(conn, b'hi %d' % port)
+        self.exchange()
+        for port, client in self.clients.items():
+            self.assertEqual(client.read(client.outbound_stream.size), b'hi %d' % port)
+
+    def test_syn_cookies(self):
+        for i in range(6):
+            self.connect(50000 + i)
+        self.mux.segments_received(self.client_segments())
+        # the SYN queue holds four, the other two got cookies and cost nothing
+        self.assertEqual(self.listener.syn_queue_size, 4)
+        self.assertEqual(self.listener.cookies_sent, 2)
+        self.assertEqual(len(self.mux), 4)
+        self.exchange()
+        self.assertTrue(all(client.state == TcpState.ESTABLISHED
+                            for client in self.clients.values()))
+        self.assertEqual(self.listener.cookies_accepted, 2)
+        accepted = self.accept_all()
+        self.assertEqual(len(accepted), 6)
+        for conn in accepted:
+            self.mux.write(conn, b'x' * 3000)
+        self.exchange()
+        for client in self.clients.values():
+            self.assertEqual(client.outbound_stream.bytes_written, 3000)
+
+    def test_cookie_advertises_our_mss(self):
+        self.cfg.mss = 536
+        for i in range(4):
+            self.connect(50000 + i)
+        peer_cfg = TcpConfig()
+        peer_cfg.mss = 1460
+        client = self.connect(50004, peer_cfg)
+        self.mux.segments_received(self.client_segments())
+        self.mux.flush()
+        self.assertEqual(self.listener.cookies_sent, 1)
+        syn_acks = [seg for seg in self.adapter.written if seg.header.dport == 50004]
+        self.assertEqual([seg.header.options.mss for seg in syn_acks], [536])
+        self.adapter.written = deque(syn_acks)
+        self.exchange()
+        self.assertEqual(client.state, TcpState.ESTABLISHED)
+        self.assertEqual(client._max_payload_size, 536)
+
+    def test_forged_cookie(self):
+        for i in range(4):
+            self.connect(50000 + i)
+        self.mux.segments_received(self.client_segments())
+        self.mux.flush()
+        self.adapter.written.clear()
+        ack = TcpSegment(TcpHeader(ack=True, seqno=1001, ackno=12345, win=1000,
+                                   sport=50100, dport=80), b'', REMOTE_IP, LOCAL_IP)
+        self.mux.segments_received([ack])
+        self.assertEqual(self.listener.cookies_accepted, 0)
+        self.assertIsNone(self.mux.connection((LOCAL_IP, 80, REMOTE_IP, 50100)))
+
+    def test_cookie_expires(self):
+        cookies = SynCookies(b'k' * 16)
+        four_tuple = (LOCAL_IP, 80, REMOTE_IP, 50000)
+        cookie, mss = cookies.make(four_tuple, 1000, 1460, 0)
+        self.assertEqual(mss, 1460)
+        self.assertEqual(cookies.check(four_tuple, 1000, cookie, 128000), 1460)
+        self.assertIsNone(cookies.check(four_tuple, 1000, cookie, 192000))
+        self.assertIsNone(cookies.check(four_tuple, 1001, cookie, 0))
+
+    def test_accept_queue_full(self):
+        self.listener = self.mux.listen(LOCAL_IP, 81, backlog=2)
+        for i in range(3):
+            self.connect(50000 + i)
+        for seg in self.client_segments():
+            seg.header.dport = 81
+            self.mux.segments_received([seg])
+            self.mux.flush()
+            for reply in self.adapter.written:
+                client = self.clients[reply.header.dport]
+                client.segment_received(reply)
+                ack = client.segments_out.popleft()
+                ack.header.sport, ack.header.dport = reply.header.dport, 81
+                ack.src_ip, ack.dst_ip = REMOTE_IP, LOCAL_IP
+                self.mux.segments_received([ack])
+            self.adapter.written.clear()
+        self.assertEqual(len(self.listener), 2)
+        self.assertEqual(self.listener.syns_dropped, 1)
+        self.assertEqual(self.clients[50002].state, TcpState.SYN_SENT)
+
+    def test_syn_ack_retransmitted(self):
+        self.connect(50000)
+        self.mux.segments_received(self.client_segments())
+        self.mux.flush()
+        syn_ack = self.adapter.written.popleft()
+        self.mux.tick(TcpConfig.TIMEOUT_DFLT)
+        self.mux.flush()
+        again = self.adapter.written.popleft()
+        self.assertTrue(again.header.syn and again.header.ack)
+        self.assertEqual(again.header.seqno, syn_ack.header.seqno)
+        self.clients[50000].segment_received(again)
+        self.exchange()
+        self.assertEqual(len(self.accept_all()), 1)
+
+    def test_half_open_reset(self):
+        client = self.connect(50000)
+        self.mux.segments_received(self.client_segments())
+        self.mux.flush()
+        self.adapter.written.clear()
+        client.shutdown()
+        self.mux.segments_received(self.client_segments())
+        self.assertEqual(self.listener.syn_queue_size, 0)
+        self.mux.flush()
+        self.assertEqual(len(self.mux), 0)
+        self.assertIsNone(self.listener.accept())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+import unittest
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from config import TcpConfig, FdAdapterConfig
+from tcp_connection import TcpConnection
+from tcp_segment import TcpHeader, TcpSegment
+from tcp_state import TcpState
+from tcp_mux import TcpMultiplexer
+
+LOCAL_IP = '169.254.144.9'
+REMOTE_IP = '169.254.144.1'
+
+
+class FakeTunAdapter:
+    """
+    Stands in for TcpOverIpv4OverTunAdapter: segments written are kept in
+    written, read_segment() returns what the test put in inbox
+    """
+    def __init__(self):
+        self.mtu: Optional[int] = None
+        self.inbox: Deque[TcpSegment] = deque()
+        self.written: Deque[TcpSegment] = deque()
+
+    def read_segment(self) -> Optional[TcpSegment]:
+        return self.inbox.popleft() if self.inbox else None
+
+    def write_segment(self, seg: TcpSegment):
+        # a copy, as the datagram on the wire would be
+        copy = TcpSegment.deserialize(seg.serialize(), seg.src_ip, seg.dst_ip)
+        assert copy
+        self.written.append(copy)
+
+
+class MultiplexerTestBase(unittest.TestCase):
+    def setUp(self):
+        self.adapter = FakeTunAdapter()
+        self.mux = TcpMultiplexer(self.adapter, TcpConfig())  # type: ignore[arg-type]
+        # peer connections by their own (remote side) port
+        self.peers: Dict[int, TcpConnection] = {}
+
+    def peer(self, port: int) -> TcpConnection:
+        if port not in self.peers:
+            self.peers[port] = TcpConnection(TcpConfig())
+            self.peers[port].set_listening()
+        return self.peers[port]
+
+    def exchange(self):
+        """
+        Carry segments between the multiplexer and the peers until both sides are quiet
+        """
+        while True:
+            self.mux.flush()
+            if not self.adapter.written:
+                return
+            replies = []
+            while self.adapter.written:
+                seg = self.adapter.written.popleft()
+                self.assertEqual((seg.src_ip, seg.dst_ip), (LOCAL_IP, REMOTE_IP))
+                peer = self.peer(seg.header.dport)
+                peer.segment_received(seg)
+                while peer.segments_out:
+                    reply = peer.segments_out.popleft()
+                    reply.header.sport, reply.header.dport = seg.header.dport, seg.header.sport
+                    reply.src_ip, reply.dst_ip = REMOTE_IP, LOCAL_IP
+                    replies.append(reply)
+            self.mux.segments_received(replies)
+
+
+class MultiplexerTest(MultiplexerTestBase):
+    def test_many_connections(self):
+        n = 1000
+        conns = [self.mux.connect(FdAdapterConfig(
+            saddr=LOCAL_IP, sport=40000 + i, daddr=REMOTE_IP, dport=1000 + i))
+            for i in range(n)]
+        self.assertEqual(len(self.mux), n)
+        self.exchange()
+        self.assertTrue(all(conn.state == TcpState.ESTABLISHED for conn in conns))
+        for i, conn in enumerate(conns):
+            self.mux.write(conn, b'hello %d' % i)
+        self.exchange()
+        for i in range(n):
+            received = self.peers[1000 + i].outbound_stream
+            self.assertEqual(received.read(received.size), b'hello %d' % i)
+        self.assertTrue(all(conn.bytes_in_flight == 0 for conn in conns))
+
+    def test_duplicate_four_tuple(self):
+        cfg = FdAdapterConfig(saddr=LOCAL_IP, sport=40000, daddr=REMOTE_IP, dport=80)
+        self.mux.connect(cfg)
+        with self.assertRaises(RuntimeError):
+            self.mux.connect(cfg)
+
+    def test_unknown_connection_dropped(self):
+        conn = self.mux.connect(FdAdapterConfig(
+            saddr=LOCAL_IP, sport=40000, daddr=REMOTE_IP, dport=80))
+        self.mux.flush()
+        syn = self.adapter.written.popleft()
+        seg = TcpSegment(TcpHeader(syn=True, ack=True, seqno=7, ackno=syn.header.seqno + 1,
+                                   sport=80, dport=40001), b'', REMOTE_IP, LOCAL_IP)
+        self.mux.segments_received([seg])
+        self.assertEqual(conn.state, TcpState.SYN_SENT)
+        self.mux.flush()
+        self.assertFalse(self.adapter.written)
+
+    def test_timers(self):
+        conn = self.mux.connect(FdAdapterConfig(
+            saddr=LOCAL_IP, sport=40000, daddr=REMOTE_IP, dport=80))
+        self.mux.flush()
+        self.adapter.written.clear()
+        # the SYN is lost and goes out again after the RTO
+        self.mux.tick(TcpConfig.TIMEOUT_DFLT - 1)
+        self.mux.flush()
+        self.assertFalse(self.adapter.written)
+        self.mux.tick(1)
+        self.mux.flush()
+        self.assertTrue(self.adapter.written[0].header.syn)
+        self.exchange()
+        self.assertEqual(conn.state, TcpState.ESTABLISHED)
+
+    def test_closed_connections_removed(self):
+        conn = self.mux.connect(FdAdapterConfig(
+            saddr=LOCAL_IP, sport=40000, daddr=REMOTE_IP, dport=80))
+        self.exchange()
+        self.assertEqual(len(self.mux), 1)
+        # the peer resets the connection
+        peer = self.peers[80]
+        peer.shutdown()
+        rst = peer.segments_out.popleft()
+        rst.header.sport, rst.header.dport = 80, 40000
+        rst.src_ip, rst.dst_ip = REMOTE_IP, LOCAL_IP
+        self.mux.segments_received([rst])
+        self.assertFalse(conn.active)
+        self.mux.flush()
+        self.assertEqual(len(self.mux), 0)
+        self.assertIsNone(self.mux.connection((LOCAL_IP, 40000, REMOTE_IP, 80)))
+
+    def test_mss_from_mtu_leaves_config_alone(self):
+        cfg = TcpConfig()
+        adapter = FakeTunAdapter()
+        adapter.mtu = 1500
+        mux = TcpMultiplexer(adapter, cfg)  # type: ignore[arg-type]
+        self.assertIsNone(cfg.mss)
+        mux.connect(FdAdapterConfig(saddr=LOCAL_IP, sport=40000, daddr=REMOTE_IP, dport=80))
+        mux.flush()
+        self.assertEqual(adapter.written[0].header.options.mss, 1460)
+        # a second multiplexer sharing the config derives its own MSS
+        adapter = FakeTunAdapter()
+        adapter.mtu = 1280
+        mux = TcpMultiplexer(adapter, cfg)  # type: ignore[arg-type]
+        mux.connect(FdAdapterConfig(saddr=LOCAL_IP, sport=40000, daddr=REMOTE_IP, dport=80))
+        mux.flush()
+        self.assertEqual(adapter.written[0].header.options.mss, 1240)
+        self.assertIsNone(cfg.mss)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+import unittest
+from typing import Optional
+
+from config import FdAdapterConfig, TcpConfig
+from fd_adapter import FdAdapter
+from tcp_segment import TcpSegment
+from tcp_socket import TcpSocket
+from test_tcp_mux import LOCAL_IP, REMOTE_IP
+
+
+class DatagramAdapter(FdAdapter):
+    """
+    One end of a datagram socketpair carrying serialized segments, the
+    fd is closed by the socket's thread as a TUN fd would be
+    """
+    def __init__(self, sock: socket.socket, src_ip: str, dst_ip: str):
+        super().__init__()
+        self._fd = sock.detach()
+        self._src_ip, self._dst_ip = src_ip, dst_ip
+
+    @staticmethod
+    def pair():
+        a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        return DatagramAdapter(a, LOCAL_IP, REMOTE_IP), DatagramAdapter(b, REMOTE_IP, LOCAL_IP)
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def read(self) -> Optional[TcpSegment]:
+        return TcpSegment.deserialize(os.read(self._fd, 65536), self._dst_ip, self._src_ip)
+
+    def write(self, seg: TcpSegment):
+        seg.src_ip, seg.dst_ip = self._src_ip, self._dst_ip
+        try:
+            os.write(self._fd, seg.serialize())
+        except OSError:
+            # the other end has closed its fd
+            pass
+
+
+class TcpSocketCloseTest(unittest.TestCase):
+    def setUp(self):
+        cfg = TcpConfig()
+        cfg.MSL = 50
+        client_adapter, server_adapter = DatagramAdapter.pair()
+        self.client = TcpSocket(client_adapter, cfg)
+        self.server = TcpSocket(server_adapter, cfg)
+        accepting = threading.Thread(target=self.server.listen_and_accept,
+                                     args=[FdAdapterConfig()])
+        accepting.start()
+        self.client.connect()
+        accepting.join(5)
+
+    def test_close(self):
+        self.client.send(b'hello')
+        self.assertEqual(self.server.recv(5), b'hello')
+        closing = threading.Thread(target=self.server.close)
+        closing.start()
+        self.assertTrue(self.client.close(timeout=5))
+        closing.join(5)
+        self.assertFalse(closing.is_alive())
+        self.assertFalse(self.client._tcp.active)
+        self.assertFalse(self.server._tcp.active)
+
+    def test_send_then_close(self):
+        # the data is still in the socketpair when close() is called
+        data = bytes(range(256)) * 400
+        self.client.send(data)
+        closing = threading.Thread(target=self.client.close, args=[5])
+        closing.start()
+        received = b''
+        while len(received) < len(data):
+            chunk = self.server.recv(65536)
+            if not chunk:
+                break
+            received += chunk
+        self.assertTrue(self.server.close(timeout=5))
+        closing.join(5)
+        self.assertEqual(received, data)
+        self.assertTrue(self.server._tcp.outbound_stream.eof)
+        self.assertEqual(self.client._tcp.inbound_stream.bytes_written, len(data))
+
+    def test_close_timeout(self):
+        # the server never closes its side, the client gives up and resets
+        self.assertFalse(self.client.close(timeout=0.2))
+        self.assertFalse(self.client._tcp.active)
+        self.assertTrue(self.server._finished.wait(5))
+        self.assertFalse(self.server._tcp.active)
+        self.server.close()
+
+    def test_aclose(self):
+        async def close_both():
+            return await asyncio.gather(self.client.aclose(5), self.server.aclose(5))
+
+        self.assertEqual(asyncio.run(close_both()), [True, True])
+
+    def test_cork_runs_on_tcp_thread(self):
+        calls = []
+        tcp = self.client._tcp
+        for name in ('set_nodelay', 'cork', 'uncork'):
+            method = getattr(tcp, name)
+            def record(*args, name=name, method=method):
+                calls.append((name, threading.current_thread()))
+                return method(*args)
+            setattr(tcp, name, record)
+        self.client.set_nodelay(True)
+        self.client.cork()
+        self.client.send(b'hello')
+        self.client.uncork()
+        received = self.server.recv(5)
+        closing = threading.Thread(target=self.server.close)
+        closing.start()
+        self.assertTrue(self.client.close(timeout=5))
+        closing.join(5)
+        self.assertEqual(received, b'hello')
+        self.assertEqual([name for name, _ in calls], ['set_nodelay', 'cork', 'uncork'])
+        self.assertTrue(all(thread is self.client._tcp_thread for _, thread in calls))
+
+    def test_cork_holds_following_send(self):
+        self.client.cork()
+        self.client.send(b'x' * 10)
+        time.sleep(0.1)
+        held = self.client._tcp.inbound_stream.size
+        self.client.uncork()
+        received = self.server.recv(10)
+        closing = threading.Thread(target=self.server.close)
+        closing.start()
+        self.assertTrue(self.client.close(timeout=5))
+        closing.join(5)
+        self.assertEqual(held, 10)
+        self.assertEqual(received, b'x' * 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+from config import TcpConfig, FdAdapterConfig
+from tcp_segment import TcpHeader, TcpOptions, TcpSegment
+from tcp_state import TcpState
+from test_tcp_mux import MultiplexerTestBase, LOCAL_IP, REMOTE_IP
+from utils import uint32_plus
+
+FOUR_TUPLE = (LOCAL_IP, 40000, REMOTE_IP, 80)
+
+
+class TimeWaitTest(MultiplexerTestBase):
+    def close_actively(self):
+        conn = self.mux.connect(FdAdapterConfig(
+            saddr=LOCAL_IP, sport=40000, daddr=REMOTE_IP, dport=80))
+        self.exchange()
+        self.mux.shutdown_write(conn)
+        self.exchange()
+        self.peers[80].shutdown_write()
+        fin = self.peers[80].segments_out[0]
+        self.peer_segments(80)
+        self.exchange()
+        return conn, fin
+
+    def peer_segments(self, port: int):
+        peer = self.peers[port]
+        segs = []
+        while peer.segments_out:
+            seg = peer.segments_out.popleft()
+            seg.header.sport, seg.header.dport = port, 40000
+            seg.src_ip, seg.dst_ip = REMOTE_IP, LOCAL_IP
+            segs.append(seg)
+        self.mux.segments_received(segs)
+
+    def test_connection_freed(self):
+        conn, _ = self.close_actively()
+        self.assertEqual(conn.state, TcpState.TIME_WAIT)
+        self.assertEqual(self.peers[80].state, TcpState.CLOSED)
+        self.assertEqual(len(self.mux), 0)
+        self.assertTrue(self.mux.in_time_wait(FOUR_TUPLE))
+        self.mux.tick(2 * TcpConfig.MSL - 1)
+        self.assertTrue(self.mux.in_time_wait(FOUR_TUPLE))
+        self.mux.tick(1)
+        self.assertFalse(self.mux.in_time_wait(FOUR_TUPLE))
+
+    def test_retransmitted_fin_acked(self):
+        conn, fin = self.close_actively()
+        self.mux.tick(500)
+        fin.src_ip, fin.dst_ip = REMOTE_IP, LOCAL_IP
+        self.mux.segments_received([fin])
+        ack = self.adapter.written.popleft()
+        self.assertTrue(ack.header.ack)
+        self.assertFalse(ack.header.fin or ack.header.rst)
+        self.assertEqual(ack.header.seqno, conn.next_seqno)
+        self.assertEqual(ack.header.ackno, conn.ackno)
+        self.assertEqual(ack.header.options.ts_val, uint32_plus(conn.ts_val, 500))
+        self.assertEqual(ack.header.options.ts_ecr, conn.ts_recent)
+
+    def test_connect_reuses_after_a_second(self):
+        conn, _ = self.close_actively()
+        cfg = FdAdapterConfig(saddr=LOCAL_IP, sport=40000, daddr=REMOTE_IP, dport=80)
+        with self.assertRaises(RuntimeError):
+            self.mux.connect(cfg)
+        self.mux.tick(1000)
+        new = self.mux.connect(cfg)
+        self.assertFalse(self.mux.in_time_wait(FOUR_TUPLE))
+        self.mux.flush()
+        syn = self.adapter.written.popleft()
+        self.assertEqual(syn.header.seqno, uint32_plus(conn.next_seqno, 65535 + 2))
+        self.assertEqual(syn.header.options.ts_val, uint32_plus(conn.ts_val, 1001))
+        self.assertIs(self.mux.connection(FOUR_TUPLE), new)
+
+    def test_syn_reuses_with_newer_timestamp(self):
+        conn, _ = self.close_actively()
+        listener = self.mux.listen(LOCAL_IP, 40000)
+        assert conn.ts_recent is not None
+        for ts_val, accepted in ((conn.ts_recent, False), (conn.ts_recent + 1, True)):
+            self.mux.segments_received([TcpSegment(TcpHeader(
+                syn=True, seqno=1, sport=80, dport=40000,
+                options=TcpOptions(mss=1000, ts_val=ts_val)), b'', REMOTE_IP, LOCAL_IP)])
+            self.assertEqual(self.mux.in_time_wait(FOUR_TUPLE), not accepted)
+            self.assertEqual(listener.syn_queue_size, int(accepted))
@@ -0,0 +1,123 @@
+import unittest
+import random
+
+from config import TcpConfig
+from tcp_connection import TcpConnection
+from tcp_segment import TcpHeader, TcpSegment
+from test_sender import SenderTestBase
+from timer_wheel import TimerWheel, ConnectionTimers
+
+
+class TimerWheelTest(unittest.TestCase):
+    def test_fires_at_deadline(self):
+        wheel = TimerWheel()
+        delays = [1, 2, 63, 64, 65, 100, 4095, 4096, 5000, 262144, 300000, 1 << 25]
+        for delay in delays:
+            wheel.schedule(delay, delay)
+        fired = {}
+        while wheel:
+            for key in wheel.advance_to_expiry(1 << 26):
+                fired[key] = wheel.now
+        self.assertEqual(fired, {delay: delay for delay in delays})
+
+    def test_random_against_reference(self):
+        rng = random.Random(144)
+        wheel = TimerWheel()
+        deadlines = {}
+        for _ in range(2000):
+            if rng.random() < 0.7:
+                key = rng.randrange(300)
+                delay = rng.choice((rng.randint(1, 100), rng.randint(1, 10000)))
+                wheel.schedule(key, delay)
+                deadlines[key] = wheel.now + delay
+            elif deadlines and rng.random() < 0.3:
+                key = rng.choice(list(deadlines))
+                wheel.cancel(key)
+                del deadlines[key]
+            target = wheel.now + rng.randint(0, 50)
+            while wheel.now < target:
+                for key in wheel.advance_to_expiry(target - wheel.now):
+                    self.assertEqual(deadlines.pop(key), wheel.now)
+            self.assertFalse(any(d <= wheel.now for d in deadlines.values()))
+        self.assertEqual(len(wheel), len(deadlines))
+
+    def test_next_wakeup(self):
+        rng = random.Random(6)
+        wheel = TimerWheel()
+        self.assertIsNone(wheel.next_wakeup())
+        for _ in range(200):
+            wheel.schedule(rng.randrange(50), rng.randint(1, 20000))
+            # advancing to the wakeup never skips past a deadline
+            wakeup = wheel.next_wakeup()
+            assert wakeup is not None
+            self.assertEqual(wheel.advance(wakeup - 1), [])
+            wheel.advance(1)
+        self.assertEqual(wheel.next_wakeup() is None, len(wheel) == 0)
+
+    def test_reschedule_and_cancel(self):
+        wheel = TimerWheel()
+        wheel.schedule('a', 10)
+        wheel.schedule('b', 10)
+        wheel.schedule('a', 500)
+        wheel.cancel('b')
+        self.assertEqual(wheel.advance(499), [])
+        self.assertEqual(wheel.deadline('a'), 500)
+        self.assertEqual(wheel.advance(1), ['a'])
+        self.assertNotIn('a', wheel)
+
+
+class ConnectionTimersTest(SenderTestBase):
+    def test_matches_polling(self):
+        isn, isn2 = 10000, 20000
+        polled = self.new_eastablished_connection(1000, isn, isn2)
+        wheeled = self.new_eastablished_connection(1000, isn, isn2)
+        timers = ConnectionTimers()
+        for conn in (polled, wheeled):
+            conn.segment_received(TcpSegment(TcpHeader(ack=True, ackno=isn + 1, win=100)))
+            conn.write(b'hello')
+            conn.segments_out.clear()
+        timers.add(wheeled)
+        # the peer is gone: the RTO backs off until the connection gives up
+        while polled.active:
+            polled.tick(10)
+            fired = timers.advance(10)
+            self.assertEqual([(s.header.seqno, s.header.rst) for s in wheeled.segments_out],
+                             [(s.header.seqno, s.header.rst) for s in polled.segments_out])
+            self.assertEqual(fired != [], len(polled.segments_out) > 0)
+            polled.segments_out.clear()
+            wheeled.segments_out.clear()
+        self.assertFalse(wheeled.active)
+        self.assertEqual(len(timers._wheel), 0)
+
+    def test_idle_connection_untouched(self):
+        conn = self.new_eastablished_connection(1000, 1, 2)
+        self.assertIsNone(conn.next_timeout)
+        timers = ConnectionTimers()
+        timers.add(conn)
+        self.assertEqual(timers.advance(60000), [])
+
+    def test_delayed_ack(self):
+        cfg = TcpConfig()
+        cfg.delayed_ack = True
+        conn = TcpConnection(cfg, 1)
+        conn.set_listening()
+        conn.segment_received(TcpSegment(TcpHeader(syn=True, seqno=100)))
+        conn.segment_received(TcpSegment(TcpHeader(ack=True, seqno=101, ackno=2, win=100)))
+        conn.segments_out.clear()
+        timers = ConnectionTimers()
+        timers.add(conn)
+        for data in (b'a', b'b', b'c'):
+            timers.sync(conn)
+            conn.segment_received(TcpSegment(
+                TcpHeader(ack=True, seqno=101 + conn.outbound_stream.bytes_written, ackno=2, win=100),
+                data))
+            timers.update(conn)
+        # the quick ACKs at the start went out at once, the last one waits
+        conn.segments_out.clear()
+        self.assertEqual(timers.advance(TcpConfig.DELACK_TIMEOUT - 1), [])
+        self.assertEqual(timers.advance(1), [conn])
+        self.expectSegment(conn, ack=True, ackno=104)
+
+
+if __name__ == '__main__':
+    unittest.main()
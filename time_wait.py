@@ -0,0 +1,120 @@
+from typing import Dict, Hashable, NamedTuple, Optional
+
+from config import TcpConfig
+from tcp_connection import TcpConnection
+from tcp_segment import TcpSegment, TcpHeader
+
+
+class TimeWaitEntry(NamedTuple):
+    # our next sequence number, which the peer's FIN was acknowledged with
+    seqno: int
+    # the peer's next sequence number, one past its FIN
+    ackno: int
+    # our TSval and the peer's TS.Recent on entry, None without timestamps
+    ts_val: Optional[int]
+    ts_recent: Optional[int]
+    # table time the connection entered TIME_WAIT
+    since: int
+
+
+class TimeWaitTable:
+    """
+    What is left of connections in TIME_WAIT once their TcpConnection is
+    freed: enough to ACK a retransmitted FIN and to decide whether a new
+    SYN may reuse the 4-tuple.
+
+    Every entry lives for the same 2 * MSL, so entries expire in the order
+    they were added and expire() only looks at the oldest ones.
+    """
+    def __init__(self, duration: int = 2 * TcpConfig.MSL):
+        self._duration = duration
+        # in the order connections entered TIME_WAIT
+        self._entries: Dict[Hashable, TimeWaitEntry] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable) -> Optional[TimeWaitEntry]:
+        return self._entries.get(key)
+
+    def add(self, key: Hashable, conn: TcpConnection, now: int):
+        assert conn.ackno is not None
+        self._entries.pop(key, None)
+        self._entries[key] = TimeWaitEntry(
+            conn.next_seqno, conn.ackno, conn.ts_val, conn.ts_recent, now)
+
+    def remove(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def expire(self, now: int) -> int:
+        """
+        Drop the entries older than 2 * MSL, return how many
+        """
+        expired = 0
+        for entry in self._entries.values():
+            if now - entry.since < self._duration:
+                break
+            expired += 1
+        for _ in range(expired):
+            del self._entries[next(iter(self._entries))]
+        return expired
+
+    def next_expiry(self, now: int) -> Optional[int]:
+        """
+        Milliseconds until the oldest entry expires, None when the table is empty
+        """
+        for entry in self._entries.values():
+            return max(entry.since + self._duration - now, 0)
+        return None
+
+    def reply(self, key: Hashable, seg: TcpSegment, now: int) -> Optional[TcpSegment]:
+        """
+        The ACK for a retransmitted FIN, None for anything else
+        """
+        entry = self._entries[key]
+        if not seg.header.fin or seg.header.rst or seg.header.syn:
+            return None
+        ack = TcpSegment(TcpHeader(
+            ack=True,
+            seqno=entry.seqno,
+            ackno=entry.ackno
+        ))
+        if entry.ts_val is not None:
+            ack.header.options.ts_val = self.ts_val(key, now)
+            ack.header.options.ts_ecr = entry.ts_recent
+        return ack
+
+    def ts_val(self, key: Hashable, now: int) -> Optional[int]:
+        """
+        The TSval the old connection would send now
+        """
+        entry = self._entries[key]
+        if entry.ts_val is None:
+            return None
+        return (entry.ts_val + now - entry.since) & 0xffffffff
+
+    def syn_acceptable(self, key: Hashable, seg: TcpSegment) -> bool:
+        """
+        Whether a SYN may open a new connection on a 4-tuple in TIME_WAIT:
+        with timestamps its TSval must be newer than the old connection's
+        (RFC 6191), without them its sequence number must lie past the
+        old one's (RFC 1122 4.2.2.13)
+        """
+        entry = self._entries[key]
+        ts_val = seg.header.options.ts_val
+        if entry.ts_recent is not None and ts_val is not None:
+            return 0 < ((ts_val - entry.ts_recent) & 0xffffffff) < (1 << 31)
+        return 0 < ((seg.header.seqno - entry.ackno) & 0xffffffff) < (1 << 31)
+
+    def reusable(self, key: Hashable, now: int) -> bool:
+        """
+        Whether we may connect out again on the 4-tuple before the entry
+        expires: timestamps were in use and a second has passed, so the
+        peer's PAWS check tells the new connection's segments from the old
+        one's (as Linux tcp_tw_reuse)
+        """
+        entry = self._entries[key]
+        return entry.ts_val is not None and now - entry.since >= 1000
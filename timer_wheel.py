@@ -0,0 +1,205 @@
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from tcp_connection import TcpConnection
+
+
+class TimerWheel:
+    """
+    Hierarchical timing wheel (Varghese & Lauck) with 1 ms resolution.
+
+    Level 0 has one slot per millisecond, each higher level one slot per
+    full turn of the level below. A timer sits in the level matching how
+    far away its deadline is and moves down a level each time its slot
+    comes up, so scheduling, cancelling and firing are O(1) per timer
+    no matter how many are pending.
+    """
+    SLOT_BITS = 6
+    SLOTS = 1 << SLOT_BITS
+    MASK = SLOTS - 1
+    LEVELS = 4
+
+    def __init__(self):
+        self._now = 0
+        self._slots: List[List[Dict[Hashable, None]]] = [
+            [{} for _ in range(self.SLOTS)] for _ in range(self.LEVELS)]
+        self._counts = [0] * self.LEVELS
+        # key -> (deadline, level, slot index)
+        self._timers: Dict[Hashable, Tuple[int, int, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._timers)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._timers
+
+    @property
+    def now(self) -> int:
+        return self._now
+
+    def deadline(self, key: Hashable) -> Optional[int]:
+        timer = self._timers.get(key)
+        return timer[0] if timer is not None else None
+
+    def next_wakeup(self) -> Optional[int]:
+        """
+        Milliseconds until the wheel must be advanced next, None when no
+        timer is pending: the first occupied level 0 slot before the end
+        of the current turn, else the end of the turn, where the next
+        cascade may bring timers down
+        """
+        if not self._timers:
+            return None
+        turn_end = self.SLOTS - (self._now & self.MASK)
+        if self._counts[0]:
+            for ms in range(1, turn_end):
+                if self._slots[0][(self._now + ms) & self.MASK]:
+                    return ms
+        return turn_end
+
+    def schedule(self, key: Hashable, delay_ms: int):
+        """
+        (Re)arm the timer for key to expire delay_ms from now, at least 1 ms
+        """
+        self.cancel(key)
+        self._place(key, self._now + max(delay_ms, 1))
+
+    def cancel(self, key: Hashable):
+        timer = self._timers.pop(key, None)
+        if timer is None:
+            return
+        _, level, index = timer
+        del self._slots[level][index][key]
+        self._counts[level] -= 1
+
+    def advance(self, ms: int) -> List[Hashable]:
+        """
+        Move the clock forward, return the keys that expired in deadline order
+        """
+        return self._run(self._now + ms, stop_at_expiry=False)
+
+    def advance_to_expiry(self, ms: int) -> List[Hashable]:
+        """
+        Move the clock forward by up to ms, stopping at the first millisecond
+        at which timers expire; return those keys, empty when none did
+        """
+        return self._run(self._now + ms, stop_at_expiry=True)
+
+    def _run(self, target: int, stop_at_expiry: bool) -> List[Hashable]:
+        expired: List[Hashable] = []
+        while self._now < target:
+            if not self._timers:
+                self._now = target
+                break
+            if not self._counts[0]:
+                # nothing due this turn, skip to the next cascade
+                self._now = min(self._now | self.MASK, target)
+                if self._now == target:
+                    break
+            self._now += 1
+            index = self._now & self.MASK
+            if index == 0:
+                self._cascade(1)
+            slot = self._slots[0][index]
+            if not slot:
+                continue
+            self._slots[0][index] = {}
+            self._counts[0] -= len(slot)
+            for key in slot:
+                deadline = self._timers.pop(key)[0]
+                if deadline <= self._now:
+                    expired.append(key)
+                else:
+                    self._place(key, deadline)
+            if expired and stop_at_expiry:
+                break
+        return expired
+
+    def _place(self, key: Hashable, deadline: int):
+        delta = deadline - self._now
+        level = 0
+        while level < self.LEVELS - 1 and delta >= 1 << (self.SLOT_BITS * (level + 1)):
+            level += 1
+        # beyond the top level the slot comes up early and the timer is placed again
+        index = (deadline >> (self.SLOT_BITS * level)) & self.MASK
+        self._slots[level][index][key] = None
+        self._counts[level] += 1
+        self._timers[key] = (deadline, level, index)
+
+    def _cascade(self, level: int):
+        index = (self._now >> (self.SLOT_BITS * level)) & self.MASK
+        if index == 0 and level + 1 < self.LEVELS:
+            self._cascade(level + 1)
+        slot = self._slots[level][index]
+        if not slot:
+            return
+        self._slots[level][index] = {}
+        self._counts[level] -= len(slot)
+        for key in slot:
+            self._place(key, self._timers.pop(key)[0])
+
+
+class ConnectionTimers:
+    """
+    Tick many TcpConnections from one TimerWheel: a connection is only
+    touched when its earliest timer (RTO, persist, delayed ACK, RACK/TLP,
+    TIME_WAIT) is due, instead of every loop iteration.
+
+    The owner calls sync() before handing a connection segments or data,
+    so its clock is current, and update() afterwards to rearm its timer.
+    """
+    def __init__(self):
+        self._wheel = TimerWheel()
+        # wheel time each connection was last ticked to
+        self._ticked: Dict[TcpConnection, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._ticked)
+
+    @property
+    def now(self) -> int:
+        return self._wheel.now
+
+    def next_wakeup(self) -> Optional[int]:
+        return self._wheel.next_wakeup()
+
+    def add(self, conn: TcpConnection):
+        self._ticked[conn] = self._wheel.now
+        self.update(conn)
+
+    def remove(self, conn: TcpConnection):
+        self._wheel.cancel(conn)
+        self._ticked.pop(conn, None)
+
+    def sync(self, conn: TcpConnection):
+        """
+        Bring the connection's clock up to the wheel's
+        """
+        elapsed = self._wheel.now - self._ticked[conn]
+        if elapsed > 0:
+            self._ticked[conn] = self._wheel.now
+            conn.tick(elapsed)
+
+    def update(self, conn: TcpConnection):
+        """
+        Rearm the connection's timer after it was ticked or fed
+        """
+        timeout = conn.next_timeout if conn.active else None
+        if timeout is None:
+            self._wheel.cancel(conn)
+        else:
+            self._wheel.schedule(conn, timeout)
+
+    def advance(self, ms: int) -> List[TcpConnection]:
+        """
+        Move time forward and tick the connections whose timers expired,
+        return them so the owner can send what they queued
+        """
+        fired = []
+        target = self._wheel.now + ms
+        while self._wheel.now < target:
+            # stop at each expiry, a connection may rearm before target
+            for conn in self._wheel.advance_to_expiry(target - self._wheel.now):
+                self.sync(conn)
+                self.update(conn)
+                fired.append(conn)
+        return fired